@@ -10,26 +10,115 @@ This .py file contains multiple functions:
     
     ***FUNCTIONS FOR FUNCTIONAL PROXIMITY ANALYSES***
     getCsvList() = list of all mIHC files for all analyses
+    fileHash() = sha256 of a file's contents
+    roiSourceHash() = sha256 of an mIHC csv, recomputed only when the csv changes
+    cacheROI() = converts one mIHC csv into a typed columnar cache file
+    refreshROICache() = (re)builds the cache file of one ROI if it is missing or out of date
+    getROICacheVersion() = version of the columnar cache format
+    loadROI() = reads selected columns of one mIHC file from disk through the columnar cache
+    getCohortStore() = gets the memory-mapped compact cohort store, building it when missing or out of date
+    buildCohortStore() = writes all ROIs into one struct-of-arrays file with uint8 class codes and bit-packed markers
+    cohortStoreROI() = gets the columns of one ROI for the cohort store
+    openCohortStore() = memory-maps the cohort store
+    cohortROI() = slices the cells of one ROI out of the cohort store without copying
+    cohortFrame() = gets coordinate, class and marker columns of one ROI from the cohort store as a df
+    startSession() = starts a session-level store so each file is read once per run and intermediates stay in memory
+    endSession() = empties the session-level store
+    readROI() = gets selected columns of one mIHC file, from the session store when one is active
+    readClinical() = gets the clinical data, from the session store when one is active
+    saveResult() = saves an intermediate df to 'dfCreated' and keeps it in memory for the next stage
+    loadResult() = gets an intermediate df, from memory when available
+    buildROICache() = converts all mIHC csvs into the columnar cache up front
+    codeVersion() = fingerprints a function's code together with the functions of this file it depends on
+    runMemoized() = runs a pipeline stage only if its inputs, parameters or code changed since its outputs were made
+    mapROIs() = runs a per-ROI function on every mIHC file, optionally across a pool of processes
+    iterROIs() = streaming form of mapROIs(), yielding each ROI's result in order as soon as it is ready
+    getPoolContext() = multiprocessing context process pools start their workers with (forkserver or spawn, never fork)
+    startWorker() = sets up a pool worker like the process that started it: neighbor backend and cohort store
+    setNeighborBackend() = selects the kdtree or grid backend for every fixed-radius neighbor search
+    gridNeighbors() = finds all pairs of points within a radius with a uniform grid of buckets the size of the radius
+    buildNeighborGraph() = builds the radius neighbor graph (with distances) of all cells of an ROI
+    filterGraph() = derives a smaller-radius neighbor graph by filtering stored distances
+    graphRows() = gets the neighbors of a set of cells from a neighbor graph
+    getNeighborGraph() = gets the neighbor graph of an ROI from a persistent cache keyed by ROI content hash and radius
+    spillTiles() = streams an mIHC csv into spatial tiles with a halo, for slides too large to load
+    readTile() = reads one spatial tile written by spillTiles()
+    withinDistance() = checks whether each seed cell has any neighbor cell within set distance
+    funProximityROI() = gets functional status and proximity of the seed cells of one ROI
+    funProximityTiles() = classifies the seed cells of one ROI as close/far one spatial tile at a time
+    proximityTables() = formats the seed cells of one ROI into close and far dfs
+    markerSummary() = counts seed cells and percent positive for each functional marker per location and patient
     nkFunTumSpatial() = gets functional status of NK cells and spatial proximity to neoplastic tumor cells
     tumFunNKSpatial() = gets functional status of neoplastic tumor cells and spatial proximity to NK cells
+    proximityNull() = tests per ROI whether seed cells are proximal to neighbor cells more than random label placement would give
+    proximityNullROI() = runs the label permutation test of one ROI in batches of sparse products
+    nearestDistance() = records each seed cell's exact distance to the nearest neighbor cell, with its functional markers
+    nearestDistanceROI() = finds the nearest neighbor cell distance of every seed cell of one ROI in one query
+    thresholdCurves() = derives percent positive per patient at any set of distance thresholds from the nearest distances
     
     ***FUNCTIONS FOR NEIGHBORHOOD ANALYSES***
+    getClassOptions() = list of all possible neighbor cell classes
+    radiusNeighbors() = finds all neighbors of a set of seed cells within set distance in one pass
+    neighborClassCounts() = counts neighboring cell types of each seed cell via a sparse adjacency x one-hot class product
+    neighborhoodTable() = formats neighbor counts of one ROI into rows of the neighborhood clustering df
+    neighborhoodROI() = calculates spatial neighbors of the seed cells of one ROI at one or more distances
+    radiusClassCounts() = counts neighboring cell types of each seed cell at one or more radii from pairs found at the largest radius
+    neighborhoodTiles() = counts neighboring cell types of the seed cells of one ROI one spatial tile at a time
+    interactionMatrix() = counts contacts between every pair of cell classes per ROI and radius, with expected counts and enrichment
+    interactionROI() = counts contacts between every pair of cell classes of one ROI at one or more radii
+    lookupInteraction() = gets the contacts between two groups of cell classes from a saved interaction table
     makeNeighborhoods() = calculates spatial neighbors of seed cells within set distance
-    elbowMethod() = runs elbow method to determine optimal number of clusters
+    makeNeighborhoodsSweep() = calculates spatial neighbors of seed cells at several distances in a single spatial pass
+    writeNeighborhoodPart() = appends the neighborhoods of one ROI to the neighborhood csv and/or parquet dataset
+    readNeighborhoods() = reads a neighborhood table from its csv or parquet dataset
+    restoreNeighborhoods() = gives a chunk of a parquet neighborhood dataset the columns and values it has in the csv
+    iterNeighborhoods() = reads a neighborhood table in chunks of rows
+    elbowMethod() = runs elbow method to determine optimal number of clusters, returning the WCSS curve and the detected elbow
+    fitKMeans() = fits one k-means model for the elbow method, optionally warm started from the k-1 centroids
+    kneedle() = finds the elbow of a decreasing convex curve (Kneedle method)
     clusterNeighborhoods() = clusters neighborhoods based upon cellular compositions
-    createCsvsWithClusterCol = creates new mIHC csvs with cluster column denoting NK cell neighborhood assignment 
+    clusterNeighborhoodsChunked() = clusters neighborhood tables too large for memory by streaming chunks (reservoir-sampled k-means++ seeds, then shuffled partial_fit)
+    saveNeighborhoodModel() = saves the centroids and feature columns of a fitted neighborhood clustering
+    loadNeighborhoodModel() = reads a saved neighborhood clustering model
+    neighborhoodsDigest() = fingerprints the first rows of a neighborhood table
+    frozenNeighborhoodModel() = gets the saved model if the neighborhood table has only grown since it was fitted
+    writeNeighborhoodClusters() = assigns every neighborhood of a table to the nearest centroid of a saved model
+    nearestCentroid() = finds the nearest centroid of each row of data
+    assignNeighborhoods() = adds new ROIs to an existing clustering by assigning them to the saved model's centroids
+    createCsvsWithClusterCol = creates new mIHC csvs with cluster column denoting NK cell neighborhood assignment, for two ROIs or all of them 
+    annotateROI() = adds the cluster column to one mIHC csv
     clusterCountPerROI = calculates how many seed cells are assigned to each cluster per patient, ROI 
+    clusterRollup() = rolls cluster counts per ROI up to patient, cohort, HER2 status and all ROIs, with fractions
+    queryRollup() = gets the groups of one level of a saved cluster rollup
+
+    ***FUNCTIONS FOR SPATIAL STATISTICS***
+    ripleyCurves() = calculates univariate and cross-type Ripley's K and L functions of cell groups at many radii per ROI
+    ripleyROI() = calculates the K and L functions of one ROI from the pairs of cells within the largest radius
+    ripleyFromPairs() = calculates K functions of groups of cells from one sorted pass over their pair distances, with translation edge correction
+    ripleyCSRCheck() = checks that K = pi*r^2 under complete spatial randomness, for single, overlapping and disjoint groups
+    benchmarkNeighborBackends() = times KDTree, cKDTree and the grid backend across ROI sizes and checks they find the same neighbors
    
     ***FUNCTIONS TO GENERATE RESULTS (which call to the above functions)***
+    startFigureExport() = starts queueing plotly figures so they are rendered together
+    exportFigure() = exports a plotly figure, queued, rendered now, or as plot data (json/html) without rendering
+    renderFigures() = renders a list of plotly figures through a single renderer
+    flushFigures() = renders all queued figures, optionally over a few renderer processes
+    getPipeline() = lays out all analyses as a graph of stages and the stages they depend on
+    runPipeline() = runs the stages needed for a set of targets, independent stages concurrently, and reports the critical path
     fig3() = generates Figures 3A-3D, Supplementary Figures S5A-S5C
+    fig3A(), fig3B(), fig3CD(), figS5() = the plotting stages of figure 3
     fig4() = generates Figures 4C-4E
+    fig4C(), fig4DE() = the plotting stages of figure 4
     fig5() = generates Figures 5B-5F, Supplementary Figures S7A-S7C
+    reportElbow() = prints the elbow detected for figure 5
+    fig5B(), fig5C(), figS7A(), fig5DE(), figS7B(), fig5F(), figS7C() = the plotting stages of figure 5
    
 Note: This program assumes the following items live in the same directory as this .py file:
     - 'data' folder, which houses 2 folders:
         -'mIHC_files' folder, which houses all mIHC data (.csv files)
         -'metadata' folder, which houses clinical data
-    -'results' folder, which houses 2 folders:
+        -'mIHC_cache' folder, created by this code, which stores a typed columnar copy of each mIHC csv (and the compact cohort store, if built)
+    -'results' folder, which houses 2 folders (and a 'cache' folder created by this code for cached neighbor graphs and stage fingerprints):
         -'dfCreated' folder, which will store dataframes created by this code, and houses 1 folder:
             -'updatedCsvs' folder within 'dfCreated' folder, which will store revised mIHC csv files with neighborhood clustering assignments
         -'figures' folder, which will store figures created by this code
@@ -37,6 +126,8 @@ Note: This program assumes the following items live in the same directory as thi
 This program is intended for Python version 3.
 """
 
+import threading
+
 
 
 def getCsvList():
@@ -119,856 +210,3683 @@ def getCsvList():
 
 
 
-def nkFunTumSpatial(path,csvList,distThresh):
+def fileHash(filePath):
     '''
-    This function identifies the functional status of NK cells that are proximal and distal to neoplastic epithelial cells
+    This function gets the sha256 hash of a file's contents, read in blocks. A folder (eg. a parquet dataset) is hashed by the names and contents of its files.
     Input parameters:
-        path = cwd
-        csvList = list of mIHC files in the dataset
-        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        filePath = full path of the file or folder
     Outputs:
-        Saves one csv with proportion of NK cells expressing functional markers that are proximal vs distal to neoplastic cells per patient. Csv saved to the /results/dfCreated/ folder.
+        returns: sha256 hex digest of the file
     '''
-    
-    import pandas as pd
-    from scipy import spatial
 
-    cellsToKeep = ['Tumor cells','CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
-    neighType = 'Tumor cells'
-    seedList = ['CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
+    import os
+    import hashlib
 
-    #empty lists to store functional results - for NK seeds with a tumor neighbor
-    fileList = []
-    seedIdxList = []
-    cd16List = []
-    cd57List = []
-    ki67List = []
-    nkg2dList = []
-    pd1List = []
-    tim3List = []
-    grzbList = []
-    
-    #empty lists to store functional results - for NK seeds withOUT a tumor neighbor
-    fileFarList = []
-    seedIdxFarList = []
-    cd16FarList = []
-    cd57FarList = []
-    ki67FarList = []
-    nkg2dFarList = []
-    pd1FarList = []
-    tim3FarList = []
-    grzbFarList = []
-    
-    #loop through each file in the csvList
-    for file in csvList:
-        #read original csv
-        df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0)
+    sha = hashlib.sha256()
+    if os.path.isdir(filePath):
+        for name in sorted(os.listdir(filePath)):
+            sha.update((name+fileHash(filePath+'/'+name)).encode())
+        return sha.hexdigest()
 
-        #only care about specific cells so filter down to speed up neighbor loop
-        filt_df = df[(df['class'].isin(cellsToKeep))]
-
-        ##get nearest neighbors of seed cells defined by seed param
-        #create np array of just x,y coordinates
-        ptsArray = filt_df[['Location_Center_X','Location_Center_Y']].values
-
-        #create kdtree
-        tree = spatial.KDTree(ptsArray)
-
-        #loop through each cell in the filt_df and check its neighbors if it's an NK cell
-        for i in range(len(ptsArray)):
-
-            classType = filt_df['class'].values[i]
-
-            #only check neighbors if the seed cell is the desired classType aka an NK cell
-            if classType in seedList:
-                neighs = tree.query_ball_point(ptsArray[i], distThresh) #get neighbors within distance
-
-                #check if there is a tumor cell as a neighbor within the distance; loop through each neighbor and get its class
-                #start as not having a tumor cell as a neighbor
-                tumNeigh = False
-                while tumNeigh == False:
-                    for j in neighs:
-
-                        #get its class
-                        neighClass = filt_df['class'].values[j]
-
-                        #if it's a tumor cell, get fun status of seed, eventually change to True
-                        if neighClass == neighType:
-
-                            #get seed cell index (original df.loc index), function
-                            seedIdx = filt_df.iloc[i].name
-                            cd16 = filt_df['Cellsp_CD16p'].values[i]
-                            cd57 = filt_df['Cellsp_CD57p'].values[i]
-                            ki67 = filt_df['Cellsp_Ki67p'].values[i]
-                            nkg2d = filt_df['Cellsp_NKG2Dp'].values[i]
-                            pd1 = filt_df['Cellsp_PD1p'].values[i]
-                            tim3 = filt_df['Cellsp_TIM3p'].values[i]
-                            grzb = filt_df['Cellsp_GRZBp'].values[i]
-
-                            #add values to lists to store in df later
-                            fileList.append(file)
-                            seedIdxList.append(seedIdx)
-                            cd16List.append(cd16)
-                            cd57List.append(cd57)
-                            ki67List.append(ki67)
-                            nkg2dList.append(nkg2d)
-                            pd1List.append(pd1)
-                            tim3List.append(tim3)
-                            grzbList.append(grzb)
-                            
-                            tumNeigh = True
-                            break
-
-                        #if not a Tumor cell neighbor, continue checking the next neighbor
-                        else:
-                            continue
-
-                    #if tumNeigh still false after looping through all neighbors, the seed cell is not close to tumor cells
-                    #get its function too - store in far df
-                    if tumNeigh == False:
-                        seedIdxFar = filt_df.iloc[i].name
-                        cd16Far = filt_df['Cellsp_CD16p'].values[i]
-                        cd57Far = filt_df['Cellsp_CD57p'].values[i]
-                        ki67Far = filt_df['Cellsp_Ki67p'].values[i]
-                        nkg2dFar = filt_df['Cellsp_NKG2Dp'].values[i]
-                        pd1Far = filt_df['Cellsp_PD1p'].values[i]
-                        tim3Far = filt_df['Cellsp_TIM3p'].values[i]
-                        grzbFar = filt_df['Cellsp_GRZBp'].values[i]
-                        
-                        #add values to lists to store in df later
-                        fileFarList.append(file)
-                        seedIdxFarList.append(seedIdxFar)
-                        cd16FarList.append(cd16Far)
-                        cd57FarList.append(cd57Far)
-                        ki67FarList.append(ki67Far)
-                        nkg2dFarList.append(nkg2dFar)
-                        pd1FarList.append(pd1Far)
-                        tim3FarList.append(tim3Far)
-                        grzbFarList.append(grzbFar)
-
-                        #then make tumNeigh True to exit while loop and move to the next seed       
-                        tumNeigh = True
+    with open(filePath,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
 
-    #store results in df - for seeds with a Tumor neighbor
-    dfFunClose = pd.DataFrame()
-    dfFunClose['file'] = fileList
-    dfFunClose['seedIdx'] = seedIdxList
-    dfFunClose['cd16'] = cd16List
-    dfFunClose['cd57'] = cd57List
-    dfFunClose['ki67'] = ki67List
-    dfFunClose['nkg2d'] = nkg2dList
-    dfFunClose['pd1'] = pd1List
-    dfFunClose['tim3'] = tim3List
-    dfFunClose['grzb'] = grzbList
-    
-    #store results in df - for seeds withOUT a Tumor neighbor
-    dfFunFar = pd.DataFrame()
-    dfFunFar['file'] = fileFarList
-    dfFunFar['seedIdx'] = seedIdxFarList
-    dfFunFar['cd16'] = cd16FarList
-    dfFunFar['cd57'] = cd57FarList
-    dfFunFar['ki67'] = ki67FarList
-    dfFunFar['nkg2d'] = nkg2dFarList
-    dfFunFar['pd1'] = pd1FarList
-    dfFunFar['tim3'] = tim3FarList
-    dfFunFar['grzb'] = grzbFarList
- 
-    #now merge close and far dfs into one df and organize per patient
-    locat = ['close','far']
-    nameDict = {'close':dfFunClose,'far':dfFunFar}
-
-    #empty lists to store % cells positive per patient
-    cd16List = []
-    cd57List = []
-    ki67List = []
-    nkg2dList = []
-    pd1List = []
-    tim3List = []
-    grzbList = []
-    totalList = [] #stores raw count of NK cells for that patient at that location
-    her2List = []
-    locatList = []
-    ptList = []
-
-    #read clinical df for HER2 status
-    dfClin = pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
-
-    #loop through close then far dfs created earlier
-    for l in locat:
-
-        dfName = nameDict[l]
-
-        #get just patient name
-        dfName['file'] = dfName['file'].str.slice(0,-6)
-
-        #subset to just one patient at a time
-        for pt in dfName['file'].unique():
-
-            dfPt = dfName[dfName['file'] == pt]
-
-            #get total count of nk cells
-            totNK = len(dfPt)
-
-            #sum the functional markers for the patient - across all ROIs
-            dfTotal = dfPt.sum(axis=0)
-
-            #get patient's her2 status
-            her2 = dfClin.loc[pt,'HER2'] #0 = HER2-, 1 = HER2+
-
-            cd16List.append(dfTotal['cd16']/totNK*100)
-            cd57List.append(dfTotal['cd57']/totNK*100)
-            ki67List.append(dfTotal['ki67']/totNK*100)
-            nkg2dList.append(dfTotal['nkg2d']/totNK*100)
-            pd1List.append(dfTotal['pd1']/totNK*100)
-            tim3List.append(dfTotal['tim3']/totNK*100)
-            grzbList.append(dfTotal['grzb']/totNK*100)
-            totalList.append(totNK)
-            her2List.append(her2)
-            locatList.append(l)
-            ptList.append(pt)
-
-    #put results into a df to plot
-    dfFun = pd.DataFrame([cd16List,cd57List,ki67List,nkg2dList,pd1List,tim3List,grzbList,totalList,her2List,locatList,ptList]).T
-    dfFun.columns = ['CD16','CD57','KI67','NKG2D','PD1','TIM3','GRZB','Total NK Cells','HER2','Location','Patient']
+    return sha.hexdigest()
 
-    #save dfFun to csv - this gets used to create figures
-    dfFun.to_csv(path+'/results/dfCreated/dfNKFun_TumorSpatial_all'+str(distThresh)+'.csv')    
-    
-    
-    
-def tumorFunNKspatial(path,csvList,distThresh):
+
+
+def roiSourceHash(path,file):
     '''
-    This function identifies the functional status of neoplastic cells that are proximal and distal to NK cells
+    This function gets the sha256 hash of an mIHC file's csv. The hash is stored next to the columnar cache of the ROI
+    and is only recomputed when the csv's modification time or size changes.
     Input parameters:
         path = cwd
-        csvList = list of mIHC files in the dataset
-        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        file = name of the mIHC file, excluding the .csv
     Outputs:
-        Saves one csv with proportion of neoplastic cells expressing functional markers that are proximal vs distal to NK cells per patient. Csv saved to the /results/dfCreated/ folder.
+        returns: sha256 hex digest of the csv
     '''
 
-    import pandas as pd
-    from scipy import spatial
+    import os
+    import uuid
+    import json
 
-    cellsToKeep = ['Tumor cells','CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
-    seed = 'Tumor cells'
-    nkList = ['CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
+    srcPath = path+'/data/mIHC_files/'+file+'.csv'
+    infoPath = path+'/data/mIHC_cache/'+file+'.json'
+    stat = os.stat(srcPath)
 
-    #empty lists to store functional results - for seeds with a NK neighbor
-    fileList = []
-    seedIdxList = []
-    hla1List = []
-    ki67List = []
-    pdl1List = []
-    caixList = []
-
-    #empty lists to store functional results - for seeds withOUT a NK neighbor
-    fileFarList = []
-    seedIdxFarList = []
-    hla1FarList = []
-    ki67FarList = []
-    pdl1FarList = []
-    caixFarList = []
-
-    #loop through each file in the csvList
-    for file in csvList:
-        #read original csv
-        df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0)
+    #reuse the stored hash if the csv has not been touched since it was hashed
+    info = {}
+    if os.path.exists(infoPath):
+        with open(infoPath) as f:
+            info = json.load(f)
+        if info.get('mtime_ns') == stat.st_mtime_ns and info.get('size') == stat.st_size:
+            return info['sha256']
 
-        #only care about specific cells so filter down to speed up neighbor loop
-        filt_df = df[(df['class'].isin(cellsToKeep))]
-
-        ##get nearest neighbors of seed cells defined by seed param
-        #create np array of just x,y coordinates
-        ptsArray = filt_df[['Location_Center_X','Location_Center_Y']].values
-
-        #create kdtree
-        tree = spatial.KDTree(ptsArray)
-
-        #loop through each cell in the filt_df and check its neighbors if it's a tumor cell
-        for i in range(len(ptsArray)):
-            classType = filt_df['class'].values[i]
-
-            #only check neighbors if the seed cell is the desired classType
-            if classType == seed:
-
-                neighs = tree.query_ball_point(ptsArray[i], distThresh) #get neighbors within distance
-                #check if there is an NK cell as a neighbor within the distance; loop through each neighbor and get its class
-
-                #start as not having an NK cell as a neighbor
-                nkNeigh = False
-
-                while nkNeigh == False:
-                    for j in neighs:
-                        #get its class
-                        neighClass = filt_df['class'].values[j]
-
-                        #if it's an NK cell, get fun status, eventually change to True
-                        if neighClass in nkList:
-
-                            #get seed cell index (original df.loc index), function
-                            seedIdx = filt_df.iloc[i].name
-                            hla1 = filt_df['Cellsp_HLAIIp'].values[i] #in csv it's listed as HLAII even though it's HLAI
-                            ki67 = filt_df['Cellsp_Ki67p'].values[i]
-                            pdl1 = filt_df['Cellsp_PDL1p'].values[i]
-                            caix = filt_df['Cellsp_CAIXp'].values[i]
-
-                            #add values to lists to store in df later
-                            fileList.append(file)
-                            seedIdxList.append(seedIdx)
-                            hla1List.append(hla1)
-                            ki67List.append(ki67)
-                            pdl1List.append(pdl1)
-                            caixList.append(caix)
-                            nkNeigh = True
-                            break
-
-                        #if not a NK cell neighbor, continue checking the next neighbor
-                        else:
-                            continue
-
-                    #if nkNeigh still false after looping through all neighbors, the seed cell is not close to NK cells
-                    #get its function too - store in far df
-                    if nkNeigh == False:
-                        seedIdxFar = filt_df.iloc[i].name
-                        hla1Far = filt_df['Cellsp_HLAIIp'].values[i] #in csv it's listed as HLAII even though it's HLAI
-                        ki67Far = filt_df['Cellsp_Ki67p'].values[i]
-                        pdl1Far = filt_df['Cellsp_PDL1p'].values[i]
-                        caixFar = filt_df['Cellsp_CAIXp'].values[i]
-
-                        #add values to lists to store in df later
-                        fileFarList.append(file)
-                        seedIdxFarList.append(seedIdxFar)
-                        hla1FarList.append(hla1Far)
-                        ki67FarList.append(ki67Far)
-                        pdl1FarList.append(pdl1Far)
-                        caixFarList.append(caixFar)
-
-                        #then make nkNeigh True to exit while loop and move to the next seed       
-                        nkNeigh = True
+    #otherwise hash the csv and store the hash with the csv's current mtime and size
+    info.update({'mtime_ns':stat.st_mtime_ns, 'size':stat.st_size, 'sha256':fileHash(srcPath)})
 
-    #store results in df - for seeds with a NK neighbor
-    dfFunClose = pd.DataFrame()
-    dfFunClose['file'] = fileList
-    dfFunClose['seedIdx'] = seedIdxList
-    dfFunClose['hla1'] = hla1List
-    dfFunClose['ki67'] = ki67List
-    dfFunClose['pdl1'] = pdl1List
-    dfFunClose['caix'] = caixList
+    #write to a uniquely named temporary file then rename, so concurrent writers never see a partial file
+    tmpPath = infoPath+'.'+uuid.uuid4().hex+'.tmp'
+    os.makedirs(path+'/data/mIHC_cache', exist_ok=True)
+    with open(tmpPath,'w') as f:
+        json.dump(info, f)
+    os.replace(tmpPath, infoPath)
+
+    return info['sha256']
 
-    #store results in df - for seeds withOUT a NK neighbor
-    dfFunFar = pd.DataFrame()
-    dfFunFar['file'] = fileFarList
-    dfFunFar['seedIdx'] = seedIdxFarList
-    dfFunFar['hla1'] = hla1FarList
-    dfFunFar['ki67'] = ki67FarList
-    dfFunFar['pdl1'] = pdl1FarList
-    dfFunFar['caix'] = caixFarList
-
-    locat = ['close','far']
-    nameDict = {'close':dfFunClose,'far':dfFunFar}
-    
-    #empty lists to store % cells positive per patient
-    hla1List = []
-    ki67List = []
-    pdl1List = []
-    caixList = []
-    totalList = [] #stores raw count of NK cells for that patient at that location
-    her2List = []
-    locatList = []
-    ptList = []
-    
-    #read clinical df for HER2 status
-    dfClin = pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
-    
-    #loop through close then far tumor cell csvs
-    for l in locat:
-        dfName = nameDict[l]
-        
-        #get just patient name
-        dfName['file'] = dfName['file'].str.slice(0,-6)
-    
-        #subset to just one patient at a time
-        for pt in dfName['file'].unique():
-    
-            dfPt = dfName[dfName['file'] == pt]
-    
-            #get total count of tumor cells
-            totTum = len(dfPt)
-    
-            #sum the functional markers for the patient - across all ROIs
-            dfTotal = dfPt.sum(axis=0)
-    
-            #get patient's her2 status
-            her2 = dfClin.loc[pt,'HER2'] #0 = HER2-, 1 = HER2+
-    
-            hla1List.append(dfTotal['hla1']/totTum*100)
-            ki67List.append(dfTotal['ki67']/totTum*100)
-            pdl1List.append(dfTotal['pdl1']/totTum*100)
-            caixList.append(dfTotal['caix']/totTum*100)
-    
-            totalList.append(totTum)
-            her2List.append(her2)
-            locatList.append(l)
-            ptList.append(pt)
-                
-    #put results into a df to plot
-    dfFun = pd.DataFrame([hla1List,ki67List,pdl1List,caixList,totalList,her2List,locatList,ptList]).T
-    dfFun.columns = ['HLA1','KI67','PDL1','CAIX','Total Tumor Cells','HER2','Location','Patient']
-    
-    #save dfFun to csv
-    dfFun.to_csv(path+'/results/dfCreated/dfTumorFun_NKspatial_all'+str(distThresh)+'.csv')
-    
-    
-    
 
-def makeNeighborhoods(path,csvList,seedList,distThresh):
+
+def cacheROI(path,file):
     '''
-    This function generates spatial neighborhoods for NK cells within a specified radius.
+    This function converts one mIHC csv into a typed columnar (Feather) cache file. Coordinates are stored as float32 when that
+    is lossless (otherwise kept as float64 so spatial results do not change), the class column as a categorical and the
+    0/1 Cellsp_* marker columns as booleans.
     Input parameters:
         path = cwd
-        csvList = list of mIHC files in the dataset
-        seedList = phenotypes to generate neighborhoods for
-        distThresh = distance to set radius for spatial neighborhoods, in px, 2 px = 1 µm
+        file = name of the mIHC file, excluding the .csv
     Outputs:
-        saves one csv to 'dfCreated' folder with neighbors of each seed cell
+        Saves the cache file and its info file to the data/mIHC_cache/ folder
     '''
-        
+
+    import os
+    import uuid
+    import json
+    import numpy as np
     import pandas as pd
-    from scipy import spatial
 
-    #empty list to hold dictionaries to create new rows of dfClust; outside of for file in csvList loop
-    allNeighList = []
+    sha = roiSourceHash(path, file)
+    df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0)
+
+    #convert columns to compact types
+    for col in ['Location_Center_X','Location_Center_Y']:
+        col32 = df[col].values.astype(np.float32)
+        if np.array_equal(col32.astype(np.float64), df[col].values, equal_nan=True):
+            df[col] = col32
+    df['class'] = df['class'].astype('category')
+    for col in df.columns[df.columns.str.startswith('Cellsp_')]:
+        if df[col].isin([0,1]).all():
+            df[col] = df[col].astype(bool)
+
+    #feather needs a default index, so store the original index as a column
+    dfOut = df.reset_index(drop=True)
+    dfOut.insert(0, '__index__', df.index.values)
+
+    cachePath = path+'/data/mIHC_cache/'+file+'.feather'
+    tmpPath = cachePath+'.'+uuid.uuid4().hex+'.tmp'
+    dfOut.to_feather(tmpPath)
+    os.replace(tmpPath, cachePath)
+
+    #record which version of the csv the cache file was made from
+    infoPath = path+'/data/mIHC_cache/'+file+'.json'
+    with open(infoPath) as f:
+        info = json.load(f)
+    info.update({'cachedSha256':sha, 'cacheVersion':getROICacheVersion(), 'indexName':df.index.name})
+    tmpPath = infoPath+'.'+uuid.uuid4().hex+'.tmp'
+    with open(tmpPath,'w') as f:
+        json.dump(info, f)
+    os.replace(tmpPath, infoPath)
+
+
+
+def refreshROICache(path,file):
+    '''
+    This function builds the columnar cache of one ROI, or rebuilds it if the csv's mtime or hash has changed since it was made.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file, excluding the .csv
+    Outputs:
+        returns: True if the cache file was (re)built, False if it was already up to date
+    '''
+
+    import os
+    import json
 
-    #loop through each ROI in csvList
-    for file in csvList:
+    sha = roiSourceHash(path, file)
+    with open(path+'/data/mIHC_cache/'+file+'.json') as f:
+        info = json.load(f)
 
-        #read df according to path
-        df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0)
+    if info.get('cachedSha256') == sha and info.get('cacheVersion') == getROICacheVersion() and os.path.exists(path+'/data/mIHC_cache/'+file+'.feather'):
+        return False
 
-        #create filtered dataframe without noise or 'other cells'
-        filt_df = df[(df['class'] != 'Other cells') & (df['class'] != 'Noise') ]
+    cacheROI(path, file)
+    return True
 
-        #get all possible class values; for later counting - from prior knowledge of possible cell types
-        classOptions = ['CD11B+ DCs',
-                 'CD11B- CD68+ cells',
-                 'CD11B- DCs',
-                 'CD4 T cells',
-                 'CD56+ NKP46+ NK',
-                 'CD56+ NKP46- NK',
-                 'CD56- NKP46+ NK',
-                 'CD8 T cells',
-                 'Myeloid other',
-                 'Myelomonocytic cells',
-                 'Other CD45+ cells',
-                 'Tumor cells']
-        
-        #generate count variable names for final created df's columns
-        classCountNames = []
-        for c in classOptions: #loop through all possible neighboring cells
-            classCountNames.append('count'+c)
 
-        ##get nearest neighbors of seed cells defined by seed param
-        #create np array of just x,y coordinates
-        ptsArray = filt_df[['Location_Center_X','Location_Center_Y']].values
 
-        #create kdtree
-        tree = spatial.KDTree(ptsArray)
+def getROICacheVersion():
+    '''
+    This function returns the version of the columnar cache format; bump it when cacheROI() changes so old cache files are rebuilt
+    Input parameters:
+        None
+    Outputs:
+        returns: cacheVersion = int
+    '''
+    cacheVersion = 1
+
+    return cacheVersion
+
 
-        #loop through each cell and check its neighbors if it's the right seed
-        for i in range(len(ptsArray)):
 
-            classType = filt_df['class'].values[i]
+def loadROI(path,file,columns=None):
+    '''
+    This function reads one mIHC file from disk through its typed columnar cache, building or rebuilding the cache when the csv is new or has changed.
+    Only the requested columns are read from disk. If pyarrow is not installed the csv is read directly.
+    Coordinates can come back as float32, which cacheROI() only stores when it is lossless (otherwise they stay float64); spatial code converts
+    them to float64 before computing any distance, so distances are exactly those computed from the csv.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file, excluding the .csv
+        columns = list of columns to read; None reads all columns
+    Outputs:
+        returns: df of the ROI, indexed by the csv's original index
+    '''
 
-            #only check neighbors if the seed cell is the desired classType
-            if classType in seedList:
-                neighs = tree.query_ball_point(ptsArray[i], distThresh) #get neighbors within distance
+    import json
+    import pandas as pd
 
-                if i in neighs:
-                    neighs.remove(i) #don't include itself as a neighbor
+    try:
+        import pyarrow #noqa: F401 - only needed for the feather cache
+    except ImportError:
+        df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0)
+        return df if columns is None else df[columns]
 
-                neighClassList = [] #empty list to store neighboring cells' classes
+    #make sure the cache was made from the current csv
+    refreshROICache(path, file)
+    with open(path+'/data/mIHC_cache/'+file+'.json') as f:
+        info = json.load(f)
 
-                #loop through each neighbor and get its class; add it to neighClassList
-                for j in neighs:
-                    #get its class
-                    neighClass = filt_df['class'].values[j]
-                    neighClassList.append(neighClass)
+    #read only the requested columns
+    df = pd.read_feather(path+'/data/mIHC_cache/'+file+'.feather', columns=None if columns is None else ['__index__']+list(columns))
+    df = df.set_index('__index__')
+    df.index.name = info['indexName']
 
-                #get counts of neighboring cell types
-                classCounts = []
-                for c in classOptions: #loop through all possible neighboring cells
-                    count = neighClassList.count(c) #count the specified cell type
-                    classCounts.append(count) #add the counts of the specified cell type to classCounts
+    return df
 
-                #reset dictionary to hold counts of neighbors; one per seed
-                seedDict = {}
 
-                #add counts to a dictionary (one per seed cell); also add original seed cell's idx value 
-                seedDict['file'] = file
-                seedDict['index'] = filt_df.iloc[i].name #original seed cell's idx value in the form of its original csv's name aka df.loc index
 
-                #for each possible neighboring cell class, add its count to seedDict both raw and as a %
-                for n in range(len(classCountNames)):
-                    seedDict[classCountNames[n]] = classCounts[n] #raw count
+def getCohortStore(path,csvList,nProcs=1):
+    '''
+    This function gets the compact cohort store of the ROIs in csvList, building or rebuilding it when it is missing, was made from other ROIs
+    or any ROI's csv has changed since, and memory-maps it.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        nProcs = number of processes to spread ROIs over when the store is (re)built; 1 runs serially, None uses all cores
+    Outputs:
+        returns: store, as returned by openCohortStore()
+    '''
 
-                    if sum(classCounts) != 0:
-                        seedDict[classCountNames[n]+'%'] = classCounts[n]/sum(classCounts) #percentage
-                    else: #avoid division by zero if there are no neighbors
-                        seedDict[classCountNames[n]+'%'] = 0 #set % to zero if there are no neighbors
+    import os
 
-                #add each seed's neighbor dictionary to the overall list; one dictionary per row of df
-                allNeighList.append(seedDict)
+    storePath = path+'/data/mIHC_cache/cohortStore.bin'
 
-    #create one new df to hold data for clustering; pass in allNeighList as the data; format is one row per seed cell across all csvs
-    #column names from a seedDict's keys (all seedDicts have the same keys)
-    dfClust = pd.DataFrame(data = allNeighList, columns = list(seedDict.keys()))
-    #NOTE: only using the columns (cells present) from the final csv that was analyzed. If a cell is not present at all in this csv then its column will not be present in the final csv created.
+    store = openCohortStore(path) if os.path.exists(storePath) else None
+    if store is not None:
+        header = store['header']
+        current = header['version'] == getROICacheVersion() and header['csvList'] == list(csvList)
+        if not (current and all(header['sha256'][i] == roiSourceHash(path, file) for i,file in enumerate(csvList))):
+            store = None
 
-    #convert any NaN values to zeros [note that NaN values arise when a csv lacks any of a cell type that does exist in other csvs]
-    dfClust = dfClust.fillna(0)
+    if store is None:
+        buildCohortStore(path, csvList, nProcs)
+        store = openCohortStore(path)
 
-    #store dfClust as a csv
-    dfClust.to_csv(path+'/results/dfCreated/dfNeighborhoodClusterNK'+str(distThresh)+'.csv')    
-    
-    
+    return store
 
-def elbowMethod(path,file,steps,save):
 
+
+def buildCohortStore(path,csvList,nProcs=1):
     '''
-    This function runs the Elbow Method to determine the optimal number of clusters for k-means clustering.
+    This function writes every ROI of csvList into one compact struct-of-arrays file: coordinates (float32 when that is lossless for every ROI,
+    otherwise float64 so spatial results do not change), one uint8 class code per cell, the 0/1 Cellsp_* markers bit-packed into one integer per cell,
+    the original csv index and the offset of each ROI's first cell.
+    The file is a JSON header followed by the arrays, each aligned to 64 bytes, so openCohortStore() can memory-map them.
     Input parameters:
         path = cwd
-        file = name of file to run clustering on 
-        steps = max number of clusters (k) to test
-        save = if True, creates and saves the plot
-        
-    Output:
-        optionally saves plot to 'figures' folder
+        csvList = list of mIHC files in the dataset
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+    Outputs:
+        Saves cohortStore.bin to the data/mIHC_cache/ folder
+    '''
+
+    import os
+    import uuid
+    import json
+    import numpy as np
+
+    roiList = mapROIs(cohortStoreROI, path, csvList, nProcs)
+
+    #class codes: the possible neighbor classes first, in getClassOptions() order, then any other class (eg. noise)
+    classList = getClassOptions()
+    classList = classList + sorted(set(c for roi in roiList for c in roi['classList']) - set(classList))
+    if len(classList) > 255:
+        raise ValueError('Too many cell classes for uint8 class codes')
+
+    #markers that are 0/1 in every ROI, in the order of the first ROI's columns
+    markerList = [col for col in roiList[0]['markerList'] if all(col in roi['markerDict'] for roi in roiList)] if len(roiList) > 0 else []
+    if len(markerList) > 64:
+        raise ValueError('Too many marker columns to bit-pack into one integer per cell')
+    markerType = np.dtype('<u'+str(next(n for n in [1,2,4,8] if len(markerList) <= 8*n))) #smallest integer with a bit per marker
+
+    #float32 coordinates only if no ROI loses precision
+    coordType = np.dtype('<f4') if all(roi['lossless32'] for roi in roiList) else np.dtype('<f8')
+
+    codeMaps = [np.array([classList.index(c) for c in roi['classList']], dtype=np.uint8) for roi in roiList]
+    arrayDict = {'x':np.concatenate([roi['x'] for roi in roiList]).astype(coordType) if len(roiList) > 0 else np.zeros(0, dtype=coordType),
+                 'y':np.concatenate([roi['y'] for roi in roiList]).astype(coordType) if len(roiList) > 0 else np.zeros(0, dtype=coordType),
+                 'classCode':np.concatenate([codeMap[roi['codes']] for codeMap,roi in zip(codeMaps,roiList)]) if len(roiList) > 0 else np.zeros(0, dtype=np.uint8),
+                 'index':np.concatenate([roi['index'] for roi in roiList]).astype('<i8') if len(roiList) > 0 else np.zeros(0, dtype='<i8'),
+                 'roiOffsets':np.concatenate([[0], np.cumsum([len(roi['x']) for roi in roiList])]).astype('<i8')}
+
+    #bit b of a cell's marker integer is set if the cell is positive for markerList[b]
+    markers = np.zeros(len(arrayDict['x']), dtype=markerType)
+    for b,col in enumerate(markerList):
+        bits = np.concatenate([roi['markerDict'][col] for roi in roiList]).astype(markerType)
+        markers |= bits << markerType.type(b)
+    arrayDict['markers'] = markers
+
+    #array positions relative to the start of the data, each aligned to 64 bytes
+    offset = 0
+    arrayInfo = {}
+    for name,arr in arrayDict.items():
+        arrayInfo[name] = {'dtype':arr.dtype.str, 'shape':list(arr.shape), 'offset':offset}
+        offset += -(-arr.nbytes//64)*64
+
+    header = {'version':getROICacheVersion(), 'csvList':list(csvList), 'sha256':[roi['sha256'] for roi in roiList],
+              'classList':classList, 'markerList':markerList, 'arrays':arrayInfo}
+    headerBytes = json.dumps(header).encode()
+    dataStart = -(-(16+len(headerBytes))//64)*64
+
+    #write to a uniquely named temporary file then rename, so readers never see a partial file
+    os.makedirs(path+'/data/mIHC_cache', exist_ok=True)
+    storePath = path+'/data/mIHC_cache/cohortStore.bin'
+    tmpPath = storePath+'.'+uuid.uuid4().hex+'.tmp'
+    with open(tmpPath,'wb') as f:
+        f.write(b'NKCOHORT'+np.uint64(len(headerBytes)).astype('<u8').tobytes()+headerBytes)
+        for name,arr in arrayDict.items():
+            f.seek(dataStart+arrayInfo[name]['offset'])
+            f.write(arr.tobytes())
+        f.truncate(dataStart+offset)
+    os.replace(tmpPath, storePath)
+
+
+
+def cohortStoreROI(path,file):
+    '''
+    This function gets the columns of one ROI for buildCohortStore(), possibly in a separate process.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file, excluding the .csv
+    Outputs:
+        returns: dict of the ROI's coordinates, class names and per-cell codes, 0/1 Cellsp_* markers, original index and csv hash
     '''
 
+    import numpy as np
     import pandas as pd
-    from matplotlib import pyplot as plt
-    from sklearn.cluster import MiniBatchKMeans #minibatchkmeans is better when n > 10,000 samples
 
+    #straight from the ROI cache, so building the store does not keep the ROI in the session
+    df = loadROI(path, file)
 
-    df = pd.read_csv(path+'/results/dfCreated/'+file+'.csv', index_col=0)
-    #drop all rows that have no cells in the neighborhood (aka when the sum of count columns is zero)
-    df['sum'] = df.iloc[:,2:].sum(axis=1)
+    x = df['Location_Center_X'].values.astype(np.float64)
+    y = df['Location_Center_Y'].values.astype(np.float64)
+    lossless32 = all(np.array_equal(v.astype(np.float32).astype(np.float64), v, equal_nan=True) for v in [x,y])
 
-    df = df[df['sum'] != 0]
+    classCat = pd.Categorical(df['class'].astype(str))
 
-    #generate column list to cluster on based on if there is a % in the column name
-    colList = list(df.columns[['%' in col for col in list(df.columns)]])
+    markerList = [col for col in df.columns if col.startswith('Cellsp_')]
+    markerDict = {col:df[col].values.astype(bool) for col in markerList if df[col].isin([0,1]).all()}
 
-    #get only features we want to cluster on
-    df = df[colList]
-    data = df.values
+    return {'x':x, 'y':y, 'lossless32':lossless32, 'classList':list(classCat.categories), 'codes':classCat.codes.astype(np.int64),
+            'markerList':markerList, 'markerDict':markerDict, 'index':df.index.values, 'sha256':roiSourceHash(path, file)}
 
-    #empty list to store error value
-    wcss = []
 
-    #calculate error for each k value (k=number of clusters)
-    for k in range(1, steps):
-        #generate kmeans model
-        kmeans = MiniBatchKMeans(n_clusters=k, init='k-means++', max_iter=300, n_init=10, random_state=0)
-        #fit model to data
-        kmeans.fit(data)
-        #add the sum of squares to wcss list; for plotting elbow
-        wcss.append(kmeans.inertia_)
 
-    #generate elbow plot and save (not results are not shown in manuscript)
-    if save == True:
-        plt.plot(range(1, steps), wcss)
-        plt.title('Elbow Method')
-        plt.xlabel('Number of clusters')
-        plt.ylabel('WCSS')
-        plt.savefig(path+'/results/figures/figure5_elbow_plot.png',format='png')
-        plt.close()
-    
-   
-def clusterNeighborhoods(path,file,k):
+def openCohortStore(path):
     '''
-    This function runs k-means clustering on a given neighborhood clustering csv.
-    The results are saved to a new csv.
+    This function memory-maps the cohort store written by buildCohortStore(); nothing is read until an array is used.
     Input parameters:
         path = cwd
-        file = name of file to run clustering on excluding the .csv
-        k = number of clusters; use elbow method to determine optimal number
     Outputs:
-        One csv is saved to the 'dfCreated/' folder with NK neighborhood cluster assignments
+        returns: store = dict with the 'header', one memory-mapped array per column ('x', 'y', 'classCode', 'markers', 'index', 'roiOffsets'),
+            'roiPos' = dict of ROI name:position in the header's csvList and the 'path' it was opened from
     '''
 
-    import pandas as pd
-    from sklearn.cluster import MiniBatchKMeans
-    
-    #read csv with neighborhood data    
-    df = pd.read_csv(path+'/results/dfCreated/'+file+'.csv', index_col=0)
+    import json
+    import numpy as np
 
-    #drop all rows that have no cells in the neighborhood (aka when the sum of count columns is zero)
-    df['sum'] = df.iloc[:,2:].sum(axis=1)
-    dfFilt =df[df['sum'] != 0]
+    mm = np.memmap(path+'/data/mIHC_cache/cohortStore.bin', dtype=np.uint8, mode='r')
+    if bytes(mm[:8]) != b'NKCOHORT':
+        raise ValueError('Not a cohort store file')
 
-    #get lists from original df to add back later after clustering
-    roiList = list(dfFilt['file']) #get list of ROIs in order to add to dfNoNa later
-    idxList = list(dfFilt['index']) #get list of cell indices in order to add to dfNoNa later
+    headerLen = int(mm[8:16].view('<u8')[0])
+    header = json.loads(bytes(mm[16:16+headerLen]).decode())
+    dataStart = -(-(16+headerLen)//64)*64
 
-    #generate column list to cluster on based on if there is a % in the column name; this excludes the ki67, pdl1 columns too
-    colList = list(dfFilt.columns[['%' in col for col in list(dfFilt.columns)]])
+    store = {'header':header, 'roiPos':{file:i for i,file in enumerate(header['csvList'])}, 'path':path}
+    for name,info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        start = dataStart+info['offset']
+        store[name] = mm[start:start+int(np.prod(info['shape']))*dtype.itemsize].view(dtype)
 
-    #get only features we want to cluster on
-    dfFilt = dfFilt[colList]
-    data = dfFilt.values
+    return store
 
-    #=k-means clustering of cells with k clusters
-    kmeans = MiniBatchKMeans(n_clusters=k, init='k-means++', max_iter=300, n_init=10, random_state=0)
-    predict = kmeans.fit_predict(data) #fit model to data and predict index (cluster labels); same results as first fitting and then predicting
 
-    #add predicted cluster labels to df as a new column and see how many cells are in each cluster
-    dfFilt['cluster'] = predict
-    dfFilt['cluster'].value_counts() #unecessary unless you want to see how many cells are in each cluster and then you should print it
 
-    #add original ROI to df to check which ROIs are in each cluster
-    dfFilt['file'] = roiList
+def cohortROI(store,file):
+    '''
+    This function slices the cells of one ROI out of the cohort store without copying.
+    Input parameters:
+        store = cohort store, as returned by openCohortStore()
+        file = name of the mIHC file, excluding the .csv
+    Outputs:
+        returns: dict of views of the ROI's 'x', 'y', 'classCode', 'markers' and 'index' arrays, in csv order;
+            class codes are positions in the header's classList (the first 12 are getClassOptions()) and marker bits positions in its markerList
+    '''
 
-    #need to add original indices to this df to check which ROIs are in each cluster; will also need to use ROI ID to pair with cell index (same index could be had by two cells from diff ROIs)
-    dfFilt['index'] = idxList #idxList stores the row value of filt_df.iloc[row,column] command
+    pos = store['roiPos'][file]
+    start, end = store['roiOffsets'][pos], store['roiOffsets'][pos+1]
 
-    #save df to a csv
-    dfFilt.to_csv(path+'/results/dfCreated/dfNeighClustered'+file[21:]+'k'+str(k)+'.csv')
+    return {name:store[name][start:end] for name in ['x','y','classCode','markers','index']}
 
 
 
-def createCsvsWithClusterCol(path,name):
+def cohortFrame(store,file,columns):
     '''
-    This function takes a csv of all seed cells with their cluster IDs and outputs separate csvs for two hard-coded ROIs: D16_BB2014A_ROI01 and M27_TT1120A_ROI02
-    The new ROIs contain a 'cluster' column which is populated with the corresponding cluster ID for each NK cell.
-    Non-NK cells have their original cell classification ID populated in this column.
-
+    This function gets columns of one ROI from the cohort store as a df with the same values as loadROI() gives: coordinates and class codes
+    are sliced out of the memory-mapped arrays and each marker is unpacked from its bit.
     Input parameters:
-        path = cwd
-        name = name of the clustered df
+        store = cohort store, as returned by openCohortStore()
+        file = name of the mIHC file, excluding the .csv
+        columns = list of columns to get; 'Location_Center_X', 'Location_Center_Y', 'class' or Cellsp_* markers of the header's markerList
     Outputs:
-        Saves one csv per ROI to the /dfCreated/updatedCsvs/ folder
+        returns: df of the ROI, indexed by the csv's original index
     '''
 
+    import numpy as np
     import pandas as pd
 
-    #get clustered df; contains all cells from ALL ROIs
-    dfClust = pd.read_csv(path+'/results/dfCreated/'+name+'.csv', index_col=0)
+    roi = cohortROI(store, file)
 
-    #turn off pandas warning for adding values to specified column with 'loc' command
-    #per: https://stackoverflow.com/questions/12555323/adding-new-column-to-existing-dataframe-in-python-pandas
-    pd.options.mode.chained_assignment = None 
+    colDict = {}
+    for col in columns:
+        if col in ['Location_Center_X','Location_Center_Y']:
+            #the store is float32 only if every ROI is; narrow this ROI's coordinates by the same rule as cacheROI()
+            colDict[col] = np.array(roi['x'] if col == 'Location_Center_X' else roi['y'])
+            col32 = colDict[col].astype(np.float32)
+            if np.array_equal(col32.astype(np.float64), colDict[col], equal_nan=True):
+                colDict[col] = col32
+        elif col == 'class':
+            #categories of the classes in this ROI, as cacheROI() gives
+            colDict[col] = pd.Categorical(np.array(store['header']['classList'], dtype=object)[roi['classCode']])
+        else:
+            bit = roi['markers'].dtype.type(store['header']['markerList'].index(col))
+            colDict[col] = ((roi['markers'] >> bit) & 1).astype(bool)
 
-    dfDict = {} #empty dict to store roi:filtered dataframes with new cluster column
+    return pd.DataFrame(colDict, index=np.array(roi['index']))
 
-    #first break df into different dataframes based on ROI
-    #only care about 2 ROIs for this analysis - D16_BB2014A_ROI01 & M27_TT1120A_ROI02
-    for roi in ['D16_BB2014A_ROI01','M27_TT1120A_ROI02']:
-        #subset to 1 ROI
-        dfROI = dfClust[(dfClust['file'] == roi)]
 
-        #get original df based on dfClust['file'] and then iloc the tumor cell using dfClust['index']
-        df = pd.read_csv(path+'/data/mIHC_files/'+roi+'.csv', index_col=0)
 
-        #get index and cluster number from dfROI and add these pairs as a tuple to an overall list
-        idxClustList = list(zip(dfROI['index'], dfROI['cluster']))
+#session-level data store shared by every stage of a run; empty unless startSession() has been called
+sessionStore = {}
 
-        #add cluster column to filt_df with correct cluster number using idxClustList
-        for tup in idxClustList: #for each tuple in idxClustList
-            #use loc index and convert to loc's label (name)
-            df.loc[tup[0],'cluster'] = tup[1] #tup[0] = original df's .loc index; tup[1]=cluster value of the seed cell
+#lock held while drawing with matplotlib's pyplot, which is not thread-safe, as pipeline stages can run concurrently
+pyplotLock = threading.Lock()
 
-        #add roi:filt_df to dfDict
-        dfDict[roi] = df
+#how plotly figures are exported, and the figures queued for rendering; see startFigureExport()
+exportSettings = {'active':False, 'mode':'png', 'nRenderers':None, 'queue':[]}
 
-    #loop through each df again and update the cluster column to map back to the cell class if it is not tumor (and thus is not part of a cluster)    
-    for roi,df in dfDict.items():
-        df['cluster']=df['cluster'].fillna(df['class']) #if cluster value is a np NaN value, then replace it with its value from the class column
+#how fixed-radius neighbor searches are done; see setNeighborBackend()
+neighborSettings = {'backend':'kdtree'}
 
-    #save newly updated dfs with their cluster column as new csvs
-    for roi,df in dfDict.items():
-        df.to_csv(path+'/results/dfCreated/updatedCsvs/'+roi+'_cluster_'+name[16:]+'.csv')
-    
-    
 
-def clusterCountPerROI(path,name):
+
+def startSession(path,csvList=None,nProcs=1,maxGraphs=4,cohortStore=False):
     '''
-    This function takes in a clustered csv and creates two csvs with the counts of each seed cell per ROI.
-    One csv includes counts across all ROIs. One csv includes counts averaged across ROIs.
-    The avg csv has both raw count and percentage counts for each cluster.
+    This function starts a session-level data store so that each ROI and the clinical data are read from disk once per run
+    and intermediate dfs are passed between stages in memory. Without a session every read goes to disk as before.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files to load up front; None loads ROIs the first time they are read
+        nProcs = number of processes used to load the ROIs; 1 runs serially, None uses all cores
+        maxGraphs = number of neighbor graphs kept in memory, the most recently used ones; older graphs are read again from the disk cache
+        cohortStore = if True, the ROIs of csvList are put in the memory-mapped cohort store (see getCohortStore()) instead of being loaded,
+            and readROI() slices their coordinates, class and markers from it
+    Outputs:
+        None; fills sessionStore
+    '''
+
+    sessionStore.clear()
+    sessionStore['rois'] = {} #(path,file):df of all columns
+    sessionStore['clinical'] = {} #path:clinical df
+    sessionStore['results'] = {} #(path,name):intermediate df as it would be read back from its csv
+    sessionStore['graphs'] = {} #(path,file,sha256):largest neighbor graph loaded for the ROI, least recently used first
+    sessionStore['maxGraphs'] = maxGraphs
+    sessionStore['graphLock'] = threading.Lock() #stages on several threads update the graphs
+
+    #map the cohort store, or load ROIs up front; workers of process pools do not share the session, but map the same cohort store
+    if cohortStore:
+        sessionStore['cohortStore'] = getCohortStore(path, csvList, nProcs)
+    elif csvList is not None:
+        dfList = mapROIs(loadROI, path, csvList, nProcs)
+        for file,df in zip(csvList,dfList):
+            sessionStore['rois'][(path,file)] = df
+    readClinical(path)
+
+
+
+def endSession():
+    '''
+    This function empties the session-level data store; later reads go to disk again
+    Input parameters:
+        None
+    Outputs:
+        None
+    '''
+
+    sessionStore.clear()
+
 
+
+def readROI(path,file,columns=None):
+    '''
+    This function gets one mIHC file. Within a session the ROI is read from disk once and kept in the session store;
+    every caller gets its own copy of just the columns it asks for, so the stored df is never modified.
+    If the session has a cohort store holding the ROI and every requested column, the columns are taken from the store instead.
     Input parameters:
         path = cwd
-        name = name of file containing clustered neighborhood data to count cluster abundance from, excluding the '.csv'
+        file = name of the mIHC file, excluding the .csv
+        columns = list of columns to read; None reads all columns
     Outputs:
-        Saves two csvs saved to 'dfCreated' folder
+        returns: df of the ROI, indexed by the csv's original index
     '''
 
-    import pandas as pd
+    #coordinates, class and markers from the memory-mapped cohort store
+    store = sessionStore.get('cohortStore')
+    if store is not None and columns is not None and store['path'] == path and file in store['roiPos']:
+        if all(col in ['class','Location_Center_X','Location_Center_Y']+store['header']['markerList'] for col in columns):
+            return cohortFrame(store, file, columns)
 
-    #read clustering csv to analyze (eg. dfNeighClusteredH70allk5; it's a csv that has each seed cell clustered)
-    df = pd.read_csv(path+'/results/dfCreated/'+name+'.csv', index_col=0)
+    #outside of a session read only the requested columns from disk
+    if 'rois' not in sessionStore:
+        return loadROI(path, file, columns)
 
-    dictCounts = {} #empty dict to store raw counts for each cluster per ROI
+    if (path,file) not in sessionStore['rois']:
+        sessionStore['rois'][(path,file)] = loadROI(path, file)
+    df = sessionStore['rois'][(path,file)]
 
-    #for each roi in the big df
-    for roi in df['file'].unique():
+    return df.copy() if columns is None else df[columns]
 
-        dfSingleROI = df[df['file'] == roi] #df contains cells from only one region
 
-        #raw frequency counts of cluster
-        freq = dfSingleROI['cluster'].value_counts()
 
-        #add to dict to store results
-        dictCounts[roi] = freq
+def readClinical(path):
+    '''
+    This function gets the clinical data (read from disk once per session)
+    Input parameters:
+        path = cwd
+    Outputs:
+        returns: dfClin = df of clinical data indexed by patient
+    '''
 
-    #put counts of clusters into a df
-    dfClustCounts = pd.DataFrame(dictCounts).T
-    dfClustCounts = dfClustCounts.fillna(0)
+    import pandas as pd
 
-    # #save dfClustCounts to csv
-    dfClustCounts.to_csv(path+'/results/dfCreated/dfClustCounts'+name[16:]+'_all.csv')
+    if 'clinical' not in sessionStore:
+        return pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
 
-    #create new dataframe with averaged numbers for every region within one patient
-    dfClustCounts.index = dfClustCounts.index.str.slice(0,-6)
+    if path not in sessionStore['clinical']:
+        sessionStore['clinical'][path] = pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
 
-    #calculate averages on a per patient basis - not on a percent average by regions
-    dfClustCountsSum = dfClustCounts.groupby(dfClustCounts.index).sum()
-    dfClustCountsSum['Total'] = dfClustCountsSum.sum(axis=1)
+    return sessionStore['clinical'][path].copy()
 
-    for col in dfClustCountsSum.columns[:-1]: #dont include total
-        dfClustCountsSum[str(col)+'_%'] = dfClustCountsSum[col]/dfClustCountsSum['Total'] #divide by the sum of only the first 5 columns
 
-    dfClustCountsAvg = dfClustCountsSum.drop(columns=['Total'])
-    
-    #save avg df to csv
-    dfClustCountsAvg.to_csv(path+'/results/dfCreated/dfClustCounts'+name[16:]+'_avg.csv')
 
+def saveResult(path,df,name):
+    '''
+    This function saves an intermediate df to the 'dfCreated' folder and, within a session, keeps it in memory for the next stage.
+    The in-memory copy is converted to what reading the csv back would give (column names as strings, inferred dtypes,
+    mixed object columns as strings) so stages behave the same whether it comes from memory or from disk.
+    Input parameters:
+        path = cwd
+        df = df to save
+        name = name of the csv relative to the 'dfCreated' folder, excluding the .csv
+    Outputs:
+        Saves one csv to the 'dfCreated' folder
+    '''
 
-    
-def fig3():
+    import pandas as pd
+
+    df.to_csv(path+'/results/dfCreated/'+name+'.csv')
+
+    if 'results' not in sessionStore:
+        return
+
+    dfMem = df.infer_objects()
+    dfMem.columns = [str(col) for col in dfMem.columns]
+    for col in dfMem.columns[(dfMem.dtypes == object).values]:
+        dfMem[col] = [v if isinstance(v,str) or pd.isna(v) else str(v) for v in dfMem[col]]
+    sessionStore['results'][(path,name)] = dfMem
+
+
+
+def loadResult(path,name):
     '''
-    Single cell analysis of NK cells results in distinct phenotypes related to the proximity to tumor cells and HER2 status.
-    This function creates figures 3A-D and supplementary figures S5A-C. 
+    This function gets an intermediate df saved by saveResult(); from memory within a session, otherwise from its csv
     Input parameters:
-        None  
+        path = cwd
+        name = name of the csv relative to the 'dfCreated' folder, excluding the .csv
     Outputs:
-        Saves plots to 'figures' folder for figures 3A-D and supplementary figures S5A-C
+        returns: df
     '''
 
-    import os
-    import plotly.express as px
     import pandas as pd
-    import numpy as np
-    from scipy.stats import mannwhitneyu
-    from statsmodels.stats.multitest import fdrcorrection
 
-    print('\n\n***FIGURE 3 - NK cell function versus spatial proximity to neoplastic cells and HER2 status***\n')
+    if 'results' in sessionStore and (path,name) in sessionStore['results']:
+        return sessionStore['results'][(path,name)].copy()
 
-    #get current working directory
-    path = os.getcwd()
-    
-    #get csvList
-    csvList = getCsvList()
-    
-    #FIGURE 3A
-    file = 'D16_BB2014A_ROI01'
-    colorDict = {'Tumor Cells':'rgb(153,153,153)','NK Cells':'rgb(231,41,138)'}
-    
-    #read specific ROI mIHC csv
-    df = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv',index_col=0)
-    
-    #subset to just tumor and NK
-    df = df[df['class'].isin(['Tumor cells','CD56- NKP46+ NK','CD56+ NKP46+ NK','CD56+ NKP46- NK'])]
-    df['Cell Type'] = np.where(df['class'] == 'Tumor cells','Tumor Cells','NK Cells')
-    
-    #plot and save
-    fig = px.scatter(df,x='Location_Center_X',y='Location_Center_Y',color='Cell Type',category_orders={'Cell Type':['Tumor Cells','NK Cells']},color_discrete_map=colorDict)
-    fig.write_image(path+'/results/figures/figure3A.png')
+    return pd.read_csv(path+'/results/dfCreated/'+name+'.csv', index_col=0)
 
 
-    #FIGURE 3B
-    distThresh = 40 #40 px = 20 µm
-    #generate csv storing NK cell function and spatial relationship to neoplastic cells
-    nkFunTumSpatial(path=path,csvList=csvList,distThresh=distThresh)
+
+def buildROICache(path,csvList,nProcs=1):
+    '''
+    This function converts all mIHC csvs into the typed columnar cache up front (readROI() otherwise does it on first read).
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+    Outputs:
+        Saves one cache file and info file per ROI to the data/mIHC_cache/ folder
+    '''
+
+    mapROIs(refreshROICache, path, csvList, nProcs)
+
+
+
+def codeVersion(func):
+    '''
+    This function fingerprints the code of a function together with every function of this file it calls, directly or indirectly,
+    so a stage is recomputed when any code it depends on changes, but not when unrelated code (eg. plotting) changes.
+    Input parameters:
+        func = function to fingerprint
+    Outputs:
+        returns: sha256 hex digest of the source of func and the functions it depends on
+    '''
+
+    import types
+    import inspect
+    import hashlib
+
+    sourceDict = {} #function name:source
+    toVisit = [func]
+    while len(toVisit) > 0:
+        f = toVisit.pop()
+        if f.__name__ in sourceDict:
+            continue
+        sourceDict[f.__name__] = inspect.getsource(f)
+
+        #names used by the function (and any nested functions); keep the ones that are functions of this file
+        codeList = [f.__code__]
+        while len(codeList) > 0:
+            code = codeList.pop()
+            for name in code.co_names:
+                g = f.__globals__.get(name)
+                if isinstance(g, types.FunctionType) and g.__module__ == func.__module__:
+                    toVisit.append(g)
+            codeList.extend([c for c in code.co_consts if isinstance(c, types.CodeType)])
+
+    sha = hashlib.sha256()
+    for name in sorted(sourceDict):
+        sha.update(sourceDict[name].encode())
+
+    return sha.hexdigest()
+
+
+
+def runMemoized(path,func,outputs,inputs=None,log=None,**kwargs):
+    '''
+    This function runs a pipeline stage only if its inputs, parameters or code have changed since the stored outputs were made.
+    The stage's fingerprint covers: the hash of every ROI csv in csvList (in csvList order), the hash of any other input files,
+    the stage's parameters and the code version of the stage function. Parameters that do not change results (nProcs, workers, graphRadius, tileSize) are left out.
+    Input parameters:
+        path = cwd
+        func = stage function, called as func(path=path,**kwargs)
+        outputs = list of files the stage writes, relative to path (eg. 'results/dfCreated/dfNKFun_TumorSpatial_all40.csv')
+        inputs = list of other files the stage reads, relative to path (eg. 'data/metadata/clinicalData.csv'); None if it reads none
+        log = list to add messages to instead of printing them, so a stage run on a background thread can have them printed by the main thread; None prints them
+        **kwargs = parameters passed to func
+    Outputs:
+        returns: True if the stage was run, False if its stored outputs were reused
+        Saves the stage's fingerprint to the /results/cache/memo/ folder
+    '''
+
+    import os
+    import uuid
+    import json
+    import hashlib
+
+    #parameters that only change how a stage runs, not what it outputs
+    ignoreParams = ['nProcs','workers','graphRadius','tileSize']
+
+    #fingerprint the stage
+    sha = hashlib.sha256()
+    sha.update(func.__name__.encode())
+    sha.update(codeVersion(func).encode())
+    sha.update(repr(sorted([(k,repr(v)) for k,v in kwargs.items() if k not in ignoreParams])).encode())
+    for file in kwargs.get('csvList',[]):
+        sha.update((file+roiSourceHash(path,file)).encode())
+    for name in (inputs if inputs is not None else []):
+        sha.update((name+fileHash(path+'/'+name)).encode())
+    fingerprint = sha.hexdigest()
+
+    #compare with the fingerprint of the stored outputs; outputs must also be unchanged since they were made
+    memoDir = path+'/results/cache/memo/'
+    memoPath = memoDir+func.__name__+'_'+hashlib.sha256(repr(outputs).encode()).hexdigest()[:16]+'.json'
+    if os.path.exists(memoPath):
+        with open(memoPath) as f:
+            memo = json.load(f)
+        if memo['fingerprint'] == fingerprint and all([os.path.exists(path+'/'+name) and fileHash(path+'/'+name) == memo['outputs'].get(name) for name in outputs]):
+            message = 'Reusing stored output of '+func.__name__+'() - inputs, parameters and code unchanged.'
+            if log is None:
+                print(message)
+            else:
+                log.append(message)
+            return False
+
+    func(path=path, **kwargs)
+
+    #store the fingerprint with the hashes of the outputs just made
+    os.makedirs(memoDir, exist_ok=True)
+    tmpPath = memoPath+'.'+uuid.uuid4().hex+'.tmp'
+    with open(tmpPath,'w') as f:
+        json.dump({'fingerprint':fingerprint, 'outputs':{name:fileHash(path+'/'+name) for name in outputs}}, f)
+    os.replace(tmpPath, memoPath)
+
+    return True
+
+
+
+def mapROIs(func,path,csvList,nProcs,*args):
+    '''
+    This function runs a per-ROI function on every mIHC file in csvList, optionally fanned out to a pool of processes.
+    Input parameters:
+        func = function called as func(path,file,*args) for each ROI; must be defined at module level so it can be sent to other processes
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        nProcs = number of processes; 1 runs serially in this process, None uses all cores
+        *args = any further arguments passed to func, the same for every ROI
+    Outputs:
+        returns: list with func's result for each ROI, in csvList order (so downstream results are the same regardless of nProcs)
+    '''
+
+    return list(iterROIs(func, path, csvList, nProcs, *args))
+
+
+
+def iterROIs(func,path,csvList,nProcs,*args):
+    '''
+    This function is the streaming form of mapROIs(): it yields func's result for each ROI as soon as it is ready, in csvList order,
+    so callers can write each ROI's result out instead of holding all of them.
+    Input parameters:
+        func = function called as func(path,file,*args) for each ROI; must be defined at module level so it can be sent to other processes
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        nProcs = number of processes; 1 runs serially in this process, None uses all cores
+        *args = any further arguments passed to func, the same for every ROI
+    Outputs:
+        yields: func's result for each ROI, in csvList order
+    '''
+
+    from itertools import repeat
+    from concurrent.futures import ProcessPoolExecutor
+
+    #arguments for each call: path, file, then the shared args
+    argLists = [repeat(path), csvList] + [repeat(a) for a in args]
+
+    #run serially if only one process is requested or there is only one ROI
+    if nProcs == 1 or len(csvList) <= 1:
+        yield from map(func, *argLists)
+        return
+
+    #executor.map returns results in the order of csvList, not the order the ROIs finish in; workers use this process's neighbor backend and cohort store
+    storePath = sessionStore['cohortStore']['path'] if 'cohortStore' in sessionStore else None
+    with ProcessPoolExecutor(max_workers=nProcs, mp_context=getPoolContext(), initializer=startWorker, initargs=(neighborSettings['backend'],storePath)) as executor:
+        yield from executor.map(func, *argLists)
+
+
+
+def getPoolContext():
+    '''
+    This function gets the multiprocessing context process pools are started with. Pipeline stages run on several threads,
+    and forking a process that has other threads running can deadlock the child (eg. on a lock held by another thread),
+    so workers are started fresh by a forkserver where available, otherwise spawned. Workers do not share the session: they read ROIs
+    from the cohort store when the session has one (see startWorker()), otherwise from the disk cache.
+    Input parameters:
+        None
+    Outputs:
+        returns: multiprocessing context
+    '''
+
+    import multiprocessing
+
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+
+def startWorker(backend='kdtree',storePath=None):
+    '''
+    This function sets up a freshly started pool worker like the process that started the pool, since workers do not share its globals.
+    Input parameters:
+        backend = neighbor backend, see setNeighborBackend()
+        storePath = path the session's cohort store was opened from; None if the session has none
+    Outputs:
+        None; with a storePath, the worker memory-maps the same cohort store so readROI() slices ROIs from it
+    '''
+
+    setNeighborBackend(backend)
+    if storePath is not None:
+        sessionStore['cohortStore'] = openCohortStore(storePath)
+
+
+
+def setNeighborBackend(backend='kdtree'):
+    '''
+    This function selects how every fixed-radius neighbor search of this file is done; both backends find exactly the same neighbors.
+    Input parameters:
+        backend = 'kdtree' uses scipy's cKDTree; 'grid' uses gridNeighbors(), a uniform grid of cells the size of the radius
+    Outputs:
+        None
+    '''
+
+    if backend not in ['kdtree','grid']:
+        raise ValueError("backend must be 'kdtree' or 'grid'")
+
+    neighborSettings['backend'] = backend
+
+
+
+def gridNeighbors(queryPts,dataPts,radius,chunkSize=4096):
+    '''
+    This function finds every pair of a query point and a data point within a radius using a uniform grid (cell list) of buckets the size of the radius:
+    points are sorted by bucket once, and the neighbors of a query point can only be in its own or the 8 surrounding buckets.
+    Pairs are kept by the same test as the kdtree (d^2 <= r^2), so the neighbor sets are identical.
+    Input parameters:
+        queryPts = np array of x,y coordinates of the query points
+        dataPts = np array of x,y coordinates of the data points
+        radius = radius to search for neighbors, in px, 2 px = 1 µm
+        chunkSize = number of query points handled at once, to bound the memory used for candidate pairs
+    Outputs:
+        returns: queryRows, dataCols, distSq = one entry per (query point, data point) pair within radius, in no particular order
+    '''
+
+    import numpy as np
+
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+    if len(queryPts) == 0 or len(dataPts) == 0:
+        return empty
+
+    #buckets a hair larger than the radius, so rounding in the binning can never put two points within radius more than one bucket apart
+    #(at radius 0 only points at the same spot are neighbors, and those always share a bucket)
+    bucket = radius*(1+1e-9) if radius > 0 else 1.0
+    origin = np.minimum(queryPts.min(axis=0), dataPts.min(axis=0))
+    dataBin = np.floor((dataPts - origin)/bucket).astype(np.int64)
+    queryBin = np.floor((queryPts - origin)/bucket).astype(np.int64)
+    nBinsY = max(dataBin[:,1].max(), queryBin[:,1].max()) + 3 #room for the bucket on either side
+
+    #data points sorted by bucket id (column of buckets, then row); each bucket is a contiguous run,
+    #and so are the 3 buckets above each other at x-1, x and x+1 of a query point's bucket
+    dataId = (dataBin[:,0]+1)*nBinsY + dataBin[:,1]+1
+    dataOrder = np.argsort(dataId, kind='stable')
+    dataId = dataId[dataOrder]
+    dataSorted = dataPts[dataOrder]
+
+    #query points are handled in bucket order too, so the candidates of consecutive query points are close in memory
+    queryId = (queryBin[:,0]+1)*nBinsY + queryBin[:,1]+1
+    queryOrder = np.argsort(queryId, kind='stable')
+
+    rowList, colList, distList = [], [], []
+    for chunkStart in range(0, len(queryPts), chunkSize):
+        queryPos = queryOrder[chunkStart:chunkStart+chunkSize]
+        queryXY = queryPts[queryPos]
+
+        for dx in [-1,0,1]:
+            #run of data points in the 3 buckets (y-1, y, y+1) of column x+dx of every query point
+            targetId = queryId[queryPos] + dx*nBinsY
+            starts = np.searchsorted(dataId, targetId-1, side='left')
+            lengths = np.searchsorted(dataId, targetId+1, side='right') - starts
+
+            #expand the runs into candidate pairs
+            rows = np.repeat(np.arange(len(queryPos)), lengths)
+            pairPos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+            diff = dataSorted[pairPos] - queryXY[rows]
+            distSq = diff[:,0]**2 + diff[:,1]**2
+            keep = distSq <= radius**2
+
+            rowList.append(queryPos[rows[keep]])
+            colList.append(dataOrder[pairPos[keep]])
+            distList.append(distSq[keep])
+
+    return np.concatenate(rowList), np.concatenate(colList), np.concatenate(distList)
+
+
+
+def buildNeighborGraph(ptsArray,radius,backend=None):
+    '''
+    This function builds the radius neighbor graph of all cells of an ROI, with the distance of every neighbor pair.
+    Input parameters:
+        ptsArray = np array of x,y coordinates of all cells of the ROI
+        radius = largest distance between neighbors, in px, 2 px = 1 µm
+        backend = 'kdtree' or 'grid'; None uses the backend set by setNeighborBackend()
+    Outputs:
+        returns: graph = dict of CSR arrays; the neighbors of cell i are indices[indptr[i]:indptr[i+1]] (sorted, not including cell i)
+            with squared distances distSq[indptr[i]:indptr[i+1]]; 'radius' is the radius the graph was built at
+    '''
+
+    import numpy as np
+    from scipy import spatial
+
+    nCells = len(ptsArray)
+    if (backend or neighborSettings['backend']) == 'grid':
+        #every pair of cells within radius in both directions, without the cell itself
+        rows, cols, _ = gridNeighbors(ptsArray, ptsArray, radius)
+        rows, cols = rows[rows != cols], cols[rows != cols]
+    else:
+        pairs = np.zeros((0,2), dtype=np.int64)
+        if nCells > 1:
+            #every pair of cells within radius once (i < j), then both directions
+            pairs = spatial.cKDTree(ptsArray).query_pairs(radius, output_type='ndarray').astype(np.int64)
+        rows = np.concatenate([pairs[:,0], pairs[:,1]])
+        cols = np.concatenate([pairs[:,1], pairs[:,0]])
+
+    #sort by cell, then neighbor
+    order = np.lexsort((cols, rows))
+    rows = rows[order]
+    cols = cols[order]
+
+    #squared distances, computed the same way the kdtree compares them to the radius
+    diff = ptsArray[cols] - ptsArray[rows]
+    distSq = diff[:,0]**2 + diff[:,1]**2
+
+    indptr = np.zeros(nCells+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=nCells))
+
+    return {'indptr':indptr, 'indices':cols, 'distSq':distSq, 'radius':radius}
+
+
+
+def filterGraph(graph,radius):
+    '''
+    This function derives the neighbor graph at a smaller radius from a neighbor graph by filtering its stored distances.
+    Input parameters:
+        graph = neighbor graph, as returned by buildNeighborGraph()
+        radius = radius to keep neighbors within; must not be larger than the graph's radius
+    Outputs:
+        returns: graph = neighbor graph at radius
+    '''
+
+    import numpy as np
+
+    nCells = len(graph['indptr'])-1
+    keep = graph['distSq'] <= radius**2 #same as a query at that radius (d^2 <= r^2)
+    rows = np.repeat(np.arange(nCells), np.diff(graph['indptr']))
+
+    indptr = np.zeros(nCells+1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows[keep], minlength=nCells))
+
+    return {'indptr':indptr, 'indices':graph['indices'][keep], 'distSq':graph['distSq'][keep], 'radius':radius}
+
+
+
+def graphRows(graph,rowPos):
+    '''
+    This function gets the neighbors of a set of cells from a neighbor graph as seed-neighbor pairs.
+    Input parameters:
+        graph = neighbor graph, as returned by buildNeighborGraph()
+        rowPos = np array of row positions of the seed cells in the ROI
+    Outputs:
+        returns: seedRows, neighCols, distSq = one entry per (seed, neighbor) pair, in the same format as radiusNeighbors()
+    '''
+
+    import numpy as np
+
+    starts = graph['indptr'][rowPos]
+    lengths = graph['indptr'][rowPos+1] - starts
+
+    #position of every pair in the graph's arrays: start of its seed's row plus its offset within the row
+    seedRows = np.repeat(np.arange(len(rowPos)), lengths)
+    pairPos = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+    return seedRows, graph['indices'][pairPos], graph['distSq'][pairPos]
+
+
+
+def getNeighborGraph(path,file,radius,buildRadius=None):
+    '''
+    This function gets the neighbor graph of all cells of an ROI from a persistent cache, keyed by the ROI csv's content hash and radius.
+    Any cached graph at a radius >= the one requested is reused by filtering its distances; otherwise a graph is built at buildRadius and cached.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file, excluding the .csv
+        radius = radius the graph is needed at, in px, 2 px = 1 µm
+        buildRadius = radius to build a new graph at, so later analyses at smaller radii can reuse it; None builds at radius
+    Outputs:
+        returns: graph = neighbor graph at radius, as returned by buildNeighborGraph(); rows are the cells of the ROI in csv order
+        Saves new graphs to the /results/cache/neighborGraphs/ folder
+    '''
+
+    import os
+    import uuid
+    import glob
+    import numpy as np
+
+    if buildRadius is None or buildRadius < radius:
+        buildRadius = radius
+
+    sha = roiSourceHash(path, file)
+    prefix = path+'/results/cache/neighborGraphs/'+file+'_'+sha[:16]+'_r'
+
+    graph = None
+
+    #within a session, reuse the graph already loaded for this ROI if it is large enough
+    if 'graphs' in sessionStore:
+        with sessionStore['graphLock']:
+            stored = sessionStore['graphs'].get((path,file,sha))
+        if stored is not None and stored['radius'] >= radius:
+            graph = stored
+
+    #otherwise load the smallest cached graph that is at least as large as radius
+    if graph is None:
+        cachedList = []
+        for f in glob.glob(glob.escape(prefix)+'*.npz'):
+            r = float(f[len(prefix):-4])
+            if r >= radius:
+                cachedList.append((r,f))
+        if len(cachedList) > 0:
+            with np.load(min(cachedList)[1]) as npz:
+                graph = {'indptr':npz['indptr'], 'indices':npz['indices'], 'distSq':npz['distSq'], 'radius':npz['radius'].item()}
+
+    #otherwise build it from the ROI's coordinates and cache it
+    if graph is None:
+        df = readROI(path, file, ['Location_Center_X','Location_Center_Y'])
+        graph = buildNeighborGraph(df.values.astype(np.float64), buildRadius)
+
+        os.makedirs(path+'/results/cache/neighborGraphs', exist_ok=True)
+        tmpPath = prefix+str(buildRadius)+'.npz.'+uuid.uuid4().hex+'.tmp'
+        with open(tmpPath,'wb') as f:
+            np.savez(f, **graph)
+        os.replace(tmpPath, prefix+str(buildRadius)+'.npz')
+
+    #keep the most recently used graphs only; the disk cache holds the rest
+    if 'graphs' in sessionStore:
+        with sessionStore['graphLock']:
+            graphDict = sessionStore['graphs']
+            graphDict.pop((path,file,sha), None)
+            graphDict[(path,file,sha)] = graph
+            while len(graphDict) > sessionStore['maxGraphs']:
+                del graphDict[next(iter(graphDict))]
+
+    if graph['radius'] > radius:
+        graph = filterGraph(graph, radius)
+
+    return graph
+
+
+
+def spillTiles(path,file,columns,classList,seedList,tileSize,halo,spillDir,chunkSize=1000000):
+    '''
+    This function streams one mIHC csv in chunks and spills its cells into square spatial tiles, so a slide too large to load can be processed one tile at a time.
+    Each cell is owned by the tile it lies in, and is also copied into every other tile it is within halo of, so each tile holds every neighbor of the cells it owns.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file, excluding the .csv
+        columns = list of columns to keep besides class and coordinates (eg. functional markers)
+        classList = phenotypes to keep; cells of other classes are dropped
+        seedList = phenotypes of the seed cells; tiles that own no seed cell are not returned
+        tileSize = side of a tile, in px, 2 px = 1 µm
+        halo = distance to copy cells into neighboring tiles, in px; the largest radius of the analysis
+        spillDir = folder to write the tile files to
+        chunkSize = number of csv rows held in memory at a time
+    Outputs:
+        returns: tileDict = dict of tile (x,y):list of its spill files, for tiles owning at least one seed cell
+        Saves the spill files to spillDir; each has the kept columns, '__row__' (row position in the csv) and '__owned__' (True in the cell's own tile)
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    colNames = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', nrows=0).columns
+    usecols = [colNames[0],'class','Location_Center_X','Location_Center_Y']+list(columns)
+
+    #pad the halo slightly so pairs at exactly the radius always share a tile despite rounding; extra halo cells never change results
+    halo = halo*(1+1e-9)+1e-9
+    span = int(np.ceil(2*halo/tileSize))+1 #max number of tiles a cell can fall in along each axis
+
+    tileDict = {}
+    seedTiles = set()
+    rowStart = 0
+    reader = pd.read_csv(path+'/data/mIHC_files/'+file+'.csv', index_col=0, usecols=usecols, chunksize=chunkSize)
+    for chunkNo,chunk in enumerate(reader):
+        chunk['__row__'] = np.arange(rowStart, rowStart+len(chunk))
+        rowStart += len(chunk)
+        chunk = chunk[chunk['class'].isin(classList)]
+
+        x = chunk['Location_Center_X'].values.astype(np.float64)
+        y = chunk['Location_Center_Y'].values.astype(np.float64)
+        ownX = np.floor(x/tileSize).astype(np.int64)
+        ownY = np.floor(y/tileSize).astype(np.int64)
+        loX = np.floor((x-halo)/tileSize).astype(np.int64)
+        loY = np.floor((y-halo)/tileSize).astype(np.int64)
+        hiX = np.floor((x+halo)/tileSize).astype(np.int64)
+        hiY = np.floor((y+halo)/tileSize).astype(np.int64)
+        isSeed = chunk['class'].isin(seedList).values
+
+        #every (cell, tile) pair a cell's halo reaches
+        posList = []
+        txList = []
+        tyList = []
+        for dx in range(span):
+            for dy in range(span):
+                keep = np.nonzero((loX+dx <= hiX) & (loY+dy <= hiY))[0]
+                posList.append(keep)
+                txList.append(loX[keep]+dx)
+                tyList.append(loY[keep]+dy)
+        pos = np.concatenate(posList)
+        tx = np.concatenate(txList)
+        ty = np.concatenate(tyList)
+        owned = (tx == ownX[pos]) & (ty == ownY[pos])
+        seedTiles.update(zip(tx[owned & isSeed[pos]], ty[owned & isSeed[pos]]))
+
+        #write one spill file per tile for this chunk
+        dfPart = chunk.iloc[pos].copy()
+        dfPart['__owned__'] = owned
+        for (kx,ky),dfTile in dfPart.groupby([tx,ty], sort=False):
+            partPath = spillDir+'/'+str(kx)+'_'+str(ky)+'_'+str(chunkNo)+'.pkl'
+            dfTile.to_pickle(partPath)
+            tileDict.setdefault((kx,ky),[]).append(partPath)
+
+    return {key:tileDict[key] for key in sorted(tileDict) if key in seedTiles}
+
+
+
+def readTile(partList):
+    '''
+    This function reads one spatial tile written by spillTiles()
+    Input parameters:
+        partList = list of the tile's spill files
+    Outputs:
+        returns: df of the cells in the tile (owned and halo), indexed by the csv's original index
+    '''
+
+    import pandas as pd
+
+    return pd.concat([pd.read_pickle(part) for part in partList])
+
+
+
+def withinDistance(seedPts,neighPts,distThresh,workers=1,backend=None):
+    '''
+    This function checks, for every seed cell at once, whether any neighbor cell lies within a set distance.
+    Input parameters:
+        seedPts = np array of x,y coordinates of the seed cells
+        neighPts = np array of x,y coordinates of the candidate neighbor cells
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        workers = number of threads used for the query; -1 uses all cores
+        backend = 'kdtree' or 'grid'; None uses the backend set by setNeighborBackend()
+    Outputs:
+        returns: close = boolean np array, True for seeds with at least one neighbor cell within distThresh
+    '''
+
+    import numpy as np
+    from scipy import spatial
+
+    close = np.zeros(len(seedPts), dtype=bool)
+    if len(seedPts) == 0 or len(neighPts) == 0:
+        return close
+
+    if (backend or neighborSettings['backend']) == 'grid':
+        seedRows, _, _ = gridNeighbors(seedPts, neighPts, distThresh)
+        close[seedRows] = True
+        return close
+
+    #kdtree of the neighbor cells only; nearest neighbor per seed, bounded just past distThresh so boundary cells are still returned
+    tree = spatial.cKDTree(neighPts)
+    dist, nearest = tree.query(seedPts, k=1, distance_upper_bound=np.nextafter(distThresh, np.inf), workers=workers)
+    found = np.isfinite(dist)
+
+    #compare squared distances the same way query_ball_point does (d^2 <= r^2) so boundary cells are classified identically
+    diff = seedPts[found] - neighPts[nearest[found]]
+    close[found] = diff[:,0]**2 + diff[:,1]**2 <= distThresh**2
+
+    return close
+
+
+
+def funProximityROI(path,file,seedList,neighList,funCols,funNames,distThresh,workers=1,graphRadius=None,tileSize=None):
+    '''
+    This function gets the functional status of the seed cells of one ROI and whether each seed is proximal to a neighbor cell type.
+    Called once per ROI by nkFunTumSpatial() and tumorFunNKspatial(), possibly in a separate process.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        funCols = functional marker columns of the seed cells in the mIHC file
+        funNames = names the functional markers are stored under in the results
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        workers = number of threads used for the proximity query; -1 uses all cores
+        graphRadius = if set, neighbors come from the ROI's cached neighbor graph (built at this radius if not cached yet) instead of a kdtree query
+        tileSize = if set, the csv is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; graphRadius is then not used
+    Outputs:
+        returns: dfClose, dfFar = one row per seed cell (file, seedIdx, functional markers) with / without a neighbor cell within distThresh
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    if tileSize is not None:
+        seedIdx, seedFun, close = funProximityTiles(path, file, seedList, neighList, funCols, distThresh, workers, tileSize)
+        return proximityTables(file, seedIdx, seedFun, close, funCols, funNames)
+
+    #read only the columns needed
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y']+funCols)
+
+    #split into seeds and neighbors; seeds stay in csv order
+    seedMask = df['class'].isin(seedList).values
+    neighMask = df['class'].isin(neighList).values
+
+    if graphRadius is None:
+        #classify every seed as close (True) or far (False) from the neighbor cells in one query
+        ptsArray = df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+        close = withinDistance(ptsArray[seedMask], ptsArray[neighMask], distThresh, workers)
+    else:
+        #classify every seed from the cached neighbor graph of the ROI; no spatial query
+        graph = getNeighborGraph(path, file, distThresh, graphRadius)
+        pairRows = np.repeat(np.arange(len(df)), np.diff(graph['indptr']))
+        hit = neighMask[graph['indices']] & (graph['distSq'] <= distThresh**2)
+        close = (np.bincount(pairRows[hit], minlength=len(df)) > 0)[seedMask]
+
+    #gather seed cell indices (original df.loc index) and function by boolean mask
+    seedIdx = df.index.values[seedMask]
+    seedFun = df.loc[seedMask, funCols]
+
+    return proximityTables(file, seedIdx, seedFun, close, funCols, funNames)
+
+
+
+def funProximityTiles(path,file,seedList,neighList,funCols,distThresh,workers,tileSize):
+    '''
+    This function classifies the seed cells of one ROI as close to / far from a neighbor cell type one spatial tile at a time, with bounded memory.
+    Each seed is classified only in the tile that owns it; the tile's halo holds all of its possible neighbors, so results match funProximityROI().
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        funCols = functional marker columns of the seed cells in the mIHC file
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        workers = number of threads used for the proximity query; -1 uses all cores
+        tileSize = side of a tile, in px
+    Outputs:
+        returns: seedIdx, seedFun, close = seed cell indices, df of their functional markers and True for seeds with a neighbor within distThresh; in csv order
+    '''
+
+    import os
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    rowList = []
+    idxList = []
+    funList = []
+    closeList = []
+
+    os.makedirs(path+'/results/cache/tiles', exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=path+'/results/cache/tiles') as spillDir:
+        tileDict = spillTiles(path, file, funCols, seedList+neighList, seedList, tileSize, distThresh, spillDir)
+
+        for key in tileDict:
+            dfTile = readTile(tileDict[key])
+
+            #seeds owned by this tile, neighbors anywhere in the tile or its halo
+            seedMask = dfTile['class'].isin(seedList).values & dfTile['__owned__'].values
+            neighMask = dfTile['class'].isin(neighList).values
+            ptsArray = dfTile[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+
+            closeList.append(withinDistance(ptsArray[seedMask], ptsArray[neighMask], distThresh, workers))
+            rowList.append(dfTile['__row__'].values[seedMask])
+            idxList.append(dfTile.index.values[seedMask])
+            funList.append(dfTile.loc[seedMask, funCols])
+
+    if len(rowList) == 0:
+        return np.zeros(0, dtype=np.int64), pd.DataFrame(columns=funCols), np.zeros(0, dtype=bool)
+
+    #put seeds back in csv order
+    order = np.argsort(np.concatenate(rowList), kind='stable')
+    seedFun = pd.concat(funList).iloc[order]
+
+    return np.concatenate(idxList)[order], seedFun, np.concatenate(closeList)[order]
+
+
+
+def proximityTables(file,seedIdx,seedFun,close,funCols,funNames):
+    '''
+    This function formats the seed cells of one ROI into the close and far dfs returned by funProximityROI()
+    Input parameters:
+        file = name of the mIHC file the seeds come from
+        seedIdx = original df.loc index of each seed cell
+        seedFun = df of the functional marker columns of the seed cells
+        close = boolean np array, True for seeds with a neighbor cell within the distance
+        funCols = functional marker columns of the seed cells in the mIHC file
+        funNames = names the functional markers are stored under in the results
+    Outputs:
+        returns: dfClose, dfFar = one row per seed cell (file, seedIdx, functional markers) with / without a neighbor cell within the distance
+    '''
+
+    import pandas as pd
+
+    #store results in df - for seeds with and withOUT a neighbor
+    dfDict = {}
+    for l,mask in [('close',close),('far',~close)]:
+        dfLoc = pd.DataFrame({'file':[file]*int(mask.sum()), 'seedIdx':seedIdx[mask]})
+        for col,name in zip(funCols,funNames):
+            dfLoc[name] = seedFun[col].values[mask]
+        dfDict[l] = dfLoc
+
+    return dfDict['close'], dfDict['far']
+
+
+
+def markerSummary(path,dfClose,dfFar,funNames,totalName):
+    '''
+    This function summarizes the functional markers of close and far seed cells per patient in one grouped pass:
+    the count of seed cells and the percent positive for each marker, with the patient's HER2 status.
+    Input parameters:
+        path = cwd
+        dfClose, dfFar = one row per seed cell (file, seedIdx, functional markers) with / without a neighbor cell within the distance, as from proximityTables()
+        funNames = names of the functional marker columns to summarize
+        totalName = name of the column with the count of seed cells
+    Outputs:
+        returns: dfFun = one row per location (close then far) and patient (in order of first appearance), with the percent positive for each marker
+            (named in capitals), the count of seed cells, HER2 status, location and patient
+    '''
+
+    import pandas as pd
+
+    #stack close and far seeds, labelled by location and patient (ROI name without '_ROI01')
+    df = pd.concat([dfClose.assign(Location='close'),dfFar.assign(Location='far')], ignore_index=True)
+    df['Patient'] = df['file'].str.slice(0,-6)
+
+    #sum the functional markers and count the seed cells for each location and patient - across all ROIs
+    grouped = df.groupby(['Location','Patient'],sort=False)
+    total = grouped.size()
+    dfFun = grouped[funNames].sum().div(total,axis=0)*100
+    dfFun.columns = [name.upper() for name in funNames]
+    dfFun[totalName] = total
+    dfFun = dfFun.reset_index()
+
+    #add each patient's her2 status; 0 = HER2-, 1 = HER2+
+    dfFun = dfFun.merge(readClinical(path)[['HER2']], how='left', left_on='Patient', right_index=True)
+
+    return dfFun[list(dfFun.columns[2:])+['Location','Patient']]
+
+
+
+def nkFunTumSpatial(path,csvList,distThresh,nProcs=1,graphRadius=None,tileSize=None):
+    '''
+    This function identifies the functional status of NK cells that are proximal and distal to neoplastic epithelial cells
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet), so reruns skip spatial queries; None queries a kdtree
+        tileSize = if set, each ROI is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; results are the same
+    Outputs:
+        Saves one csv with proportion of NK cells expressing functional markers that are proximal vs distal to neoplastic cells per patient. Csv saved to the /results/dfCreated/ folder.
+    '''
+    
+    import pandas as pd
+
+    neighList = ['Tumor cells']
+    seedList = ['CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
+
+    #functional marker columns of the seed cells and the names they are stored under in the results
+    funCols = ['Cellsp_CD16p','Cellsp_CD57p','Cellsp_Ki67p','Cellsp_NKG2Dp','Cellsp_PD1p','Cellsp_TIM3p','Cellsp_GRZBp']
+    funNames = ['cd16','cd57','ki67','nkg2d','pd1','tim3','grzb']
+
+    #classify the NK seeds of each ROI as close/far from tumor cells; results come back in csvList order
+    roiResults = mapROIs(funProximityROI, path, csvList, nProcs, seedList, neighList, funCols, funNames, distThresh, 1, graphRadius, tileSize)
+
+    #store results in df - for seeds with a Tumor neighbor
+    dfFunClose = pd.concat([res[0] for res in roiResults], ignore_index=True)
+    
+    #store results in df - for seeds withOUT a Tumor neighbor
+    dfFunFar = pd.concat([res[1] for res in roiResults], ignore_index=True)
+ 
+    #percent of NK cells positive for each marker per patient, close then far
+    dfFun = markerSummary(path,dfFunClose,dfFunFar,funNames,'Total NK Cells')
+
+    #save dfFun to csv - this gets used to create figures
+    saveResult(path,dfFun,'dfNKFun_TumorSpatial_all'+str(distThresh))    
+    
+    
+    
+def tumorFunNKspatial(path,csvList,distThresh,workers=-1,nProcs=1,graphRadius=None,tileSize=None):
+    '''
+    This function identifies the functional status of neoplastic cells that are proximal and distal to NK cells
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        workers = number of threads used for the proximity query; -1 uses all cores
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet), so reruns skip spatial queries; None queries a kdtree
+        tileSize = if set, each ROI is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; results are the same
+    Outputs:
+        Saves one csv with proportion of neoplastic cells expressing functional markers that are proximal vs distal to NK cells per patient. Csv saved to the /results/dfCreated/ folder.
+    '''
+
+    import pandas as pd
+
+    seedList = ['Tumor cells']
+    nkList = ['CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
+
+    #functional marker columns of the seed cells and the names they are stored under in the results
+    funCols = ['Cellsp_HLAIIp','Cellsp_Ki67p','Cellsp_PDL1p','Cellsp_CAIXp'] #in csv it's listed as HLAII even though it's HLAI
+    funNames = ['hla1','ki67','pdl1','caix']
+
+    #when ROIs are spread over processes, each query gets one thread so cores are not oversubscribed
+    if nProcs != 1:
+        workers = 1
+
+    #classify the tumor seeds of each ROI as close/far from NK cells; results come back in csvList order
+    roiResults = mapROIs(funProximityROI, path, csvList, nProcs, seedList, nkList, funCols, funNames, distThresh, workers, graphRadius, tileSize)
+
+    #store results in df - for seeds with a NK neighbor
+    dfFunClose = pd.concat([res[0] for res in roiResults], ignore_index=True)
+
+    #store results in df - for seeds withOUT a NK neighbor
+    dfFunFar = pd.concat([res[1] for res in roiResults], ignore_index=True)
+
+    #percent of tumor cells positive for each marker per patient, close then far
+    dfFun = markerSummary(path,dfFunClose,dfFunFar,funNames,'Total Tumor Cells')
+
+    #save dfFun to csv
+    saveResult(path,dfFun,'dfTumorFun_NKspatial_all'+str(distThresh))
+    
+    
+    
+
+def proximityNull(path,csvList,seedList,neighList,distThresh,name,nPerms=1000,seed=0,nProcs=1,graphRadius=None,batchSize=100):
+    '''
+    This function tests, per ROI, whether seed cells (eg. NK cells) are proximal to neighbor cells (eg. tumor cells) more or less often than
+    random placement of the cell labels would give: the class labels of each ROI are shuffled over its cells nPerms times and the proximity counts recomputed.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        name = name of the analysis used in the saved csv's name (eg. 'NKTumor')
+        nPerms = number of label permutations per ROI
+        seed = seed of the random number generator; each ROI gets its own stream derived from seed and the ROI name, so results do not depend on csvList order or nProcs
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet); None builds the graph at distThresh
+        batchSize = number of permutations computed together in one sparse product
+    Outputs:
+        Saves one csv with one row per ROI: observed count, permutation mean and SD, z-score and one-sided p-values of
+        the number of seed cells with a neighbor cell within distThresh ('close') and of the number of seed-neighbor pairs ('pairs').
+        Csv saved to the /results/dfCreated/ folder.
+    '''
+
+    import pandas as pd
+
+    rowList = mapROIs(proximityNullROI, path, csvList, nProcs, seedList, neighList, distThresh, nPerms, seed, graphRadius, batchSize)
+
+    dfNull = pd.DataFrame(rowList)
+
+    saveResult(path,dfNull,'dfProximityNull_'+name+str(distThresh))
+
+
+
+def proximityNullROI(path,file,seedList,neighList,distThresh,nPerms,seed,graphRadius=None,batchSize=100):
+    '''
+    This function runs the label permutation test of proximityNull() for one ROI, possibly in a separate process.
+    Permutations are done in batches: the neighbor labels of a batch form a cells x permutations matrix, which the ROI's sparse
+    neighbor graph multiplies in one product to count every cell's neighbors under every permutation.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        distThresh = distance to stratify proximal vs distal (in px); note 1 µm = 2 px
+        nPerms = number of label permutations
+        seed = seed of the random number generator, combined with the ROI name
+        graphRadius = if set, neighbors come from the ROI's cached neighbor graph (built at this radius if not cached yet); None builds the graph at distThresh
+        batchSize = number of permutations computed together in one sparse product
+    Outputs:
+        returns: dict of the ROI's results (see proximityNull())
+    '''
+
+    import hashlib
+    import numpy as np
+    from scipy import sparse
+
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y'])
+    nCells = len(df)
+
+    if graphRadius is None:
+        graph = buildNeighborGraph(df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64), distThresh)
+    else:
+        graph = getNeighborGraph(path, file, distThresh, graphRadius)
+
+    #adjacency matrix of cells within distThresh of each other; integer so every count is exact
+    adj = sparse.csr_matrix((np.ones(len(graph['indices']),dtype=np.int32),graph['indices'],graph['indptr']), shape=(nCells,nCells))
+
+    #label of each cell as bits: 1 = seed, 2 = neighbor; shuffling the labels keeps the number of each
+    labels = (df['class'].isin(seedList).values*1 + df['class'].isin(neighList).values*2).astype(np.int8)
+
+    def proximityCounts(labelMat):
+        #labelMat = cells x permutations; returns close seed count and seed-neighbor pair count per permutation
+        neighCount = adj @ (labelMat & 2 > 0).astype(np.int32)
+        isSeed = labelMat & 1 > 0
+        return ((neighCount > 0) & isSeed).sum(axis=0), (neighCount * isSeed).sum(axis=0, dtype=np.int64)
+
+    obsClose, obsPairs = [v[0] for v in proximityCounts(labels[:,None])]
+
+    #one random stream per ROI, keyed by the ROI name so it is the same whichever order or process the ROI runs in
+    rng = np.random.default_rng([seed, int(hashlib.sha256(file.encode()).hexdigest()[:8], 16)])
+
+    nullClose = np.zeros(nPerms, dtype=np.int64)
+    nullPairs = np.zeros(nPerms, dtype=np.int64)
+    for start in range(0, nPerms, batchSize):
+        nBatch = min(batchSize, nPerms-start)
+        labelMat = rng.permuted(np.tile(labels, (nBatch,1)), axis=1).T
+        nullClose[start:start+nBatch], nullPairs[start:start+nBatch] = proximityCounts(labelMat)
+
+    rowDict = {'file':file, 'nCells':nCells, 'nSeeds':int((labels & 1 > 0).sum()), 'nNeighbors':int((labels & 2 > 0).sum()), 'nPerms':nPerms}
+    for stat,obs,null in [('close',obsClose,nullClose),('pairs',obsPairs,nullPairs)]:
+        sd = null.std(ddof=1) if nPerms > 1 else np.nan
+        rowDict[stat+'Obs'] = int(obs)
+        rowDict[stat+'NullMean'] = null.mean()
+        rowDict[stat+'NullSD'] = sd
+        rowDict[stat+'Z'] = (obs-null.mean())/sd if sd > 0 else np.nan
+        #one-sided permutation p-values, counting the observed labelling as one of the permutations
+        rowDict[stat+'PHigh'] = (1+(null >= obs).sum())/(1+nPerms)
+        rowDict[stat+'PLow'] = (1+(null <= obs).sum())/(1+nPerms)
+
+    return rowDict
+
+
+
+def nearestDistance(path,csvList,seedList,neighList,funCols,funNames,name,nProcs=1,workers=-1):
+    '''
+    This function records, for every seed cell, the exact distance to its nearest neighbor cell (eg. each NK cell's distance to the nearest tumor cell)
+    along with its functional markers, so close/far at any distance threshold can be derived afterwards by thresholdCurves() without another spatial query.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        funCols = functional marker columns of the seed cells in the mIHC file
+        funNames = names the functional markers are stored under in the results
+        name = name of the analysis used in the saved csv's name (eg. 'NKTumor')
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        workers = number of threads used for the nearest neighbor query; -1 uses all cores
+    Outputs:
+        Saves one csv to 'dfCreated' folder with one row per seed cell: file, seedIdx, squared distance ('distSq') and distance ('distance') to the nearest
+        neighbor cell (inf if the ROI has none) and its functional markers
+    '''
+
+    import pandas as pd
+
+    #when ROIs are spread over processes, each query gets one thread so cores are not oversubscribed
+    if nProcs != 1:
+        workers = 1
+
+    dfNearest = pd.concat(mapROIs(nearestDistanceROI, path, csvList, nProcs, seedList, neighList, funCols, funNames, workers), ignore_index=True)
+
+    saveResult(path,dfNearest,'dfNearest_'+name)
+
+
+
+def nearestDistanceROI(path,file,seedList,neighList,funCols,funNames,workers=1):
+    '''
+    This function finds the distance from every seed cell of one ROI to its nearest neighbor cell in one query, possibly in a separate process.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes of the seed cells
+        neighList = phenotypes of the neighbor cells
+        funCols = functional marker columns of the seed cells in the mIHC file
+        funNames = names the functional markers are stored under in the results
+        workers = number of threads used for the query; -1 uses all cores
+    Outputs:
+        returns: df with one row per seed cell (see nearestDistance()), in csv order
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from scipy import spatial
+
+    #read only the columns needed
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y']+funCols)
+
+    seedMask = df['class'].isin(seedList).values
+    neighMask = df['class'].isin(neighList).values
+    ptsArray = df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+    seedPts = ptsArray[seedMask]
+    neighPts = ptsArray[neighMask]
+
+    distSq = np.full(len(seedPts), np.inf)
+    if len(seedPts) > 0 and len(neighPts) > 0:
+        _, nearest = spatial.cKDTree(neighPts).query(seedPts, k=1, workers=workers)
+
+        #squared distance computed the same way withinDistance() compares it to a threshold (d^2 <= r^2)
+        diff = seedPts - neighPts[nearest]
+        distSq = diff[:,0]**2 + diff[:,1]**2
+
+    dfNearest = pd.DataFrame({'file':[file]*len(seedPts), 'seedIdx':df.index.values[seedMask], 'distSq':distSq, 'distance':np.sqrt(distSq)})
+    for col,funName in zip(funCols,funNames):
+        dfNearest[funName] = df.loc[seedMask, col].values
+
+    return dfNearest
+
+
+
+def thresholdCurves(path,name,threshList,funNames,totalName='Total Cells'):
+    '''
+    This function derives percent positive vs distance threshold curves from the nearest distances saved by nearestDistance():
+    for each threshold, seed cells within it of a neighbor cell are close and the others far, summarized per patient as in nkFunTumSpatial().
+    Input parameters:
+        path = cwd
+        name = name of the analysis the nearest distances were saved under (eg. 'NKTumor')
+        threshList = list of distance thresholds (in px); note 1 µm = 2 px
+        funNames = names of the functional marker columns to summarize
+        totalName = name of the column with the count of seed cells
+    Outputs:
+        Saves one csv to 'dfCreated' folder with, per threshold, one row per location (close then far) and patient:
+        percent positive for each marker, count of seed cells, HER2 status, location, patient and threshold
+    '''
+
+    import pandas as pd
+
+    dfNearest = loadResult(path,'dfNearest_'+name)
+
+    dfList = []
+    for distThresh in threshList:
+        close = (dfNearest['distSq'] <= distThresh**2).values
+        dfThresh = markerSummary(path,dfNearest[close],dfNearest[~close],funNames,totalName)
+        dfThresh['Threshold'] = distThresh
+        dfList.append(dfThresh)
+
+    saveResult(path,pd.concat(dfList,ignore_index=True),'dfThresholdCurves_'+name)
+
+
+
+def radiusNeighbors(ptsArray,seedPos,distThresh,backend=None):
+    '''
+    This function finds every neighbor of a set of seed cells within a radius in one pass, rather than one kdtree query per seed.
+    Input parameters:
+        ptsArray = np array of x,y coordinates of all cells that can be neighbors
+        seedPos = np array of row positions in ptsArray of the seed cells
+        distThresh = radius to search for neighbors, in px, 2 px = 1 µm
+        backend = 'kdtree' or 'grid'; None uses the backend set by setNeighborBackend()
+    Outputs:
+        returns: seedRows, neighCols, distSq = one entry per (seed, neighbor) pair sorted by seed then neighbor
+            seedRows = position of the seed in seedPos
+            neighCols = row position of the neighbor in ptsArray
+            distSq = squared distance between seed and neighbor
+        A seed is not included as its own neighbor.
+    '''
+
+    import numpy as np
+    from scipy import spatial
+
+    if len(seedPos) == 0 or len(ptsArray) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    if (backend or neighborSettings['backend']) == 'grid':
+        #grid buckets of all cells; every seed-neighbor pair within distThresh
+        seedRows, neighCols, _ = gridNeighbors(ptsArray[seedPos], ptsArray, distThresh)
+    else:
+        #kdtree of all cells and of just the seeds; one sparse distance query gives every seed-neighbor pair within distThresh
+        tree = spatial.cKDTree(ptsArray)
+        seedTree = spatial.cKDTree(ptsArray[seedPos])
+        pairs = seedTree.sparse_distance_matrix(tree, distThresh, output_type='ndarray')
+        seedRows = pairs['i'].astype(np.int64)
+        neighCols = pairs['j'].astype(np.int64)
+
+    #don't include the seed itself as a neighbor
+    notSelf = neighCols != seedPos[seedRows]
+    seedRows = seedRows[notSelf]
+    neighCols = neighCols[notSelf]
+
+    #sort pairs by seed, then neighbor
+    order = np.lexsort((neighCols, seedRows))
+    seedRows = seedRows[order]
+    neighCols = neighCols[order]
+
+    #squared distances, computed the same way the kdtree compares them to distThresh
+    diff = ptsArray[neighCols] - ptsArray[seedPos[seedRows]]
+    distSq = diff[:,0]**2 + diff[:,1]**2
+
+    return seedRows, neighCols, distSq
+
+
+
+def neighborClassCounts(seedRows,neighCols,classCodes,nSeeds,nClasses):
+    '''
+    This function counts the neighboring cell types of each seed cell as one sparse matrix product:
+    a seed x cell adjacency matrix multiplied by a cell x class one-hot encoding.
+    Input parameters:
+        seedRows, neighCols = seed-neighbor pairs, as returned by radiusNeighbors()
+        classCodes = np array with the class code of every cell; codes < 0 are cells that are not counted
+        nSeeds = number of seed cells
+        nClasses = number of possible classes
+    Outputs:
+        returns: counts = np array (nSeeds x nClasses) of neighbor counts per class
+    '''
+
+    import numpy as np
+    from scipy import sparse
+
+    nCells = len(classCodes)
+
+    #seed x cell adjacency matrix; one entry per neighbor
+    adj = sparse.csr_matrix((np.ones(len(seedRows), dtype=np.int64), (seedRows, neighCols)), shape=(nSeeds, nCells))
+
+    #cell x class one-hot encoding; cells of a class that is not counted get an empty row
+    counted = np.nonzero(classCodes >= 0)[0]
+    oneHot = sparse.csr_matrix((np.ones(len(counted), dtype=np.int64), (counted, classCodes[counted])), shape=(nCells, nClasses))
+
+    return (adj @ oneHot).toarray()
+
+
+
+def neighborhoodTable(file,seedIdx,counts,classOptions):
+    '''
+    This function formats the neighbor counts of one ROI's seed cells into rows of the neighborhood clustering df.
+    Input parameters:
+        file = name of the mIHC file the seeds come from
+        seedIdx = original df.loc index of each seed cell
+        counts = np array (seeds x classes) of neighbor counts, as returned by neighborClassCounts()
+        classOptions = list of possible neighbor classes, in the same order as the columns of counts
+    Outputs:
+        returns: df with file, index and a raw count and % column per class; % is set to zero when a seed has no neighbors
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    #percentage of each class out of all counted neighbors; avoid division by zero if there are no neighbors
+    total = counts.sum(axis=1, keepdims=True)
+    perc = np.divide(counts, total, out=np.zeros(counts.shape), where=total != 0)
+
+    #columns in the same order as before: file, index, then a count and % column for each class
+    colDict = {'file':[file]*len(seedIdx), 'index':seedIdx}
+    for n in range(len(classOptions)):
+        colDict['count'+classOptions[n]] = counts[:,n] #raw count
+        colDict['count'+classOptions[n]+'%'] = perc[:,n] #percentage
+
+    return pd.DataFrame(colDict)
+
+
+
+def getClassOptions():
+    '''
+    This function generates the list of all possible neighbor cell classes used for neighborhood analyses, in a fixed order
+    Input parameters:
+        None
+    Outputs:
+        returns: classOptions = list of cell classes; from prior knowledge of possible cell types
+    '''
+    classOptions = ['CD11B+ DCs',
+             'CD11B- CD68+ cells',
+             'CD11B- DCs',
+             'CD4 T cells',
+             'CD56+ NKP46+ NK',
+             'CD56+ NKP46- NK',
+             'CD56- NKP46+ NK',
+             'CD8 T cells',
+             'Myeloid other',
+             'Myelomonocytic cells',
+             'Other CD45+ cells',
+             'Tumor cells']
+
+    return classOptions
+
+
+
+def neighborhoodROI(path,file,seedList,radiusList,graphRadius=None,tileSize=None):
+    '''
+    This function generates spatial neighborhoods for the seed cells of one ROI at one or more radii, with a single spatial query.
+    Neighbors are found once at the largest radius; counts at every smaller radius come from cumulative counts over the sorted pair distances.
+    Called once per ROI by makeNeighborhoods() and makeNeighborhoodsSweep(), possibly in a separate process.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes to generate neighborhoods for
+        radiusList = sorted list of radii for spatial neighborhoods, in px, 2 px = 1 µm
+        graphRadius = if set, neighbors come from the ROI's cached neighbor graph (built at this radius if not cached yet) instead of a kdtree query
+        tileSize = if set, the csv is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; graphRadius is then not used
+    Outputs:
+        returns: list with one df of rows of the neighborhood clustering df per radius, in radiusList order
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    classOptions = getClassOptions()
+
+    if tileSize is not None:
+        seedIdx, counts = neighborhoodTiles(path, file, seedList, radiusList, tileSize)
+        return [neighborhoodTable(file, seedIdx, counts[:,b,:], classOptions) for b in range(len(radiusList))]
+
+    #read only the columns needed
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y'])
+
+    if graphRadius is None:
+        #create filtered dataframe without noise or 'other cells'
+        filt_df = df[(df['class'] != 'Other cells') & (df['class'] != 'Noise') ]
+    else:
+        #the cached graph covers all cells; noise and 'other cells' are not in classOptions so they are never counted
+        filt_df = df
+
+    #class code of each cell (position in classOptions; -1 if it is not a possible neighbor class)
+    classCodes = pd.Categorical(filt_df['class'], categories=classOptions).codes.astype(np.int64)
+
+    ##get neighbors of seed cells defined by seed param
+    seedPos = np.nonzero(filt_df['class'].isin(seedList).values)[0]
+    nSeeds = len(seedPos)
+    seedIdx = filt_df.index.values[seedPos] #original df.loc index of each seed
+
+    #all seed-neighbor pairs within the largest radius, with their squared distances
+    if graphRadius is None:
+        ptsArray = filt_df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+        seedRows, neighCols, distSq = radiusNeighbors(ptsArray, seedPos, radiusList[-1])
+    else:
+        seedRows, neighCols, distSq = graphRows(getNeighborGraph(path, file, radiusList[-1], graphRadius), seedPos)
+
+    counts = radiusClassCounts(seedRows, neighCols, distSq, classCodes, nSeeds, radiusList)
+
+    return [neighborhoodTable(file, seedIdx, counts[:,b,:], classOptions) for b in range(len(radiusList))]
+
+
+
+def radiusClassCounts(seedRows,neighCols,distSq,classCodes,nSeeds,radiusList):
+    '''
+    This function counts the neighboring cell types of each seed cell at one or more radii from seed-neighbor pairs found at the largest radius.
+    Input parameters:
+        seedRows, neighCols, distSq = seed-neighbor pairs within the largest radius, as returned by radiusNeighbors()
+        classCodes = np array with the class code of every cell (position in getClassOptions()); codes < 0 are cells that are not counted
+        nSeeds = number of seed cells
+        radiusList = sorted list of radii, in px, 2 px = 1 µm
+    Outputs:
+        returns: counts = np array (nSeeds x radii x classes) of neighbor counts per class within each radius
+    '''
+
+    import numpy as np
+
+    nClasses = len(getClassOptions())
+    radiusSq = np.array([r**2 for r in radiusList])
+    nRadii = len(radiusList)
+
+    #single radius: counts of neighboring cell types per seed as one sparse product
+    if nRadii == 1:
+        return neighborClassCounts(seedRows, neighCols, classCodes, nSeeds, nClasses)[:,np.newaxis,:]
+
+    #only count neighbors of a possible class
+    neighCodes = classCodes[neighCols]
+    counted = neighCodes >= 0
+
+    #smallest radius each pair falls within (d^2 <= r^2, same as a query at that radius)
+    radiusBin = np.searchsorted(radiusSq, distSq[counted], side='left')
+
+    #count pairs per seed, radius bin and class, then accumulate bins so each radius includes all closer neighbors
+    flatIdx = (seedRows[counted]*nRadii + radiusBin)*nClasses + neighCodes[counted]
+    counts = np.bincount(flatIdx, minlength=nSeeds*nRadii*nClasses).reshape(nSeeds, nRadii, nClasses)
+
+    return np.cumsum(counts, axis=1)
+
+
+
+def neighborhoodTiles(path,file,seedList,radiusList,tileSize):
+    '''
+    This function counts the neighboring cell types of the seed cells of one ROI one spatial tile at a time, with bounded memory.
+    Each seed is counted only in the tile that owns it; the tile's halo holds all of its neighbors, so counts match neighborhoodROI().
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        seedList = phenotypes to generate neighborhoods for
+        radiusList = sorted list of radii for spatial neighborhoods, in px, 2 px = 1 µm
+        tileSize = side of a tile, in px
+    Outputs:
+        returns: seedIdx, counts = seed cell indices and np array (seeds x radii x classes) of neighbor counts; in csv order
+    '''
+
+    import os
+    import tempfile
+    import numpy as np
+    import pandas as pd
+
+    classOptions = getClassOptions()
+
+    rowList = []
+    idxList = []
+    countList = []
+
+    os.makedirs(path+'/results/cache/tiles', exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=path+'/results/cache/tiles') as spillDir:
+        #only cells of a possible neighbor class are kept; the others are never counted
+        tileDict = spillTiles(path, file, [], classOptions, seedList, tileSize, radiusList[-1], spillDir)
+
+        for key in tileDict:
+            dfTile = readTile(tileDict[key])
+
+            #seeds owned by this tile, neighbors anywhere in the tile or its halo
+            classCodes = pd.Categorical(dfTile['class'], categories=classOptions).codes.astype(np.int64)
+            seedPos = np.nonzero(dfTile['class'].isin(seedList).values & dfTile['__owned__'].values)[0]
+            ptsArray = dfTile[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+
+            seedRows, neighCols, distSq = radiusNeighbors(ptsArray, seedPos, radiusList[-1])
+            countList.append(radiusClassCounts(seedRows, neighCols, distSq, classCodes, len(seedPos), radiusList))
+            rowList.append(dfTile['__row__'].values[seedPos])
+            idxList.append(dfTile.index.values[seedPos])
+
+    if len(rowList) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0,len(radiusList),len(classOptions)), dtype=np.int64)
+
+    #put seeds back in csv order
+    order = np.argsort(np.concatenate(rowList), kind='stable')
+
+    return np.concatenate(idxList)[order], np.concatenate(countList)[order]
+
+
+
+def interactionMatrix(path,csvList,radiusList,nProcs=1,graphRadius=None):
+    '''
+    This function counts the contacts between every pair of cell classes in getClassOptions() (12 x 12) for every ROI and radius,
+    with the contacts expected if the class labels were placed at random over the ROI's cells, so any pair of cell types can be looked up afterwards.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        radiusList = sorted list of radii, in px, 2 px = 1 µm
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet); None queries a kdtree
+    Outputs:
+        Saves one csv to 'dfCreated' folder with one row per ROI, radius and ordered pair of classes (classA, classB): the number of cells of each class,
+        the number of classB neighbors of classA cells ('contacts'), the expected number ('expected') and their ratio ('enrichment')
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    classOptions = getClassOptions()
+    nClasses = len(classOptions)
+    nRadii = len(radiusList)
+
+    dfList = []
+    for file,contacts,classTotals,pairTotals in mapROIs(interactionROI, path, csvList, nProcs, radiusList, graphRadius):
+        nCells = classTotals.sum()
+
+        #expected contacts if labels were shuffled over the ROI's cells: each of the pairs within the radius joins a given
+        #ordered pair of classes with probability nA*nB/(N*(N-1)), or nA*(nA-1)/(N*(N-1)) for the same class
+        pairProb = np.outer(classTotals, classTotals) - np.diag(classTotals)
+        pairProb = pairProb/(nCells*(nCells-1)) if nCells > 1 else np.zeros((nClasses,nClasses))
+        expected = pairTotals[:,None,None]*pairProb[None,:,:]
+
+        dfList.append(pd.DataFrame({'file':file,
+                                    'radius':np.repeat(radiusList, nClasses*nClasses),
+                                    'classA':np.tile(np.repeat(classOptions, nClasses), nRadii),
+                                    'classB':np.tile(classOptions, nClasses*nRadii),
+                                    'nA':np.tile(np.repeat(classTotals, nClasses), nRadii),
+                                    'nB':np.tile(classTotals, nClasses*nRadii),
+                                    'contacts':contacts.ravel(),
+                                    'expected':expected.ravel()}))
+
+    dfInteract = pd.concat(dfList, ignore_index=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dfInteract['enrichment'] = dfInteract['contacts']/dfInteract['expected'].where(dfInteract['expected'] > 0)
+
+    saveResult(path,dfInteract,'dfInteractions'+'_'.join(str(r) for r in radiusList))
+
+
+
+def interactionROI(path,file,radiusList,graphRadius=None):
+    '''
+    This function counts the contacts between every pair of cell classes of one ROI at one or more radii, possibly in a separate process.
+    The neighbors of every cell are counted per class as in neighborhoodROI(), then summed per class of the cell: O.T @ A @ O for the adjacency A and class one-hot O.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        radiusList = sorted list of radii, in px, 2 px = 1 µm
+        graphRadius = if set, neighbors come from the ROI's cached neighbor graph (built at this radius if not cached yet) instead of a kdtree query
+    Outputs:
+        returns: file, contacts, classTotals, pairTotals
+            contacts = np array (radii x classes x classes) of the number of neighbors of each class (columns) of the cells of each class (rows)
+            classTotals = np array with the number of cells of each class
+            pairTotals = np array with the number of ordered pairs of counted cells within each radius
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from scipy import sparse
+
+    classOptions = getClassOptions()
+    nClasses = len(classOptions)
+
+    #read only the columns needed
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y'])
+
+    if graphRadius is None:
+        #cells that are not of a possible class (noise, 'other cells') are never counted
+        df = df[df['class'].isin(classOptions)]
+
+    #class code of each cell (position in classOptions; -1 if it is not counted)
+    classCodes = pd.Categorical(df['class'], categories=classOptions).codes.astype(np.int64)
+    nCells = len(df)
+
+    #every cell is a seed; all pairs within the largest radius, with their squared distances
+    if graphRadius is None:
+        ptsArray = df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+        seedRows, neighCols, distSq = radiusNeighbors(ptsArray, np.arange(nCells), radiusList[-1])
+    else:
+        seedRows, neighCols, distSq = graphRows(getNeighborGraph(path, file, radiusList[-1], graphRadius), np.arange(nCells))
+
+    #neighbors of each class per cell and radius, then summed over the cells of each class
+    counts = radiusClassCounts(seedRows, neighCols, distSq, classCodes, nCells, radiusList)
+    counted = np.nonzero(classCodes >= 0)[0]
+    oneHot = sparse.csr_matrix((np.ones(len(counted), dtype=np.int64), (counted, classCodes[counted])), shape=(nCells, nClasses))
+    contacts = np.stack([oneHot.T @ counts[:,b,:] for b in range(len(radiusList))])
+
+    classTotals = np.bincount(classCodes[counted], minlength=nClasses)
+
+    return file, contacts, classTotals, contacts.sum(axis=(1,2))
+
+
+
+def lookupInteraction(path,name,classA,classB,radius=None):
+    '''
+    This function gets the contacts between two groups of cell classes per ROI from an interaction table saved by interactionMatrix(),
+    eg. CD8 T cells with any NK cell subtype, without another pass over the ROIs.
+    Input parameters:
+        path = cwd
+        name = name of the interaction csv, excluding the '.csv' (eg. dfInteractions40)
+        classA = cell class or list of cell classes whose neighbors are counted
+        classB = cell class or list of cell classes counted as neighbors
+        radius = radius to get; None gets every radius in the table
+    Outputs:
+        returns: df with one row per ROI and radius: number of cells in each group, contacts, expected contacts and enrichment
+    '''
+
+    import numpy as np
+
+    classA = [classA] if isinstance(classA,str) else list(classA)
+    classB = [classB] if isinstance(classB,str) else list(classB)
+
+    df = loadResult(path,name)
+    if radius is not None:
+        df = df[df['radius'] == radius]
+
+    #contacts and expected contacts add up over the classes of each group
+    dfPair = df[df['classA'].isin(classA) & df['classB'].isin(classB)]
+    dfPair = dfPair.groupby(['file','radius'],sort=False)[['contacts','expected']].sum()
+
+    #cells in each group, from the rows of one class pair per group member
+    dfPair['nA'] = df[df['classA'].isin(classA) & (df['classB'] == classB[0])].groupby(['file','radius'],sort=False)['nA'].sum()
+    dfPair['nB'] = df[(df['classA'] == classA[0]) & df['classB'].isin(classB)].groupby(['file','radius'],sort=False)['nB'].sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dfPair['enrichment'] = dfPair['contacts']/dfPair['expected'].where(dfPair['expected'] > 0)
+
+    return dfPair[['nA','nB','contacts','expected','enrichment']].reset_index()
+
+
+
+def makeNeighborhoods(path,csvList,seedList,distThresh,nProcs=1,graphRadius=None,tileSize=None,fmt='csv'):
+    '''
+    This function generates spatial neighborhoods for NK cells within a specified radius.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        seedList = phenotypes to generate neighborhoods for
+        distThresh = distance to set radius for spatial neighborhoods, in px, 2 px = 1 µm
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet), so reruns skip spatial queries; None queries a kdtree
+        tileSize = if set, each ROI is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; results are the same
+        fmt = 'csv' saves a csv; 'parquet' saves a parquet dataset instead (one part file per ROI, counts as uint16 and fractions as float32); 'both' saves both
+    Outputs:
+        saves one csv or parquet dataset folder (or both) to 'dfCreated' folder with neighbors of each seed cell, written one ROI at a time
+    '''
+
+    name = 'dfNeighborhoodClusterNK'+str(distThresh)
+
+    #neighborhoods of each ROI's seed cells come back in csvList order; each is written out as it arrives, one row per seed cell across all csvs
+    rowStart = 0
+    for partNo,res in enumerate(iterROIs(neighborhoodROI, path, csvList, nProcs, seedList, [distThresh], graphRadius, tileSize)):
+        writeNeighborhoodPart(path, name, res[0], rowStart, partNo, fmt)
+        rowStart += len(res[0])
+    
+    
+
+def makeNeighborhoodsSweep(path,csvList,seedList,radiusList,nProcs=1,graphRadius=None,tileSize=None,fmt='csv'):
+    '''
+    This function generates spatial neighborhoods for NK cells at several radii with a single spatial query per ROI.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        seedList = phenotypes to generate neighborhoods for
+        radiusList = list of radii for spatial neighborhoods, in px, 2 px = 1 µm; eg. [40,60,80,120,160]
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph (built at this radius if not cached yet), so reruns skip spatial queries; None queries a kdtree
+        tileSize = if set, each ROI is streamed into spatial tiles of this side (in px) and processed one tile at a time, for slides too large to load; results are the same
+        fmt = 'csv' saves a csv per radius; 'parquet' saves a parquet dataset per radius instead (counts as uint16 and fractions as float32); 'both' saves both
+    Outputs:
+        saves one csv or parquet dataset (or both) per radius to 'dfCreated' folder with neighbors of each seed cell; same format as makeNeighborhoods()
+    '''
+
+    #sort radii so counts can be accumulated from the smallest radius out
+    radiusList = sorted(radiusList)
+
+    #neighborhoods of each ROI's seed cells at every radius come back in csvList order; each is written out as it arrives
+    rowStart = 0
+    for partNo,res in enumerate(iterROIs(neighborhoodROI, path, csvList, nProcs, seedList, radiusList, graphRadius, tileSize)):
+        for b in range(len(radiusList)):
+            writeNeighborhoodPart(path, 'dfNeighborhoodClusterNK'+str(radiusList[b]), res[b], rowStart, partNo, fmt)
+        rowStart += len(res[0])
+
+
+
+def writeNeighborhoodPart(path,name,df,rowStart,partNo,fmt='csv'):
+    '''
+    This function writes the neighborhood rows of one ROI to the end of a neighborhood clustering table, so the full table is never held in memory.
+    The csv is the same as saving the whole table at once: one header, then rows indexed from 0 across all ROIs.
+    The parquet dataset is a folder with one part file per ROI, with the same rows and index; counts are stored as uint16 and fractions as float32.
+    Input parameters:
+        path = cwd
+        name = name of the table in the 'dfCreated' folder, excluding the .csv
+        df = rows of one ROI, as returned by neighborhoodTable()
+        rowStart = index of the first row of this ROI in the full table
+        partNo = position of the ROI in csvList; 0 starts a new table, and removes a table of the same name in the other format so it is not read instead
+        fmt = 'csv', 'parquet' or 'both'
+    Outputs:
+        Appends to one csv and/or writes one parquet part file in the 'dfCreated' folder
+    '''
+
+    import os
+    import shutil
+    import numpy as np
+
+    df.index = np.arange(rowStart, rowStart+len(df))
+    csvPath = path+'/results/dfCreated/'+name+'.csv'
+    dirPath = path+'/results/dfCreated/'+name
+
+    if fmt in ['csv','both']:
+        df.to_csv(csvPath, mode='w' if partNo == 0 else 'a', header=partNo == 0)
+    elif partNo == 0 and os.path.exists(csvPath):
+        os.remove(csvPath)
+
+    #a table kept in memory by an earlier saveResult() of the same name is now out of date
+    sessionStore.get('results',{}).pop((path,name), None)
+
+    if partNo == 0:
+        shutil.rmtree(dirPath, ignore_errors=True)
+
+    if fmt in ['parquet','both']:
+        if partNo == 0:
+            os.makedirs(dirPath)
+
+        #fixed compact types; counts of one neighborhood are far below the uint16 limit
+        countCols = [col for col in df.columns if col.startswith('count') and not col.endswith('%')]
+        if len(df) > 0 and df[countCols].values.max() > np.iinfo(np.uint16).max:
+            raise ValueError('Neighbor counts of '+name+' do not fit in uint16')
+        dfPart = df.astype({col:np.uint16 for col in countCols})
+        dfPart = dfPart.astype({col:np.float32 for col in df.columns if col.endswith('%')})
+        dfPart.to_parquet(dirPath+'/part-'+str(partNo).zfill(5)+'.parquet')
+
+
+
+def readNeighborhoods(path,name,fmt=None):
+    '''
+    This function reads a neighborhood clustering table written by makeNeighborhoods(), from its csv or its parquet dataset
+    Input parameters:
+        path = cwd
+        name = name of the table in the 'dfCreated' folder, excluding the .csv
+        fmt = 'csv' or 'parquet'; None reads the csv if there is one, otherwise the parquet dataset
+    Outputs:
+        returns: df of neighborhoods, one row per seed cell
+    '''
+
+    import os
+    import pandas as pd
+
+    if fmt == 'parquet' or (fmt is None and not os.path.exists(path+'/results/dfCreated/'+name+'.csv')):
+        return restoreNeighborhoods(pd.read_parquet(path+'/results/dfCreated/'+name))
+
+    return loadResult(path,name)
+
+
+
+def restoreNeighborhoods(df):
+    '''
+    This function gives neighborhoods read from a parquet dataset the values they have in the csv: counts as int64, and fractions
+    recalculated in float64 from the counts (they are stored as float32), so results are the same whichever format the table was saved in
+    Input parameters:
+        df = neighborhoods read from a parquet dataset written by writeNeighborhoodPart()
+    Outputs:
+        returns: df with the same columns, values and dtypes as read from the csv
+    '''
+
+    import numpy as np
+
+    fracCols = [col for col in df.columns if col.startswith('count') and col.endswith('%')]
+    countCols = [col[:-1] for col in fracCols]
+
+    counts = df[countCols].values.astype(np.int64)
+    total = counts.sum(axis=1, keepdims=True)
+    perc = np.divide(counts, total, out=np.zeros(counts.shape), where=total != 0)
+
+    df = df.astype({col:np.int64 for col in countCols})
+    for n in range(len(fracCols)):
+        df[fracCols[n]] = perc[:,n]
+
+    return df
+
+
+
+def iterNeighborhoods(path,name,chunkSize,fmt=None):
+    '''
+    This function reads a neighborhood clustering table written by makeNeighborhoods() in chunks of rows, so tables larger than memory can be processed
+    Input parameters:
+        path = cwd
+        name = name of the table in the 'dfCreated' folder, excluding the .csv
+        chunkSize = number of rows per chunk
+        fmt = 'csv' or 'parquet'; None reads the csv if there is one, otherwise the parquet dataset
+    Outputs:
+        yields: df of up to chunkSize neighborhoods, in table order, indexed as in the full table
+    '''
+
+    import os
+    import glob
+    import pandas as pd
+
+    if fmt == 'parquet' or (fmt is None and not os.path.exists(path+'/results/dfCreated/'+name+'.csv')):
+        import pyarrow.parquet as pq
+
+        for part in sorted(glob.glob(glob.escape(path+'/results/dfCreated/'+name)+'/*.parquet')):
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=chunkSize):
+                df = batch.to_pandas()
+                if '__index_level_0__' in df.columns:
+                    df = df.set_index('__index_level_0__')
+                    df.index.name = None
+                yield restoreNeighborhoods(df)
+        return
+
+    yield from pd.read_csv(path+'/results/dfCreated/'+name+'.csv', index_col=0, chunksize=chunkSize)
+
+
+
+def elbowMethod(path,file,steps,save,nProcs=1,warmStart=False):
+
+    '''
+    This function runs the Elbow Method to determine the optimal number of clusters for k-means clustering.
+    The elbow is detected automatically (Kneedle: the k furthest below the straight line joining the first and last points of the normalized WCSS curve).
+    Input parameters:
+        path = cwd
+        file = name of file to run clustering on 
+        steps = max number of clusters (k) to test
+        save = if True, creates and saves the plot
+        nProcs = number of processes to spread the k values over; 1 runs serially, None uses all cores; results are the same
+        warmStart = if True, each k starts from the k-1 centroids plus the point furthest from them, instead of 10 k-means++ initializations; k values then run serially
+        
+    Output:
+        returns: dfWCSS, elbow = df of within-cluster sum of squares per k, and the detected elbow k
+        saves dfWCSS (with a column marking the elbow) to the 'dfCreated' folder; optionally saves plot to 'figures' folder
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from joblib import Parallel, delayed
+    from matplotlib import pyplot as plt
+
+    df = readNeighborhoods(path,file)
+    #drop all rows that have no cells in the neighborhood (aka when the sum of count columns is zero)
+    df['sum'] = df.iloc[:,2:].sum(axis=1)
+
+    df = df[df['sum'] != 0]
+
+    #generate column list to cluster on based on if there is a % in the column name
+    colList = list(df.columns[['%' in col for col in list(df.columns)]])
+
+    #get only features we want to cluster on
+    df = df[colList]
+    data = df.values
+
+    kList = list(range(1, steps))
+
+    #calculate error for each k value (k=number of clusters)
+    if warmStart:
+        #each k depends on the centroids of k-1, so k values run one after another
+        wcss = []
+        centroids = None
+        for k in kList:
+            inertia, centroids = fitKMeans(data, k, centroids)
+            wcss.append(inertia)
+    else:
+        #k values are independent; each fit has a fixed random_state, so results do not depend on nProcs
+        resList = Parallel(n_jobs=-1 if nProcs is None else nProcs)(delayed(fitKMeans)(data, k) for k in kList)
+        wcss = [res[0] for res in resList]
+
+    #detect the elbow and store the curve
+    elbow = kneedle(kList, wcss)
+    dfWCSS = pd.DataFrame({'k':kList, 'wcss':wcss})
+    dfWCSS['elbow'] = (dfWCSS['k'] == elbow).astype(int)
+    saveResult(path,dfWCSS,'dfElbow'+file[21:])
+
+    #generate elbow plot and save (not results are not shown in manuscript)
+    if save == True:
+        with pyplotLock: #pyplot keeps global state; figures may be drawn from other stages at the same time
+            plt.plot(kList, wcss)
+            plt.axvline(elbow, color='grey', linestyle='--')
+            plt.title('Elbow Method')
+            plt.xlabel('Number of clusters')
+            plt.ylabel('WCSS')
+            plt.savefig(path+'/results/figures/figure5_elbow_plot.png',format='png')
+            plt.close()
+
+    return dfWCSS, elbow
+
+
+
+def fitKMeans(data,k,prevCentroids=None):
+    '''
+    This function fits one k-means model for the elbow method; a separate function so k values can be fitted in parallel.
+    Input parameters:
+        data = np array of features, one row per neighborhood
+        k = number of clusters
+        prevCentroids = optional np array of the k-1 centroids to warm start from; None uses 10 k-means++ initializations
+    Outputs:
+        returns: inertia, centroids = within-cluster sum of squares and the fitted centroids
+    '''
+
+    import numpy as np
+    from sklearn.cluster import MiniBatchKMeans #minibatchkmeans is better when n > 10,000 samples
+
+    if prevCentroids is None:
+        #generate kmeans model
+        kmeans = MiniBatchKMeans(n_clusters=k, init='k-means++', max_iter=300, n_init=10, random_state=0)
+    else:
+        #add the point furthest from the previous centroids as the new centroid
+        distSq = np.full(len(data), np.inf)
+        for centroid in prevCentroids:
+            distSq = np.minimum(distSq, ((data - centroid)**2).sum(axis=1))
+        init = np.vstack([prevCentroids, data[np.argmax(distSq)]])
+        kmeans = MiniBatchKMeans(n_clusters=k, init=init, max_iter=300, n_init=1, random_state=0)
+
+    #fit model to data
+    kmeans.fit(data)
+
+    return kmeans.inertia_, kmeans.cluster_centers_
+
+
+
+def kneedle(xList,yList):
+    '''
+    This function finds the elbow of a decreasing, convex curve such as WCSS versus k (Kneedle method).
+    Both axes are scaled to 0-1; the elbow is the point furthest below the straight line from the first to the last point.
+    Input parameters:
+        xList = list of x values (eg. k), increasing
+        yList = list of y values (eg. WCSS)
+    Outputs:
+        returns: elbow = x value of the elbow
+    '''
+
+    import numpy as np
+
+    x = np.asarray(xList, dtype=np.float64)
+    y = np.asarray(yList, dtype=np.float64)
+    if len(x) < 3:
+        return xList[0]
+
+    #normalize both axes; a flat curve has no elbow, so return the first point
+    xNorm = (x - x.min()) / (x.max() - x.min())
+    if y.max() == y.min():
+        return xList[0]
+    yNorm = (y - y.min()) / (y.max() - y.min())
+
+    #difference curve; the line from (0,1) to (1,0) minus the curve
+    diff = (1 - xNorm) - yNorm
+
+    return xList[int(np.argmax(diff))]
+    
+   
+def clusterNeighborhoods(path,file,k,chunkSize=None,assign=False):
+    '''
+    This function runs k-means clustering on a given neighborhood clustering csv.
+    The results are saved to a new csv.
+    Input parameters:
+        path = cwd
+        file = name of file to run clustering on excluding the .csv
+        k = number of clusters; use elbow method to determine optimal number
+        chunkSize = if set, the table is streamed in chunks of this many rows so memory is bounded by the chunk size, not the number of seeds;
+            see clusterNeighborhoodsChunked(). None fits on the whole table in memory
+        assign = if True and the saved model was fitted on the first rows of the current table (eg. ROIs were only added by assignNeighborhoods()),
+            the model is not refitted: every neighborhood is assigned to its nearest saved centroid, so cluster ids do not change. False always refits
+    Outputs:
+        One csv is saved to the 'dfCreated/' folder with NK neighborhood cluster assignments
+    '''
+
+    import pandas as pd
+    from sklearn.cluster import MiniBatchKMeans
+
+    #in assign mode, keep the saved model if the table has only grown since it was fitted
+    model = frozenNeighborhoodModel(path,'dfNeighClustered'+file[21:]+'k'+str(k),file) if assign else None
+    if model is not None:
+        return writeNeighborhoodClusters(path,file,'dfNeighClustered'+file[21:]+'k'+str(k),model,100000 if chunkSize is None else chunkSize)
+
+    if chunkSize is not None:
+        return clusterNeighborhoodsChunked(path,file,k,chunkSize)
     
+    #read csv with neighborhood data    
+    df = readNeighborhoods(path,file)
+
+    #drop all rows that have no cells in the neighborhood (aka when the sum of count columns is zero)
+    df['sum'] = df.iloc[:,2:].sum(axis=1)
+    dfFilt =df[df['sum'] != 0]
+
+    #get lists from original df to add back later after clustering
+    roiList = list(dfFilt['file']) #get list of ROIs in order to add to dfNoNa later
+    idxList = list(dfFilt['index']) #get list of cell indices in order to add to dfNoNa later
+
+    #generate column list to cluster on based on if there is a % in the column name; this excludes the ki67, pdl1 columns too
+    colList = list(dfFilt.columns[['%' in col for col in list(dfFilt.columns)]])
+
+    #get only features we want to cluster on
+    dfFilt = dfFilt[colList]
+    data = dfFilt.values
+
+    #=k-means clustering of cells with k clusters
+    kmeans = MiniBatchKMeans(n_clusters=k, init='k-means++', max_iter=300, n_init=10, random_state=0)
+    predict = kmeans.fit_predict(data) #fit model to data and predict index (cluster labels); same results as first fitting and then predicting
+
+    #add predicted cluster labels to df as a new column and see how many cells are in each cluster
+    dfFilt['cluster'] = predict
+    dfFilt['cluster'].value_counts() #unecessary unless you want to see how many cells are in each cluster and then you should print it
+
+    #add original ROI to df to check which ROIs are in each cluster
+    dfFilt['file'] = roiList
+
+    #need to add original indices to this df to check which ROIs are in each cluster; will also need to use ROI ID to pair with cell index (same index could be had by two cells from diff ROIs)
+    dfFilt['index'] = idxList #idxList stores the row value of filt_df.iloc[row,column] command
+
+    #save df to a csv
+    saveResult(path,dfFilt,'dfNeighClustered'+file[21:]+'k'+str(k))
+
+    #save the fitted model so new ROIs can be assigned to the same clusters later
+    saveNeighborhoodModel(path,'dfNeighClustered'+file[21:]+'k'+str(k),kmeans,colList,file,len(df))
+
+
+
+def clusterNeighborhoodsChunked(path,file,k,chunkSize,nPasses=1,sampleSize=None):
+    '''
+    This function runs k-means clustering on a neighborhood clustering table too large for memory, in streaming passes over chunks of rows.
+    A first pass draws a uniform reservoir sample of neighborhoods from the whole table and seeds the centroids with the best (lowest sample inertia)
+    of 10 k-means++ initializations on it, which are first updated with the sample. The fitting pass(es) then update the centroids only through
+    partial_fit on shuffled mini-batches of every chunk, so no chunk is weighted more than another. The last pass assigns each neighborhood to its nearest centroid and appends it to the output csv,
+    which has the same columns and index as the csv saved by clusterNeighborhoods().
+    Input parameters:
+        path = cwd
+        file = name of file to run clustering on excluding the .csv
+        k = number of clusters; use elbow method to determine optimal number
+        chunkSize = number of rows read at a time
+        nPasses = number of passes over the table to fit the model
+        sampleSize = number of neighborhoods in the reservoir sample used to seed the centroids; None uses max(chunkSize, 100*k)
+    Outputs:
+        One csv is saved to the 'dfCreated/' folder with NK neighborhood cluster assignments
+    '''
+
+    import numpy as np
+    from sklearn.cluster import MiniBatchKMeans, kmeans_plusplus
+
+    name = 'dfNeighClustered'+file[21:]+'k'+str(k)
+    rng = np.random.default_rng(0)
+    colList = None
+    if sampleSize is None:
+        sampleSize = max(chunkSize, 100*k)
+
+    def filterChunk(df):
+        #drop all rows that have no cells in the neighborhood (aka when the sum of count columns is zero)
+        df['sum'] = df.iloc[:,2:].sum(axis=1)
+        return df[df['sum'] != 0]
+
+    #sampling pass - reservoir sample across all chunks (each neighborhood is kept with the same probability)
+    sample = None
+    nSeen = 0
+    nRows = 0 #rows of the table, including those dropped
+    for df in iterNeighborhoods(path,file,chunkSize):
+        nRows += len(df)
+        dfFilt = filterChunk(df)
+        if colList is None:
+            #generate column list to cluster on based on if there is a % in the column name
+            colList = list(dfFilt.columns[['%' in col for col in list(dfFilt.columns)]])
+            sample = np.empty((sampleSize,len(colList)))
+        data = dfFilt[colList].values.astype(np.float64)
+
+        #fill the reservoir first, then row t replaces a random slot with probability sampleSize/(t+1)
+        nFill = min(max(sampleSize-nSeen,0), len(data))
+        sample[nSeen:nSeen+nFill] = data[:nFill]
+        slots = rng.integers(0, nSeen+np.arange(nFill,len(data))+1)
+        for row,slot in zip(np.flatnonzero(slots < sampleSize)+nFill, slots[slots < sampleSize]):
+            sample[slot] = data[row]
+        nSeen += len(data)
+
+    if nSeen < k:
+        raise ValueError('The table has fewer neighborhoods than clusters')
+    sample = sample[:min(nSeen,sampleSize)]
+
+    #seed the centroids with the best of 10 k-means++ initializations on the sample
+    bestInertia = np.inf
+    for seed in range(10):
+        centers,_ = kmeans_plusplus(sample, k, random_state=seed)
+        inertia = ((sample[:,None,:]-centers[None,:,:])**2).sum(axis=2).min(axis=1).sum()
+        if inertia < bestInertia:
+            bestInertia, init = inertia, centers
+    kmeans = MiniBatchKMeans(n_clusters=k, init=init, n_init=1, max_iter=300, random_state=0)
+
+    #the sample gives each seeded centroid a starting count; otherwise the first chunks (e.g. a few ROIs of one kind) move them all the way to their own means
+    for start in range(0, len(sample), kmeans.batch_size):
+        kmeans.partial_fit(sample[start:start+kmeans.batch_size])
+
+    #fitting pass(es) - update the centroids with shuffled mini-batches of every chunk
+    for i in range(nPasses):
+        for df in iterNeighborhoods(path,file,chunkSize):
+            data = filterChunk(df)[colList].values.astype(np.float64)
+            order = rng.permutation(len(data))
+            for start in range(0, len(data), kmeans.batch_size):
+                kmeans.partial_fit(data[order[start:start+kmeans.batch_size]])
+
+    #last pass - assign every neighborhood and write it out
+    first = True
+    for df in iterNeighborhoods(path,file,chunkSize):
+        dfFilt = filterChunk(df)
+
+        dfOut = dfFilt[colList].copy()
+        dfOut['cluster'] = kmeans.predict(dfOut.values.astype(np.float64)) if len(dfOut) > 0 else []
+        dfOut['file'] = dfFilt['file'].values
+        dfOut['index'] = dfFilt['index'].values
+
+        dfOut.to_csv(path+'/results/dfCreated/'+name+'.csv', mode='w' if first else 'a', header=first)
+        first = False
+
+    #a table kept in memory by an earlier saveResult() of the same name is now out of date
+    sessionStore.get('results',{}).pop((path,name), None)
+
+    #save the fitted model so new ROIs can be assigned to the same clusters later
+    saveNeighborhoodModel(path,name,kmeans,colList,file,nRows)
+
+
+
+def saveNeighborhoodModel(path,name,kmeans,colList,file,nRows):
+    '''
+    This function saves a fitted neighborhood clustering model: its centroids, the feature columns they are defined over and how it was fitted
+    Input parameters:
+        path = cwd
+        name = name of the clustered csv the model belongs to, excluding the .csv
+        kmeans = fitted MiniBatchKMeans model
+        colList = feature columns the model was fitted on, in order
+        file = name of the neighborhood table the model was fitted on
+        nRows = number of rows of the table the model was fitted on; these rows are fingerprinted so the model can be kept as the table grows
+    Outputs:
+        Saves one json to the 'dfCreated' folder, named after the clustered csv with a '_model' suffix
+    '''
+
+    import json
+
+    model = {'k':int(kmeans.n_clusters),
+             'features':list(colList),
+             'centroids':kmeans.cluster_centers_.tolist(),
+             'params':{'init':'k-means++', 'n_init':kmeans.n_init, 'max_iter':kmeans.max_iter, 'random_state':kmeans.random_state},
+             'fittedOn':file,
+             'fittedRows':int(nRows),
+             'fittedHash':neighborhoodsDigest(path,file,colList,nRows)}
+
+    with open(path+'/results/dfCreated/'+name+'_model.json','w') as f:
+        json.dump(model, f)
+
+
+
+def loadNeighborhoodModel(path,name):
+    '''
+    This function reads a neighborhood clustering model saved by saveNeighborhoodModel()
+    Input parameters:
+        path = cwd
+        name = name of the clustered csv the model belongs to, excluding the .csv
+    Outputs:
+        returns: model = dict with k, features, centroids (np array, clusters x features), params and fittedOn
+    '''
+
+    import json
+    import numpy as np
+
+    with open(path+'/results/dfCreated/'+name+'_model.json') as f:
+        model = json.load(f)
+    model['centroids'] = np.array(model['centroids'], dtype=np.float64)
+
+    return model
+
+
+
+def neighborhoodsDigest(path,file,colList,nRows):
+    '''
+    This function fingerprints the first rows of a neighborhood table: their ROI, cell index and feature values
+    Input parameters:
+        path = cwd
+        file = name of the neighborhood table
+        colList = feature columns to include
+        nRows = number of rows to fingerprint
+    Outputs:
+        returns: sha256 hex digest, or None if the table has fewer than nRows rows
+    '''
+
+    import hashlib
+    import numpy as np
+
+    #always read in chunks of the same size, so the digest of a table's first rows does not depend on what follows them
+    sha = hashlib.sha256()
+    nDone = 0
+    for df in iterNeighborhoods(path,file,100000):
+        if nDone >= nRows:
+            break
+        df = df.iloc[:nRows-nDone]
+        sha.update(('\n'.join(df['file'].astype(str))+'\n').encode())
+        sha.update(df['index'].values.astype(np.int64).tobytes())
+        sha.update(np.ascontiguousarray(df[colList].values.astype(np.float64)).tobytes())
+        nDone += len(df)
+
+    return sha.hexdigest() if nDone == nRows else None
+
+
+
+def frozenNeighborhoodModel(path,name,file):
+    '''
+    This function gets the saved neighborhood clustering model if it was fitted on the first rows of the current neighborhood table,
+    ie. rows have only been added to the table (eg. new ROIs by assignNeighborhoods()) since the model was fitted
+    Input parameters:
+        path = cwd
+        name = name of the clustered csv the model belongs to, excluding the .csv
+        file = name of the current neighborhood table
+    Outputs:
+        returns: model as returned by loadNeighborhoodModel(), or None if there is no such model
+    '''
+
+    import os
+
+    if not os.path.exists(path+'/results/dfCreated/'+name+'_model.json'):
+        return None
+
+    model = loadNeighborhoodModel(path,name)
+    if model['fittedOn'] != file or 'fittedHash' not in model:
+        return None
+    if neighborhoodsDigest(path,file,model['features'],model['fittedRows']) != model['fittedHash']:
+        return None
+
+    return model
+
+
+
+def writeNeighborhoodClusters(path,file,name,model,chunkSize):
+    '''
+    This function assigns every neighborhood of a table to the nearest centroid of a saved model and saves the clustered csv,
+    with the same columns and index as the csv saved by clusterNeighborhoods()
+    Input parameters:
+        path = cwd
+        file = name of the neighborhood table
+        name = name of the clustered csv, excluding the .csv
+        model = model as returned by loadNeighborhoodModel()
+        chunkSize = number of rows read at a time
+    Outputs:
+        One csv is saved to the 'dfCreated/' folder with NK neighborhood cluster assignments
+    '''
+
+    import numpy as np
+
+    first = True
+    for df in iterNeighborhoods(path,file,chunkSize):
+        #drop all rows that have no cells in the neighborhood, as when fitting
+        df['sum'] = df.iloc[:,2:].sum(axis=1)
+        dfFilt = df[df['sum'] != 0]
+
+        dfOut = dfFilt[model['features']].copy()
+        dfOut['cluster'] = nearestCentroid(dfOut.values.astype(np.float64), model['centroids'])
+        dfOut['file'] = dfFilt['file'].values
+        dfOut['index'] = dfFilt['index'].values
+
+        dfOut.to_csv(path+'/results/dfCreated/'+name+'.csv', mode='w' if first else 'a', header=first)
+        first = False
+
+    #a table kept in memory by an earlier saveResult() of the same name is now out of date
+    sessionStore.get('results',{}).pop((path,name), None)
+
+
+
+def nearestCentroid(data,centroids):
+    '''
+    This function finds the nearest centroid of each row of data
+    Input parameters:
+        data = np array, rows x features
+        centroids = np array, clusters x features
+    Outputs:
+        returns: np array with the index of the nearest centroid of each row
+    '''
+
+    import numpy as np
+
+    distSq = ((data[:,np.newaxis,:] - centroids[np.newaxis,:,:])**2).sum(axis=2)
+
+    return np.argmin(distSq, axis=1)
+
+
+
+def assignNeighborhoods(path,csvList,seedList,distThresh,k,nProcs=1,graphRadius=None):
+    '''
+    This function adds new ROIs to an existing neighborhood clustering without refitting it: neighborhoods are calculated only for ROIs
+    that are not in the neighborhood table yet, and each is assigned to the nearest centroid of the saved model, so cluster ids do not change.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files; files already in the neighborhood table are skipped
+        seedList = phenotypes to generate neighborhoods for
+        distThresh = radius of the existing neighborhoods, in px, 2 px = 1 µm
+        k = number of clusters of the existing clustering
+        nProcs = number of processes to spread new ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, neighbors come from each ROI's cached neighbor graph; None queries a kdtree
+    Outputs:
+        returns: newList = list of ROIs that were added
+        Appends the new ROIs to the neighborhood csv and/or parquet dataset, whichever exist, and to the clustered csv in the 'dfCreated' folder
+    '''
+
+    import os
+    import glob
+    import numpy as np
+
+    file = 'dfNeighborhoodClusterNK'+str(distThresh)
+    name = 'dfNeighClustered'+file[21:]+'k'+str(k)
+    model = loadNeighborhoodModel(path,name)
+
+    #find the ROIs already in the neighborhood table and where the table ends
+    doneSet = set()
+    rowStart = 0
+    for df in iterNeighborhoods(path,file,100000):
+        doneSet.update(df['file'].unique())
+        rowStart += len(df)
+    newList = [roi for roi in csvList if roi not in doneSet]
+
+    #continue the table in the format(s) it was saved in
+    isCsv = os.path.exists(path+'/results/dfCreated/'+file+'.csv')
+    isParquet = os.path.isdir(path+'/results/dfCreated/'+file)
+    fmt = 'both' if isCsv and isParquet else 'csv' if isCsv else 'parquet'
+    partNo = len(glob.glob(glob.escape(path+'/results/dfCreated/'+file)+'/*.parquet'))
+
+    for res in iterROIs(neighborhoodROI, path, newList, nProcs, seedList, [distThresh], graphRadius, None):
+        df = res[0]
+        writeNeighborhoodPart(path, file, df, rowStart, max(partNo,1), fmt)
+        rowStart += len(df)
+        partNo += 1
+
+        #drop all rows that have no cells in the neighborhood, as when fitting
+        df['sum'] = df.iloc[:,2:].sum(axis=1)
+        dfFilt = df[df['sum'] != 0]
+
+        #nearest centroid of the frozen model
+        dfOut = dfFilt[model['features']].copy()
+        dfOut['cluster'] = nearestCentroid(dfOut.values.astype(np.float64), model['centroids'])
+        dfOut['file'] = dfFilt['file'].values
+        dfOut['index'] = dfFilt['index'].values
+        dfOut.to_csv(path+'/results/dfCreated/'+name+'.csv', mode='a', header=False)
+
+    #a table kept in memory by an earlier saveResult() of the same name is now out of date
+    sessionStore.get('results',{}).pop((path,name), None)
+
+    return newList
+
+
+
+def createCsvsWithClusterCol(path,name,roiList=None,nProcs=1,parquet=False):
+    '''
+    This function takes a csv of all seed cells with their cluster IDs and outputs separate csvs per ROI, by default for two hard-coded ROIs: D16_BB2014A_ROI01 and M27_TT1120A_ROI02
+    The new ROIs contain a 'cluster' column which is populated with the corresponding cluster ID for each NK cell.
+    Non-NK cells have their original cell classification ID populated in this column.
+
+    Input parameters:
+        path = cwd
+        name = name of the clustered df
+        roiList = list of ROIs to annotate; None = the two ROIs of figure 5C, 'all' = every ROI in the clustered df
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        parquet = if True, also writes each annotated ROI as a parquet file next to its csv
+    Outputs:
+        Saves one csv (and optionally one parquet file) per ROI to the /dfCreated/updatedCsvs/ folder
+    '''
+
+    from itertools import repeat
+    from concurrent.futures import ProcessPoolExecutor
+
+    #get clustered df; contains all cells from ALL ROIs
+    dfClust = loadResult(path,name)
+
+    if roiList is None:
+        roiList = ['D16_BB2014A_ROI01','M27_TT1120A_ROI02']
+    elif roiList == 'all':
+        roiList = list(dfClust['file'].unique())
+
+    #split the clustered df into the seed index and cluster arrays of each ROI in one pass
+    groupDict = {roi:(dfROI['index'].values,dfROI['cluster'].values) for roi,dfROI in dfClust.groupby('file',sort=False)}
+    emptyPair = (dfClust['index'].values[:0],dfClust['cluster'].values[:0])
+    pairList = [groupDict.get(roi,emptyPair) for roi in roiList]
+
+    argLists = [repeat(path), roiList, [pair[0] for pair in pairList], [pair[1] for pair in pairList], repeat(name), repeat(parquet)]
+
+    #run serially if only one process is requested or there is only one ROI
+    if nProcs == 1 or len(roiList) <= 1:
+        list(map(annotateROI, *argLists))
+        return
+
+    with ProcessPoolExecutor(max_workers=nProcs, mp_context=getPoolContext()) as executor:
+        list(executor.map(annotateROI, *argLists))
+
+    #the workers saved the csvs from their own processes; tables kept in memory by an earlier run of this session are now out of date
+    for roi in roiList:
+        sessionStore.get('results',{}).pop((path,'updatedCsvs/'+roi+'_cluster_'+name[16:]), None)
+
+
+
+def annotateROI(path,roi,seedIdx,seedCluster,name,parquet=False):
+    '''
+    This function adds the cluster column to one mIHC csv, for createCsvsWithClusterCol()
+    Input parameters:
+        path = cwd
+        roi = name of the mIHC file, excluding the .csv
+        seedIdx = np array of the original csv index of each clustered seed cell of the ROI
+        seedCluster = np array of the cluster ID of each of those seed cells
+        name = name of the clustered df
+        parquet = if True, also writes the annotated ROI as a parquet file
+    Outputs:
+        Saves one csv (and optionally one parquet file) to the /dfCreated/updatedCsvs/ folder
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    #read the csv itself rather than readROI() so the saved csv keeps every column in its original format
+    df = pd.read_csv(path+'/data/mIHC_files/'+roi+'.csv', index_col=0)
+
+    #join the cluster IDs onto the cells by their original index in one step; cells that are not seeds get NaN
+    df['cluster'] = pd.Series(seedCluster.astype(np.float64), index=seedIdx).reindex(df.index).values
+
+    #non-seed cells are not part of a cluster, so map them back to their cell class
+    df['cluster'] = df['cluster'].fillna(df['class'])
+
+    outName = 'updatedCsvs/'+roi+'_cluster_'+name[16:]
+    saveResult(path,df,outName)
+
+    if parquet:
+        #the cluster column mixes cluster IDs and class names; store it as the text the csv holds
+        df.astype({'cluster':str}).to_parquet(path+'/results/dfCreated/'+outName+'.parquet')
+
+
+
+def clusterCountPerROI(path,name):
+    '''
+    This function takes in a clustered csv and creates two csvs with the counts of each seed cell per ROI.
+    One csv includes counts across all ROIs. One csv includes counts averaged across ROIs.
+    The avg csv has both raw count and percentage counts for each cluster.
+    All counts come from one grouped pass over the clustered df, which also gives the rollup csv of clusterRollup().
+
+    Input parameters:
+        path = cwd
+        name = name of file containing clustered neighborhood data to count cluster abundance from, excluding the '.csv'
+    Outputs:
+        Saves three csvs saved to 'dfCreated' folder
+    '''
+
+    import pandas as pd
+
+    #read clustering csv to analyze (eg. dfNeighClusteredH70allk5; it's a csv that has each seed cell clustered)
+    df = loadResult(path,name)
+
+    #raw frequency counts of each cluster per ROI in one pass; ROIs and clusters in order of first appearance
+    sizes = df.groupby(['file','cluster'],sort=False).size()
+
+    #most frequent cluster first per ROI, as value_counts() orders them, so the columns come out as they always have
+    dictCounts = {roi:freq.droplevel(0).sort_values(ascending=False) for roi,freq in sizes.groupby(level=0,sort=False)}
+
+    #put counts of clusters into a df
+    dfClustCounts = pd.DataFrame(dictCounts).T
+    dfClustCounts = dfClustCounts.fillna(0)
+
+    # #save dfClustCounts to csv
+    saveResult(path,dfClustCounts,'dfClustCounts'+name[16:]+'_all')
+
+    #roll the ROI counts up to patient, cohort, HER2 status and all ROIs
+    dfRollup = clusterRollup(path,dfClustCounts)
+    saveResult(path,dfRollup,'dfClustRollup'+name[16:])
+
+    #patient counts with percentages; calculated on a per patient basis - not on a percent average by regions
+    dfClustCountsAvg = dfRollup[dfRollup['level'] == 'patient'].drop(columns=['level','patient','cohort','HER2','Total'])
+    dfClustCountsAvg.index.name = None
+
+    #save avg df to csv
+    saveResult(path,dfClustCountsAvg,'dfClustCounts'+name[16:]+'_avg')
+
+
+
+def clusterRollup(path,dfClustCounts):
+    '''
+    This function rolls cluster counts per ROI up to every level the figures compare: ROI, patient, cohort, HER2 status and all ROIs.
+    Input parameters:
+        path = cwd
+        dfClustCounts = df of counts of each cluster (columns) per ROI (index), as saved by clusterCountPerROI()
+    Outputs:
+        returns: dfRollup = df indexed by group with a 'level' column ('ROI','patient','cohort','HER2','all'); the patient, cohort and HER2 of each group
+            where it has one; the count of each cluster, their 'Total' and the fraction of each cluster ('<cluster>_%')
+    '''
+
+    import numpy as np
+    import pandas as pd
+
+    clustList = list(dfClustCounts.columns)
+
+    #patient = ROI name without '_ROI01'; cohort = first letter of the patient (D = cohort 1, M = cohort 2)
+    patients = pd.Index(dfClustCounts.index.str.slice(0,-6))
+    keyDict = {'patient':patients,'cohort':patients.str[0],'HER2':patients.map(readClinical(path)['HER2'])}
+
+    #each level is a sum of the ROI counts over one key; patients come out sorted as in the patient averages
+    levelDict = {'ROI':dfClustCounts}
+    for level in ['patient','cohort','HER2']:
+        levelDict[level] = dfClustCounts.groupby(keyDict[level].values).sum()
+    levelDict['all'] = dfClustCounts.sum(axis=0).to_frame('all').T.astype(dfClustCounts.dtypes)
+
+    dfList = []
+    for level,dfLevel in levelDict.items():
+        dfLevel = dfLevel.copy()
+        dfLevel['Total'] = dfLevel[clustList].sum(axis=1)
+        for col in clustList:
+            dfLevel[str(col)+'_%'] = dfLevel[col]/dfLevel['Total']
+
+        #keys shared by the whole group
+        if level == 'ROI':
+            keys = pd.DataFrame(keyDict,index=dfLevel.index)
+        elif level == 'patient':
+            keys = pd.DataFrame(keyDict,index=dfClustCounts.index).drop_duplicates('patient').set_index('patient',drop=False).reindex(dfLevel.index)
+        else:
+            keys = pd.DataFrame({'patient':None,'cohort':dfLevel.index if level == 'cohort' else None,'HER2':dfLevel.index if level == 'HER2' else np.nan},index=dfLevel.index)
+        keys.insert(0,'level',level)
+
+        dfLevel.index = [str(i) for i in dfLevel.index]
+        keys.index = dfLevel.index
+        dfList.append(pd.concat([keys,dfLevel],axis=1))
+
+    dfRollup = pd.concat(dfList)
+    dfRollup.index.name = 'group'
+
+    return dfRollup
+
+
+
+def queryRollup(path,name,level,cohort=None):
+    '''
+    This function gets the rows of one level of a cluster rollup saved by clusterCountPerROI()
+    Input parameters:
+        path = cwd
+        name = name of the rollup csv, excluding the '.csv' (eg. dfClustRollupNK120k5)
+        level = 'ROI', 'patient', 'cohort', 'HER2' or 'all'
+        cohort = if given, only the groups of this cohort ('D' or 'M')
+    Outputs:
+        returns: df of the level's groups (index) with their keys, counts, totals and fractions
+    '''
+
+    df = loadResult(path,name)
+    df = df[df['level'] == level]
+    if cohort is not None:
+        df = df[df['cohort'] == cohort]
+
+    #HER2 is empty on levels without one, so it is read back as float; restore whole numbers where every group has a status
+    if df['HER2'].notna().all():
+        df = df.astype({'HER2':'int64'})
+
+    #groups are the index, unnamed as in the per ROI and per patient csvs
+    return df.drop(columns=['level']).rename_axis(None)
+
+
+
+def ripleyCurves(path,csvList,radiusList,name,typeDict=None,nProcs=1,graphRadius=None):
+    '''
+    This function calculates Ripley's K and L functions of groups of cell classes at many radii for every ROI:
+    univariate for each group and cross-type for each pair of groups (eg. NK cells vs tumor cells), with translation edge correction.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files in the dataset
+        radiusList = sorted list of radii, in px, 2 px = 1 µm; should be well below the size of the ROIs
+        name = name of the analysis used in the saved csv's name (eg. 'NKTumor')
+        typeDict = dict of group name:list of cell classes; None = each NK subtype, all NK cells and tumor cells
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = if set, pairs come from each ROI's cached neighbor graph (built at this radius if not cached yet); None queries a kdtree
+    Outputs:
+        Saves one csv to 'dfCreated' folder with one row per ROI, pair of groups (typeA, typeB; typeA == typeB is the univariate function) and radius:
+        number of cells of each group, area of the ROI, K and L = sqrt(K/pi)
+    '''
+
+    import pandas as pd
+
+    if typeDict is None:
+        nkList = ['CD56+ NKP46+ NK','CD56+ NKP46- NK','CD56- NKP46+ NK']
+        typeDict = {nk:[nk] for nk in nkList}
+        typeDict['NK cells'] = nkList
+        typeDict['Tumor cells'] = ['Tumor cells']
+
+    dfRipley = pd.concat(mapROIs(ripleyROI, path, csvList, nProcs, radiusList, typeDict, graphRadius), ignore_index=True)
+
+    saveResult(path,dfRipley,'dfRipley_'+name)
+
+
+
+def ripleyROI(path,file,radiusList,typeDict,graphRadius=None):
+    '''
+    This function calculates Ripley's K and L functions of one ROI for every group and pair of groups of cell classes, possibly in a separate process.
+    All pairs of cells within the largest radius are found once; ripleyFromPairs() turns them into the curves at every radius.
+    Input parameters:
+        path = cwd
+        file = name of the mIHC file to analyze
+        radiusList = sorted list of radii, in px, 2 px = 1 µm
+        typeDict = dict of group name:list of cell classes
+        graphRadius = if set, pairs come from the ROI's cached neighbor graph (built at this radius if not cached yet) instead of a kdtree query
+    Outputs:
+        returns: df of the ROI's curves (see ripleyCurves())
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from scipy import spatial
+
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y'])
+    ptsArray = df[['Location_Center_X','Location_Center_Y']].values.astype(np.float64)
+
+    #window = bounding box of all cells of the ROI
+    width, height = ptsArray.max(axis=0) - ptsArray.min(axis=0) if len(ptsArray) > 0 else (0.0, 0.0)
+    area = width*height
+
+    #group membership of each cell (cells x groups); groups may share classes
+    typeList = list(typeDict)
+    member = np.stack([df['class'].isin(typeDict[t]).values for t in typeList], axis=1)
+    counts = member.sum(axis=0)
+
+    #every pair of cells of any group within the largest radius, once (i < j)
+    typed = np.nonzero(member.any(axis=1))[0]
+    if graphRadius is None and neighborSettings['backend'] == 'grid':
+        seedRows, neighCols, _ = gridNeighbors(ptsArray[typed], ptsArray[typed], radiusList[-1])
+        pairs = np.stack([typed[seedRows], typed[neighCols]], axis=1)[seedRows < neighCols]
+    elif graphRadius is None:
+        pairs = np.zeros((0,2), dtype=np.int64)
+        if len(typed) > 1:
+            pairs = typed[spatial.cKDTree(ptsArray[typed]).query_pairs(radiusList[-1], output_type='ndarray')]
+    else:
+        seedRows, neighCols, _ = graphRows(getNeighborGraph(path, file, radiusList[-1], graphRadius), typed)
+        pairs = np.stack([typed[seedRows], neighCols], axis=1)
+        pairs = pairs[(pairs[:,0] < pairs[:,1]) & member[pairs[:,1]].any(axis=1)]
+
+    kDict = ripleyFromPairs(ptsArray, member, pairs, radiusList)
+
+    rowList = []
+    for (a,b),kList in kDict.items():
+        rowList.append(pd.DataFrame({'file':file, 'typeA':typeList[a], 'typeB':typeList[b], 'radius':radiusList,
+                                     'nA':counts[a], 'nB':counts[b], 'area':area, 'K':kList, 'L':np.sqrt(kList/np.pi)}))
+
+    return pd.concat(rowList, ignore_index=True)
+
+
+
+def ripleyFromPairs(ptsArray,member,pairs,radiusList):
+    '''
+    This function calculates Ripley's K function of every group and pair of groups from the pairs of cells within the largest radius, for ripleyROI().
+    Pairs are sorted by distance once, so each curve at any number of radii is a cumulative sum and a lookup.
+    The window is the bounding box of all cells; each pair is weighted by the translation edge correction |W|/|W ∩ (W + xi - xj)|.
+    Input parameters:
+        ptsArray = np array of x,y coordinates of all cells of the ROI
+        member = boolean np array (cells x groups), True where a cell belongs to a group; groups may overlap
+        pairs = np array (pairs x 2) of every pair of cells of any group within the largest radius, once (i < j)
+        radiusList = sorted list of radii, in px, 2 px = 1 µm
+    Outputs:
+        returns: kDict = dict of (group a, group b) positions, a <= b: np array of K at each radius
+    '''
+
+    import numpy as np
+
+    #window = bounding box of all cells of the ROI
+    width, height = ptsArray.max(axis=0) - ptsArray.min(axis=0) if len(ptsArray) > 0 else (0.0, 0.0)
+    area = width*height
+
+    memberCount = member.astype(np.int64)
+    counts = member.sum(axis=0)
+
+    #squared distances computed the same way as everywhere else (d^2 <= r^2), sorted once
+    diff = ptsArray[pairs[:,1]] - ptsArray[pairs[:,0]]
+    distSq = diff[:,0]**2 + diff[:,1]**2
+    order = np.argsort(distSq, kind='stable')
+    distSq = distSq[order]
+    pairs = pairs[order]
+    diff = np.abs(diff[order])
+
+    #translation edge correction; pairs as far apart as the window itself have no overlap and are left out
+    overlap = (width - diff[:,0])*(height - diff[:,1])
+    weight = np.where(overlap > 0, area/np.where(overlap > 0, overlap, 1.0), 0.0)
+
+    #number of pairs within each radius = position of the radius in the sorted distances
+    radiusPos = np.searchsorted(distSq, np.array([r**2 for r in radiusList]), side='right')
+
+    kDict = {}
+    for a in range(member.shape[1]):
+        for b in range(a, member.shape[1]):
+            #ordered pairs (cell of group a, cell of group b) each unordered pair stands for: 0, 1 or 2 (integers, as bools would add as 'or')
+            mult = memberCount[pairs[:,0],a]*memberCount[pairs[:,1],b] + memberCount[pairs[:,1],a]*memberCount[pairs[:,0],b]
+            cumWeight = np.concatenate([[0.0], np.cumsum(weight*mult)])[radiusPos]
+
+            #ordered pairs of distinct cells of the two groups
+            nPairs = counts[a]*counts[b] - (member[:,a] & member[:,b]).sum()
+            kDict[(a,b)] = area*cumWeight/nPairs if nPairs > 0 else np.full(len(radiusList), np.nan)
+
+    return kDict
+
+
+
+def ripleyCSRCheck(nCells=20000,side=4000,radiusList=[20,50,100],nROIs=4,seed=0):
+    '''
+    This function checks the K functions of ripleyFromPairs() under complete spatial randomness, where K = pi*r^2:
+    cells are placed uniformly at random and labelled with overlapping groups (one NK subtype, all NK cells) and a disjoint group (tumor cells).
+    Input parameters:
+        nCells = number of cells per simulated ROI
+        side = side of the square simulated ROIs, in px
+        radiusList = sorted list of radii, in px; should be well below side
+        nROIs = number of simulated ROIs
+        seed = seed of the random number generator
+    Outputs:
+        returns: dfCheck = df with one row per pair of groups and radius: mean, min and max of K/(pi*r^2) over the simulated ROIs, which should all be close to 1
+    '''
+
+    import numpy as np
+    import pandas as pd
+    from scipy import spatial
+
+    typeList = ['NK subtype','NK cells','Tumor cells']
+    rng = np.random.default_rng(seed)
+
+    rowList = []
+    for roi in range(nROIs):
+        ptsArray = rng.uniform(0, side, size=(nCells,2))
+        label = rng.choice(3, size=nCells, p=[0.1,0.1,0.8]) #0 = NK subtype, 1 = other NK subtype, 2 = tumor
+        member = np.stack([label == 0, label <= 1, label == 2], axis=1)
+
+        pairs = spatial.cKDTree(ptsArray).query_pairs(radiusList[-1], output_type='ndarray')
+        for (a,b),kList in ripleyFromPairs(ptsArray, member, pairs, radiusList).items():
+            for r,k in zip(radiusList, kList):
+                rowList.append({'typeA':typeList[a], 'typeB':typeList[b], 'radius':r, 'ratio':k/(np.pi*r**2)})
+
+    return pd.DataFrame(rowList).groupby(['typeA','typeB','radius'],sort=False)['ratio'].agg(['mean','min','max']).reset_index()
+
+
+
+def benchmarkNeighborBackends(sizeList=[1000,10000,100000],radius=40,density=None,path=None,csvList=None,seed=0):
+    '''
+    This function times the fixed-radius neighbor search of every cell of an ROI with scipy's KDTree, scipy's cKDTree and the grid backend
+    (gridNeighbors()) across ROI sizes, and checks that all three find the same neighbor pairs.
+    Cells are placed uniformly at random in a square at the given density, so ROI size can be varied beyond the real data.
+    Input parameters:
+        sizeList = list of numbers of cells per ROI
+        radius = radius to search for neighbors, in px, 2 px = 1 µm
+        density = cells per px^2; None measures the mean density of the ROIs in csvList (cells over the bounding box of each ROI), or uses 0.001 without them
+        path = cwd; only needed to measure the density
+        csvList = list of mIHC files to measure the density from
+        seed = seed of the random number generator
+    Outputs:
+        returns: dfBench = df with one row per ROI size and backend: number of cells, backend, seconds, number of neighbor pairs and
+            whether the pairs are the same as cKDTree's
+    '''
+
+    import time
+    import numpy as np
+    import pandas as pd
+    from scipy import spatial
+
+    if density is None and csvList is not None:
+        densList = []
+        for file in csvList:
+            pts = readROI(path, file, ['Location_Center_X','Location_Center_Y']).values.astype(np.float64)
+            densList.append(len(pts)/np.prod(pts.max(axis=0) - pts.min(axis=0)))
+        density = np.mean(densList)
+    elif density is None:
+        density = 0.001
+
+    def pairSet(rows,cols):
+        #pairs in a canonical order, to compare backends
+        order = np.lexsort((cols, rows))
+        return rows[order], cols[order]
+
+    def kdtreePairs(pts):
+        #the original approach: query_ball_point of every cell, returning a list of neighbors per cell
+        neighList = spatial.KDTree(pts).query_ball_point(pts, radius)
+        lengths = np.array([len(neigh) for neigh in neighList])
+        return np.repeat(np.arange(len(pts)), lengths), np.concatenate(neighList).astype(np.int64)
+
+    def cKDTreePairs(pts):
+        pairs = spatial.cKDTree(pts).sparse_distance_matrix(spatial.cKDTree(pts), radius, output_type='ndarray')
+        return pairs['i'].astype(np.int64), pairs['j'].astype(np.int64)
+
+    def gridPairs(pts):
+        rows, cols, _ = gridNeighbors(pts, pts, radius)
+        return rows, cols
+
+    rng = np.random.default_rng(seed)
+    rowList = []
+    for nCells in sizeList:
+        side = np.sqrt(nCells/density)
+        pts = rng.uniform(0, side, size=(nCells,2))
+
+        resultDict = {}
+        for backend,func in [('KDTree',kdtreePairs),('cKDTree',cKDTreePairs),('grid',gridPairs)]:
+            start = time.perf_counter()
+            rows, cols = func(pts)
+            seconds = time.perf_counter() - start
+            resultDict[backend] = pairSet(rows, cols)
+            rowList.append({'nCells':nCells, 'backend':backend, 'seconds':seconds, 'nPairs':len(rows)})
+
+        for row in rowList[-3:]:
+            row['sameAsCKDTree'] = all(np.array_equal(a,b) for a,b in zip(resultDict[row['backend']], resultDict['cKDTree']))
+
+    return pd.DataFrame(rowList)
+
+
+
+def startFigureExport(mode='png',nRenderers=None):
+    '''
+    This function starts queueing the plotly figures passed to exportFigure(), so that flushFigures() renders them together
+    instead of each figure paying for its own render call.
+    Input parameters:
+        mode = 'png' renders images; 'json' or 'html' saves the underlying plot data instead, without rendering
+        nRenderers = number of renderer processes to spread queued figures over; 1 renders them all through one renderer in this process;
+            None uses up to 4, as plotly before 6.1 (eg. 5.11 with orca) renders one figure at a time per renderer
+    Outputs:
+        None
+    '''
+
+    if mode not in ['png','json','html']:
+        raise ValueError("mode must be 'png', 'json' or 'html'")
+
+    exportSettings.update({'active':True, 'mode':mode, 'nRenderers':nRenderers, 'queue':[]})
+
+
+
+def exportFigure(fig,filePath):
+    '''
+    This function exports a plotly figure: queued for flushFigures() if startFigureExport() has been called, otherwise rendered now.
+    In 'json' and 'html' mode the plot data is saved right away, next to where the image would go.
+    Input parameters:
+        fig = plotly figure
+        filePath = full path of the image to save (eg. path+'/results/figures/figure3B.png')
+    Outputs:
+        Saves the figure (or queues it to be saved)
+    '''
+
+    import os
+
+    root = os.path.splitext(filePath)[0]
+
+    if exportSettings['mode'] == 'json':
+        fig.write_json(root+'.json')
+    elif exportSettings['mode'] == 'html':
+        fig.write_html(root+'.html', include_plotlyjs='cdn')
+    elif exportSettings['active']:
+        exportSettings['queue'].append((fig,filePath))
+    else:
+        fig.write_image(filePath)
+
+
+
+def renderFigures(figList,fileList):
+    '''
+    This function renders a list of plotly figures to image files through a single renderer
+    Input parameters:
+        figList = list of plotly figures, or their json (as sent to renderer processes)
+        fileList = list of full paths of the images to save, one per figure
+    Outputs:
+        Saves one image per figure
+    '''
+
+    import plotly.io as pio
+
+    figList = [pio.from_json(fig) if isinstance(fig,str) else fig for fig in figList]
+
+    if hasattr(pio,'write_images'):
+        #plotly 6.1+ renders a batch of figures in one renderer session
+        pio.write_images(figList, fileList)
+    else:
+        #older plotly renders one figure per call, keeping its renderer (orca server) running between calls in the same process
+        for fig,filePath in zip(figList,fileList):
+            fig.write_image(filePath)
+
+
+
+def flushFigures():
+    '''
+    This function renders every figure queued by exportFigure() and stops queueing
+    Input parameters:
+        None
+    Outputs:
+        returns: nFigs = number of figures rendered
+        Saves one image per queued figure
+    '''
+
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    queue = exportSettings['queue']
+    nRenderers = exportSettings['nRenderers']
+    exportSettings.update({'active':False, 'mode':'png', 'queue':[]})
+
+    if len(queue) == 0:
+        return 0
+
+    #by default a few renderers; each costs a process and a renderer start-up, so not one per core
+    if nRenderers is None:
+        nRenderers = min(4, os.cpu_count() or 1)
+
+    figList = [fig for fig,filePath in queue]
+    fileList = [filePath for fig,filePath in queue]
+
+    if nRenderers == 1 or len(queue) == 1:
+        renderFigures(figList, fileList)
+    else:
+        #split the figures over a few processes, each starting its renderer once
+        nRenderers = min(nRenderers,len(queue))
+        with ProcessPoolExecutor(max_workers=nRenderers, mp_context=getPoolContext()) as executor:
+            list(executor.map(renderFigures, [[fig.to_json() for fig in figList[i::nRenderers]] for i in range(nRenderers)], [fileList[i::nRenderers] for i in range(nRenderers)]))
+
+    return len(queue)
+
+
+
+def getPipeline(path,csvList,nProcs=None,graphRadius=120,assignNew=False):
+    '''
+    This function lays out all analyses as a graph of stages; each stage lists the stages whose outputs it reads.
+    Stages that generate dfs run in the background, stages that plot figures (and print their statistics) run in the order listed.
+    Background stages are runMemoized() stages, called with a log list their messages are added to. Stages given nProcs spread ROIs over processes.
+    Each figure has a header stage and a stage named after the figure (eg. 'figure3') that depends on all of its plots.
+    Input parameters:
+        path = cwd
+        csvList = list of mIHC files to include in analyses
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = radius of the cached per-ROI neighbor graph; None queries a kdtree instead
+        assignNew = if True and a neighborhood clustering model has been saved, ROIs not in the neighborhood table yet are added to it and assigned
+            to the saved clusters by assignNeighborhoods(), instead of recalculating the table; cluster ids then stay the same as ROIs are added
+    Outputs:
+        returns: stageDict = dict of stage name:(function to run the stage, list of stages it depends on, True if it plots)
+    '''
+
+    import os
+    from functools import partial
+
+    stageDict = {}
+
+    #FIGURE 3 - NK cell function versus spatial proximity to neoplastic cells
+    stageDict['figure3Header'] = (partial(print,'\n\n***FIGURE 3 - NK cell function versus spatial proximity to neoplastic cells and HER2 status***\n'),[],True)
+    distThresh = 40 #40 px = 20 µm
+    stageDict['nkFunTumSpatial'] = (partial(runMemoized,path,nkFunTumSpatial,outputs=['results/dfCreated/dfNKFun_TumorSpatial_all'+str(distThresh)+'.csv'],inputs=['data/metadata/clinicalData.csv'],
+                                            csvList=csvList,distThresh=distThresh,nProcs=nProcs,graphRadius=graphRadius),[],False)
+    stageDict['figure3A'] = (partial(fig3A,path),[],True)
+    stageDict['figure3B'] = (partial(fig3B,path),['nkFunTumSpatial'],True)
+    stageDict['figure3CD'] = (partial(fig3CD,path),['nkFunTumSpatial'],True)
+    stageDict['figureS5'] = (partial(figS5,path),['nkFunTumSpatial'],True)
+    stageDict['figure3'] = (partial(print,"Figures 3A-D and Supplementary Figures S5A-C saved to 'figures' folder.\nFigure 3 complete."),['figure3Header','figure3A','figure3B','figure3CD','figureS5'],True)
+
+    #FIGURE 4 - neoplastic cell function versus spatial proximity to NK cells
+    stageDict['figure4Header'] = (partial(print,'\n\n***FIGURE 4 - Neoplastic cell function versus spatial proximity to NK cells and HER2 status***\n'),[],True)
+    distThresh = 40 #40 px = 20 µm
+    stageDict['tumorFunNKspatial'] = (partial(runMemoized,path,tumorFunNKspatial,outputs=['results/dfCreated/dfTumorFun_NKspatial_all'+str(distThresh)+'.csv'],inputs=['data/metadata/clinicalData.csv'],
+                                              csvList=csvList,distThresh=distThresh,nProcs=nProcs,graphRadius=graphRadius),[],False)
+    stageDict['figure4C'] = (partial(fig4C,path),['tumorFunNKspatial'],True)
+    stageDict['figure4DE'] = (partial(fig4DE,path),['tumorFunNKspatial'],True)
+    stageDict['figure4'] = (partial(print,"Figures 4C-E saved to 'figures' folder.\nFigure 4 complete."),['figure4Header','figure4C','figure4DE'],True)
+
+    #FIGURE 5 - NK cell neighborhoods
+    stageDict['figure5Header'] = (partial(print,'\n\n***FIGURE 5 - NK spatial cell neighborhoods versus HER2 status***\n'),[],True)
+    seedList = ['CD56- NKP46+ NK','CD56+ NKP46- NK','CD56+ NKP46+ NK']
+    distThresh = 120 #120px = 60µm
+    k = 5 #from elbowMethod analysis below
+    if assignNew and os.path.exists(path+'/results/dfCreated/dfNeighClusteredNK'+str(distThresh)+'k'+str(k)+'_model.json'):
+        stageDict['makeNeighborhoods'] = (partial(runMemoized,path,assignNeighborhoods,outputs=['results/dfCreated/dfNeighborhoodClusterNK'+str(distThresh),'results/dfCreated/dfNeighClusteredNK'+str(distThresh)+'k'+str(k)+'.csv'],
+                                                  inputs=['results/dfCreated/dfNeighClusteredNK'+str(distThresh)+'k'+str(k)+'_model.json'],
+                                                  csvList=csvList,seedList=seedList,distThresh=distThresh,k=k,nProcs=nProcs,graphRadius=graphRadius),[],False)
+    else:
+        stageDict['makeNeighborhoods'] = (partial(runMemoized,path,makeNeighborhoods,outputs=['results/dfCreated/dfNeighborhoodClusterNK'+str(distThresh)],
+                                                  csvList=csvList,seedList=seedList,distThresh=distThresh,nProcs=nProcs,graphRadius=graphRadius,fmt='parquet'),[],False)
+
+    #run elbow method to determine optimal number of clusters
+    #note that results are not shown in manuscript, so need to manually adjust save parameter
+    steps = 16
+    file = 'dfNeighborhoodClusterNK120'
+    save = False #toggle to True if saving elbow plot is desired
+    stageDict['elbowMethod'] = (partial(runMemoized,path,elbowMethod,outputs=['results/dfCreated/dfElbow'+file[21:]+'.csv']+(['results/figures/figure5_elbow_plot.png'] if save else []),inputs=['results/dfCreated/'+file],
+                                        file=file,steps=steps,save=save,nProcs=nProcs),['makeNeighborhoods'],False)
+    stageDict['elbowReport'] = (partial(reportElbow,path,'dfElbow'+file[21:]),['elbowMethod'],True)
+    #note: from elbowMethod analysis, k=5 is determined
+
+    #cluster neighborhoods by cell compositions; with assignNew, the saved model is kept if the table has only had ROIs added since it was fitted
+    stageDict['clusterNeighborhoods'] = (partial(runMemoized,path,clusterNeighborhoods,outputs=['results/dfCreated/dfNeighClustered'+file[21:]+'k'+str(k)+'.csv','results/dfCreated/dfNeighClustered'+file[21:]+'k'+str(k)+'_model.json'],inputs=['results/dfCreated/'+file],
+                                                 file=file,k=k,assign=assignNew),['makeNeighborhoods'],False)
+    stageDict['figure5B'] = (partial(fig5B,path),['clusterNeighborhoods'],True)
+
+    #generate new mIHC csvs with cluster annotation for all NK cells
+    file = 'dfNeighClusteredNK120k5' #120px = 60µm
+    stageDict['createCsvsWithClusterCol'] = (partial(runMemoized,path,createCsvsWithClusterCol,outputs=['results/dfCreated/updatedCsvs/'+roi+'_cluster_'+file[16:]+'.csv' for roi in ['D16_BB2014A_ROI01','M27_TT1120A_ROI02']],
+                                                     inputs=['results/dfCreated/'+file+'.csv','data/mIHC_files/D16_BB2014A_ROI01.csv','data/mIHC_files/M27_TT1120A_ROI02.csv'],
+                                                     name=file),['clusterNeighborhoods'],False)
+    stageDict['figure5C'] = (partial(fig5C,path),['createCsvsWithClusterCol'],True)
+
+    #calculate counts of each cluster assignment
+    stageDict['clusterCountPerROI'] = (partial(runMemoized,path,clusterCountPerROI,outputs=['results/dfCreated/dfClustCounts'+file[16:]+'_all.csv','results/dfCreated/dfClustCounts'+file[16:]+'_avg.csv','results/dfCreated/dfClustRollup'+file[16:]+'.csv'],
+                                               inputs=['results/dfCreated/'+file+'.csv','data/metadata/clinicalData.csv'],
+                                               name=file),['clusterNeighborhoods'],False)
+    stageDict['figureS7A'] = (partial(figS7A,path),['clusterCountPerROI'],True)
+    stageDict['figure5DE'] = (partial(fig5DE,path),['clusterCountPerROI'],True)
+    stageDict['figureS7B'] = (partial(figS7B,path),['clusterCountPerROI'],True)
+    stageDict['figure5F'] = (partial(fig5F,path),['clusterCountPerROI'],True)
+    stageDict['figureS7C'] = (partial(figS7C,path),['clusterCountPerROI'],True)
+    stageDict['figure5'] = (partial(print,"Figures 5B-F and Supplementary Figures S7A-C saved to 'figures' folder.\nFigure 5 complete."),
+                            ['figure5Header','elbowReport','figure5B','figure5C','figureS7A','figure5DE','figureS7B','figure5F','figureS7C'],True)
+
+    return stageDict
+
+
+
+def runPipeline(targets=None,nProcs=None,graphRadius=120,maxWorkers=3,exportMode='png',nRenderers=None,assignNew=False):
+    '''
+    This function runs the stages needed for a set of target stages (eg. only 'figure5F'), running independent stages concurrently,
+    then reports the critical path - the chain of dependent stages that bounds the wall-clock time.
+    Background stages run on a pool of threads; plotting stages run on this thread in the order listed by getPipeline(),
+    so printed statistics appear in the same order on every run and plotting libraries are only used from one thread.
+    Messages of background stages are printed from this thread too, once the stage is done.
+    Stages that spread ROIs over processes run one at a time, so a run never starts more than nProcs processes at once.
+    Input parameters:
+        targets = list of stage names from getPipeline() to produce; None runs all stages
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = radius of the cached per-ROI neighbor graph; None queries a kdtree instead
+        maxWorkers = maximum number of background stages to run at the same time
+        exportMode = 'png' renders plotly figures, queued and rendered together at the end; 'json' or 'html' saves their plot data without rendering
+        nRenderers = number of renderer processes to render the queued figures with; None uses up to 4, see startFigureExport()
+        assignNew = if True, new ROIs are assigned to the saved neighborhood clusters instead of reclustering; see getPipeline()
+    Outputs:
+        returns: dfTimes = df of the start, end and duration (in seconds) of each stage run, indexed by stage name
+        Saves the outputs of each stage run
+    '''
+
+    import os
+    import time
+    import threading
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    #get current working directory
+    path = os.getcwd()
+
+    #get csvList
+    csvList = getCsvList()
+
+    stageDict = getPipeline(path,csvList,nProcs=nProcs,graphRadius=graphRadius,assignNew=assignNew)
+
+    if targets is None:
+        targets = list(stageDict.keys())
+
+    #find all stages the targets depend on
+    needed = set()
+    toVisit = list(targets)
+    while len(toVisit) > 0:
+        stage = toVisit.pop()
+        if stage not in stageDict:
+            raise ValueError('Unknown stage: '+stage+'. Stages are: '+', '.join(stageDict.keys()))
+        if stage not in needed:
+            needed.add(stage)
+            toVisit.extend(stageDict[stage][1])
+
+    #keep the order of getPipeline(), in which every stage comes after the stages it depends on
+    stageList = [stage for stage in stageDict if stage in needed]
+    plotList = [stage for stage in stageList if stageDict[stage][2]]
+
+    def timeStage(func):
+        start = time.perf_counter()
+        func()
+        return (start,time.perf_counter())
+
+    #held by a background stage while it uses processes, so stages running at the same time do not each start nProcs of them
+    processLock = threading.Lock()
+
+    def runBackground(func):
+        log = []
+        if 'nProcs' in func.keywords:
+            with processLock:
+                times = timeStage(lambda: func(log=log))
+        else:
+            times = timeStage(lambda: func(log=log))
+        return times,log
+
+    timeDict = {} #stage name:(start,end)
+    futureDict = {} #stage name:future of a background stage
+
+    #queue plotly figures and render them together once all stages are done, unless a caller is already queueing them
+    export = not exportSettings['active']
+    if export:
+        startFigureExport(mode=exportMode,nRenderers=nRenderers)
+
+    try:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            while len(timeDict) < len(stageList):
+
+                #start every background stage whose dependencies are done
+                for stage in stageList:
+                    func,deps,isPlot = stageDict[stage]
+                    if not isPlot and stage not in futureDict and all([d in timeDict for d in deps]):
+                        futureDict[stage] = executor.submit(runBackground,func)
+
+                #run the next plotting stage here once its dependencies are done
+                nextPlot = [stage for stage in plotList if stage not in timeDict][:1]
+                if len(nextPlot) > 0 and all([d in timeDict for d in stageDict[nextPlot[0]][1]]):
+                    timeDict[nextPlot[0]] = timeStage(stageDict[nextPlot[0]][0])
+                    continue
+
+                #otherwise wait for a background stage to finish
+                running = [future for stage,future in futureDict.items() if stage not in timeDict]
+                doneSet = wait(running,return_when=FIRST_COMPLETED)[0]
+                for stage,future in futureDict.items():
+                    if future in doneSet:
+                        timeDict[stage],log = future.result()
+                        for message in log:
+                            print(message)
+    finally:
+        if export:
+            start = time.perf_counter()
+            nFigs = flushFigures()
+            if nFigs > 0:
+                print('\nRendered',nFigs,'figures in',round(time.perf_counter()-start,1),'s')
+
+    dfTimes = pd.DataFrame.from_dict(timeDict,orient='index',columns=['start','end'])
+    dfTimes = dfTimes.loc[stageList]
+    dfTimes[['start','end']] = dfTimes[['start','end']] - dfTimes['start'].min()
+    dfTimes['duration'] = dfTimes['end'] - dfTimes['start']
+
+    #critical path - the longest chain of dependent stages by total duration
+    finishDict = {} #stage name:(total duration of the longest chain ending at this stage, previous stage in that chain)
+    for stage in stageList:
+        deps = stageDict[stage][1]
+        prev = max(deps,key=lambda d: finishDict[d][0]) if len(deps) > 0 else None
+        finishDict[stage] = (dfTimes.at[stage,'duration'] + (finishDict[prev][0] if prev is not None else 0),prev)
+
+    stage = max(stageList,key=lambda s: finishDict[s][0])
+    pathLength = finishDict[stage][0]
+    criticalPath = []
+    while stage is not None:
+        criticalPath.insert(0,stage)
+        stage = finishDict[stage][1]
+
+    print('\nCritical path: '+' -> '.join([s+' ('+str(round(dfTimes.at[s,'duration'],1))+' s)' for s in criticalPath]))
+    print('Critical path length:',round(pathLength,1),'s; wall-clock time:',round(dfTimes['end'].max(),1),'s')
+
+    return dfTimes
+
+
+
+def fig3(nProcs=None,graphRadius=120):
+    '''
+    Single cell analysis of NK cells results in distinct phenotypes related to the proximity to tumor cells and HER2 status.
+    This function creates figures 3A-D and supplementary figures S5A-C.
+    Input parameters:
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = radius of the cached per-ROI neighbor graph; 120 px is the largest radius used in figures 3-5, so one graph per ROI serves all of them; None queries a kdtree instead
+    Outputs:
+        Saves plots to 'figures' folder for figures 3A-D and supplementary figures S5A-C
+    '''
+
+    #the figure's stages print its header and completion lines
+    runPipeline(targets=['figure3'],nProcs=nProcs,graphRadius=graphRadius)
+
+
+
+def fig3A(path):
+    '''
+    This function creates figure 3A: tumor and NK cells of one ROI.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for figure 3A
+    '''
+
+    import plotly.express as px
+    import numpy as np
+
+    file = 'D16_BB2014A_ROI01'
+    colorDict = {'Tumor Cells':'rgb(153,153,153)','NK Cells':'rgb(231,41,138)'}
+
+    #read specific ROI mIHC csv
+    df = readROI(path, file, ['class','Location_Center_X','Location_Center_Y'])
+
+    #subset to just tumor and NK
+    df = df[df['class'].isin(['Tumor cells','CD56- NKP46+ NK','CD56+ NKP46+ NK','CD56+ NKP46- NK'])]
+    df['Cell Type'] = np.where(df['class'] == 'Tumor cells','Tumor Cells','NK Cells')
+
+    #plot and save
+    fig = px.scatter(df,x='Location_Center_X',y='Location_Center_Y',color='Cell Type',category_orders={'Cell Type':['Tumor Cells','NK Cells']},color_discrete_map=colorDict)
+    exportFigure(fig,path+'/results/figures/figure3A.png')
+
+
+
+def fig3B(path):
+    '''
+    This function creates figure 3B: NK cell function close to vs far from neoplastic cells, and prints its statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for figure 3B
+    '''
+
+    import plotly.express as px
+    import numpy as np
+    from scipy.stats import mannwhitneyu
+    from statsmodels.stats.multitest import fdrcorrection
+
     #read csv generated and plot
     colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}
-    df = pd.read_csv(path+'/results/dfCreated/dfNKFun_TumorSpatial_all40.csv',index_col=0)
-    
+    df = loadResult(path,'dfNKFun_TumorSpatial_all40')
+
     #NOTE: manually change D2_TN1233A patient's PD-1 value to NA - staining was off
     #loc value of 42 and 97 correspond to this patient - .at modifies df - NOTE: these row numbers change if you adjust csvList order
     df.at[42,'PD1'] = np.nan
     df.at[97,'PD1'] = np.nan
-    
+
     #plot close vs far
     fig = px.box(df,y=df.columns[:-4],color='Location',range_y=(-2,102),hover_name='Patient',points='all',color_discrete_map=colorDict,labels={'value':'Percent NK Cells Positive','variable':'Functional Marker'})
-    fig.write_image(path+'/results/figures/figure3B.png')
-    
+    exportFigure(fig,path+'/results/figures/figure3B.png')
+
     #now run stats on this - Mann-Whitney U + MHT correction
     dfClose = df[df['Location'] == 'close']
     dfFar = df[df['Location'] == 'far']
-    
+
     colList = df.columns[:-4]
     pList = []
-    
+
     #mann-whitney u test
     for col in colList:
         pVal = mannwhitneyu(dfClose[col],dfFar[col]).pvalue
         pList.append(pVal)
-    
+
     #then correct for MHT - Benjamini-Hochberg
     mhtList = fdrcorrection(pList,alpha=0.05)[1]
     print('\nMHT-corrected P-values for Figure 3B:')
     for i in range(len(mhtList)):
         col = colList[i]
         mhtP = mhtList[i]
-        print(col+': p =',round(mhtP,3)) 
+        print(col+': p =',round(mhtP,3))
 
 
-    #FIGURE 3C,D
+
+def fig3CD(path):
+    '''
+    This function creates figures 3C,D: NK cell function close to vs far from neoplastic cells by HER2 status, and prints their statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plots to 'figures' folder for figures 3C,D
+    '''
+
+    import plotly.express as px
+    import numpy as np
+    from scipy.stats import mannwhitneyu
+    from statsmodels.stats.multitest import fdrcorrection
+
     #read in file again
-    dfFun = pd.read_csv(path+'/results/dfCreated/dfNKFun_TumorSpatial_all40.csv',index_col=0)
-    
+    dfFun = loadResult(path,'dfNKFun_TumorSpatial_all40')
+
     colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}
-    
+
     #subset HER2+/-
     dfFunNeg = dfFun[dfFun['HER2'] == 0]
     dfFunPos = dfFun[dfFun['HER2'] == 1]
-    
+
     dfList = [dfFunNeg,dfFunPos] #first is her2-, then her2+
     titleDict = {0:'HER2-',1:'HER2+'} #for axis naming
     figDict = {0:'Figure 3C',1:'Figure 3D'} #for p-value printing
-    
+
     #loop through her2 status - first fig 3C then fig 3D
     for i in range(len(dfList)):
-        
+
         df = dfList[i]
         figNum = figDict[i][-1]
-        
+
         #NOTE: manually change D2_TN1233A patient's PD-1 value to NA - staining was off
         if i == 1: #this patient is a her2+ patient
             #loc value of 42 and 97 correspond to this patient - .at modifies df - NOTE: the row numbers change if csvList ordering differs
             df.at[42,'PD1'] = np.nan
             df.at[97,'PD1'] = np.nan
-        
+
         fig = px.box(df,y=['KI67','TIM3','PD1'],color='Location',width=500,range_y=[-2,102],points='all',color_discrete_map=colorDict,labels={'value':'Percent NK Cells Positive','variable':titleDict[i]})
-        fig.write_image(path+'/results/figures/figure3'+figNum+'.png')
-    
+        exportFigure(fig,path+'/results/figures/figure3'+figNum+'.png')
+
         #do stats - for her2+ and then her2- separately
         pList = []
-        
+
         for m in ['KI67','TIM3','PD1']:
-            
+
             #subset by location for each marker
             dfClose = df[df['Location'] == 'close'][m]
             dfFar = df[df['Location'] == 'far'][m]
             #mann-whitney u for the 3 markers
             pVal = mannwhitneyu(dfClose,dfFar).pvalue
             pList.append(pVal)
-       
+
         #correct for MHT - Benjamini-Hochberg
         mhtList = fdrcorrection(pList,alpha=0.05)[1]
         print('\nMHT corrected P-values for '+figDict[i]+':')
@@ -979,403 +3897,481 @@ def fig3():
         print('TIM3: p =',round(mhtTim3,3))
         print('PD1: p =',round(mhtPd1,3))
 
-    
-    #SUPPLEMENTARY FIGURES S5A-C
+
+
+def figS5(path):
+    '''
+    This function creates supplementary figures S5A-C: total NK cells close to and far from neoplastic cells per patient.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plots to 'figures' folder for supplementary figures S5A-C
+    '''
+
+    import plotly.express as px
+
     #reread file
-    dfFun = pd.read_csv(path+'/results/dfCreated/dfNKFun_TumorSpatial_all40.csv',index_col=0)
+    dfFun = loadResult(path,'dfNKFun_TumorSpatial_all40')
     dfFun['Cohort'] = dfFun['Patient'].str[0]
     dfFun['Cohort_HER2'] = dfFun['Cohort']+'_'+dfFun['HER2'].astype(str)
-    
+
+    colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}
     figDict = {'D_0':'A','D_1':'B','M_1':'C'}
-    
+
     for ch in ['D_0','D_1','M_1']:
         #subset to that cohort_her2 group
         dfCH = dfFun[dfFun['Cohort_HER2'] == ch]
         figNum = figDict[ch]
         fig = px.bar(dfCH,x='Patient',y='Total NK Cells',color='Location',barmode='stack',color_discrete_map=colorDict)
-        fig.write_image(path+'/results/figures/figureS5'+figNum+'.png')
+        exportFigure(fig,path+'/results/figures/figureS5'+figNum+'.png')
+
 
-    print("Figures 3A-D and Supplementary Figures S5A-C saved to 'figures' folder.")
-    print('Figure 3 complete.')
-      
-    
 
-def fig4():
+def fig4(nProcs=None,graphRadius=120):
     '''
     Single cell analysis of neoplastic PanCK+ epithelial cells illustrates heterogeneity and high HLA class I expression in close proximity to NK cells.
     This function creates figures 4C-E.
     Input parameters:
-        None  
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = radius of the cached per-ROI neighbor graph; 120 px is the largest radius used in figures 3-5, so one graph per ROI serves all of them; None queries a kdtree instead
     Outputs:
         Saves plots to 'figures' folder for figures 4C-E
     '''
-    
-    import os
+
+    #the figure's stages print its header and completion lines
+    runPipeline(targets=['figure4'],nProcs=nProcs,graphRadius=graphRadius)
+
+
+
+def fig4C(path):
+    '''
+    This function creates figure 4C: neoplastic cell function close to vs far from NK cells, and prints its statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for figure 4C
+    '''
+
     import plotly.express as px
-    import pandas as pd
     from scipy.stats import mannwhitneyu
     from statsmodels.stats.multitest import fdrcorrection
 
-    print('\n\n***FIGURE 4 - Neoplastic cell function versus spatial proximity to NK cells and HER2 status***\n')
-
-    #get current working directory
-    path = os.getcwd()
-    
-    #get csvList
-    csvList = getCsvList()
-    
-    #FIGURE 4C
-    distThresh = 40 #40 px = 20 µm
-    #generate csv storing NK cell function and spatial relationship to neoplastic cells
-    tumorFunNKspatial(path=path,csvList=csvList,distThresh=distThresh)
-
     #read csv generated and plot
-    colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}    
-    df = pd.read_csv(path+'/results/dfCreated/dfTumorFun_NKspatial_all40.csv',index_col=0)
-    
+    colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}
+    df = loadResult(path,'dfTumorFun_NKspatial_all40')
+
     #plot close vs far
     fig = px.box(df,y=df.columns[:-4],color='Location',range_y=(-2,102),points='all',color_discrete_map=colorDict,labels={'value':'Percent Tumor Cells Positive','variable':'Functional Marker'})
-    fig.write_image(path+'/results/figures/figure4C.png')
-    
+    exportFigure(fig,path+'/results/figures/figure4C.png')
+
     #now run stats on this - Mann Whitney U
     dfClose = df[df['Location'] == 'close']
     dfFar = df[df['Location'] == 'far']
-    
+
     #reset with each cohort
     pList = []
     colList = df.columns[:-4]
-    
+
     for col in colList:
         pVal = mannwhitneyu(dfClose[col],dfFar[col]).pvalue
         pList.append(pVal)
-    
+
     #correct for MHT - Benjamini-Hochberg
     mhtList = fdrcorrection(pList,alpha=0.05)[1]
     print('\nMHT corrected P-values for Figure 4C:')
     for i in range(len(mhtList)):
         col = colList[i]
         mhtP = mhtList[i]
-        print(col+': p =',round(mhtP,3))        
-    
-    
-    #FIGURE 4D, E
-    #read file again    
-    dfFun = pd.read_csv(path+'/results/dfCreated/dfTumorFun_NKspatial_all40.csv',index_col=0)
-    
+        print(col+': p =',round(mhtP,3))
+
+
+
+def fig4DE(path):
+    '''
+    This function creates figures 4D,E: neoplastic cell HLA class I close to vs far from NK cells by HER2 status, and prints their statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plots to 'figures' folder for figures 4D,E
+    '''
+
+    import plotly.express as px
+    from scipy.stats import mannwhitneyu
+
+    #read file again
+    dfFun = loadResult(path,'dfTumorFun_NKspatial_all40')
+
     colorDict = {'close':'rgb(17,165,121)','far':'rgb(127,60,141)'}
-    
+
     #subset HER2+/-
     dfFunNeg = dfFun[dfFun['HER2'] == 0]
     dfFunPos = dfFun[dfFun['HER2'] == 1]
-    
+
     dfList = [dfFunNeg,dfFunPos] #first is her2-, then her2+
     titleDict = {0:'HER2-',1:'HER2+'} #for axis naming
     figDict = {0:'Figure 4D',1:'Figure 4E'} #for p-value printing
-    
+
     #loop through her2 status
     for i in range(len(dfList)):
-        
+
         df = dfList[i]
         figNum = figDict[i][-1]
-        
+
         fig = px.box(df,y=['HLA1'],color='Location',points='all',range_y=[-2,102],width=300,height=400,color_discrete_map=colorDict,labels={'value':'Percent Tumor Cells Positive','variable':titleDict[i]})
-        fig.write_image(path+'/results/figures/figure4'+figNum+'.png')
-    
+        exportFigure(fig,path+'/results/figures/figure4'+figNum+'.png')
+
         #do stats - for her2+ and then her2- separately
         #subset by location for each marker
         dfClose = df[df['Location'] == 'close']['HLA1']
         dfFar = df[df['Location'] == 'far']['HLA1']
-    
+
         pVal = mannwhitneyu(dfClose,dfFar).pvalue
-    
+
         #print her2 status, marker, p value
         print('P-value for '+figDict[i]+':')
         print('HLA1: p =',round(pVal,3))
 
-    print("Figures 4C-E saved to 'figures' folder.")
-    print('Figure 4 complete.')        
-        
 
 
-def fig5():
+def fig5(nProcs=None,graphRadius=120):
     '''
     Cellular neighborhood clustering of NK cells.
-    This function creates figures 5B-F and supplementary figures S7A-C. 
+    This function creates figures 5B-F and supplementary figures S7A-C.
     Input parameters:
-        None  
+        nProcs = number of processes to spread ROIs over; 1 runs serially, None uses all cores
+        graphRadius = radius of the cached per-ROI neighbor graph; 120 px is the largest radius used in figures 3-5, so one graph per ROI serves all of them; None queries a kdtree instead
     Outputs:
         Saves plots to 'figures' folder for figures 5B-F and supplementary figures S7A-C
     '''
 
-    import os
-    import pandas as pd
-    import plotly
-    import plotly.express as px
-    from seaborn import regplot
-    from matplotlib import pyplot as plt
-    from scipy.stats import mannwhitneyu
-    from statsmodels.stats.multitest import fdrcorrection
+    #the figure's stages print its header and completion lines
+    runPipeline(targets=['figure5'],nProcs=nProcs,graphRadius=graphRadius)
+    print('\nALL ANALYSES COMPLETE.\n')
 
-    print('\n\n***FIGURE 5 - NK spatial cell neighborhoods versus HER2 status***\n')
 
-    #get current working directory
-    path = os.getcwd()
-    
-    #get csvList
-    csvList = getCsvList()
 
-    #generate neighborhoods of NK cells
-    seedList = ['CD56- NKP46+ NK','CD56+ NKP46- NK','CD56+ NKP46+ NK']
-    distThresh = 120 #120px = 60µm
-    #make neighborhoods
-    makeNeighborhoods(path=path,csvList=csvList,seedList=seedList,distThresh=distThresh)    
-    
-    #run elbow method to determine optimal number of clusters
-    #note that results are not shown in manuscript, so need to manually adjust save parameter
-    steps = 16    
-    file = 'dfNeighborhoodClusterNK120'
-    save = False #toggle to True if saving elbow plot is desired
-    elbowMethod(path=path,file=file,steps=steps,save=save)
-    #note: from elbowMethod analysis, k=5 is determined
-    
-    #cluster neighborhoods by cell compositions
-    k = 5
-    clusterNeighborhoods(path=path,file=file,k=k)
+def reportElbow(path,name):
+    '''
+    This function prints the elbow detected by elbowMethod(), next to the number of clusters used for figure 5
+    Input parameters:
+        path = cwd
+        name = name of the elbow csv saved by elbowMethod(), excluding the .csv
+    Outputs:
+        None
+    '''
+
+    dfWCSS = loadResult(path,name)
+    elbow = dfWCSS.loc[dfWCSS['elbow'] == 1,'k'].iloc[0]
+
+    print('\nElbow method: detected elbow at k =',elbow,'(figure 5 uses k = 5)')
+
+
+
+def fig5B(path):
+    '''
+    This function creates figure 5B: average cellular composition of each neighborhood cluster.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for figure 5B
+    '''
+
+    import plotly
+    import plotly.express as px
 
-    #FIGURE 5B    
     file = 'dfNeighClusteredNK120k5' #120px = 60µm
-    
+
     #read clustered csv generated above
-    df = pd.read_csv(path+'/results/dfCreated/'+file+'.csv', index_col=0)
-    
+    df = loadResult(path,file)
+
     #filter df to not include the index or file columns
     df = df.drop(['index','file'],axis=1)
-    
+
     #groupby cluster column and take the averages of all of the other columns for each group
     dfCluster = df.groupby(['cluster']).mean()
-    
+
     #reorder columns
     colList = ["countCD8 T cells%", "countCD4 T cells%", "countCD56+ NKP46+ NK%",'countCD56- NKP46+ NK%','countCD56+ NKP46- NK%','countCD11B+ DCs%','countCD11B- DCs%','countCD11B- CD68+ cells%','countMyelomonocytic cells%','countMyeloid other%','countOther CD45+ cells%','countTumor cells%']
     dfCluster = dfCluster[colList]
-    
+
     #rename index clusters to start at 1 rather than 0
     #rename clusters to be order we want- 1 = cd8, 2 = cd4, 3 = other cd45, 4 = tumor/immune, 5 = tumor
     dfCluster = dfCluster.rename(index={0:'1',1:'4',2:'2',3:'5',4:'3'}).sort_values('cluster')
-    
+
     #colors for cell types
     palette = dict(zip(colList,plotly.colors.qualitative.Pastel))
     palette['countTumor cells%'] = 'rgb(239,85,59)'
-    
+
     fig = px.bar(dfCluster,y=dfCluster.columns,barmode='stack',labels={'cluster':'Cluster','value':'Fraction Present'},color_discrete_map=palette)
     fig.update_layout(legend_traceorder="reversed")
-    fig.write_image(path+'/results/figures/figure5B.png')
-    
-    #FIGURE 5C
-    #generate new mIHC csvs with cluster annotation for all NK cells
-    createCsvsWithClusterCol(path=path,name=file)
-    
-    #visualize cells in scatterplot for 2 ROIs  
+    exportFigure(fig,path+'/results/figures/figure5B.png')
+
+
+
+def fig5C(path):
+    '''
+    This function creates figure 5C: NK cells of two ROIs colored by neighborhood cluster.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plots to 'figures' folder for figure 5C
+    '''
+
+    import plotly.express as px
+
+    #visualize cells in scatterplot for 2 ROIs
     colList = ['Tumor cells','1','2','3','4','5']
-    
+
     #color map
     palette = {'1':'dodgerblue','2':'magenta','3':'limegreen','4':'darkviolet','5':'coral','Tumor cells':'rgb(153,153,153)','CD8 T cells':'rgb(102,197,204)','CD4 T cells':'rgb(246,207,113)'}
-    
+
     def sorter(column):
         """Sort function"""
         colList = ['Tumor cells','CD8 T cells','CD4 T cells','1','2','3','4','5']
         sortDict = {col: order for order, col in enumerate(colList)}
         return column.map(sortDict)
-    
+
     roiList = ['D16_BB2014A_ROI01','M27_TT1120A_ROI02']
     for roi in roiList:
         file = roi+'_cluster_NK120k5'
-    
+
         #read updated csv with cluster number added
-        df = pd.read_csv(path+'/results/dfCreated/updatedCsvs/'+file+'.csv',index_col=0)
-    
+        df = loadResult(path,'updatedCsvs/'+file)
+
         df['cluster'] = df['cluster'].replace({'0.0':'1','1.0':'4','2.0':'2','3.0':'5','4.0':'3'})
-    
+
         #only show tumor and NK cell clusters
         df = df[df['cluster'].isin(colList)]
         df = df.sort_values(by='cluster', key=sorter)
-    
+
         #plot scatter reconstructions
         fig = px.scatter(df,x='Location_Center_X',y='Location_Center_Y',color='cluster',color_discrete_map=palette,title='Specimen '+roi[0:3])
         fig.update_traces(marker={'size': 7})
-        fig.write_image(path+'/results/figures/figure5C_'+roi[0:3]+'.png')
-        
-    #SUPPLEMENTARY FIGURE S7A
-    name = 'dfNeighClusteredNK120k5'
-    #calculate counts of each cluster assignment
-    clusterCountPerROI(path=path,name=name)    
-    
-    #get df from saved csv
-    df = pd.read_csv(path+'/results/dfCreated/dfClustCountsNK120k5_all.csv',index_col=0)
-    
+        exportFigure(fig,path+'/results/figures/figure5C_'+roi[0:3]+'.png')
+
+
+
+def figS7A(path):
+    '''
+    This function creates supplementary figure S7A: percent of all NK cell neighborhoods in each cluster.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for supplementary figure S7A
+    '''
+
+    import pandas as pd
+    import plotly.express as px
+
+    #get the counts summed over all ROIs from the saved rollup
+    df = queryRollup(path,'dfClustRollupNK120k5','all')
+    total = df['Total'].iloc[0]
+
     #manually rename clusters to match ordering set earlier
     df = df.rename(columns={'0':'1','1':'4','2':'2','3':'5','4':'3'})
     df = df[['1','2','3','4','5']] #reorder columns from 1-5
-    sums = df.sum(axis=0)
-    total = df.to_numpy().sum()
     dfPerc = pd.DataFrame(index=['1','2','3','4','5'])
-    dfPerc['Raw'] = sums.values
+    dfPerc['Raw'] = df.to_numpy()[0]
     dfPerc['Perc'] = dfPerc['Raw']/total*100 #% out of 100s
-    
+
     fig = px.bar(dfPerc,y='Perc',labels={'index':'Cluster','Perc':'Percent of NK Cell Neighborhood Clusters Present'})
-    fig.write_image(path+'/results/figures/figureS7A.png')
-    
-    #FIGURES 5D, E
-    #get df from saved csv
-    df = pd.read_csv(path+'/results/dfCreated/dfClustCountsNK120k5_avg.csv',index_col=0)
-    
+    exportFigure(fig,path+'/results/figures/figureS7A.png')
+
+
+
+def fig5DE(path):
+    '''
+    This function creates figures 5D,E: cluster composition per specimen, and the correlation of T cell clusters with the tumor cluster.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plots to 'figures' folder for figures 5D,E
+    '''
+
+    import plotly.express as px
+    from seaborn import regplot
+    from matplotlib import pyplot as plt
+
+    #get the patient level of the saved rollup
+    df = queryRollup(path,'dfClustRollupNK120k5','patient')
+
     #generate column list to cluster on based on if there is a % in the column name
     dfPerc = df[df.columns[['%' in col for col in list(df.columns)]]]
-    
+
     #rename columns according to manual order
     colDict = {'0_%':'1','1_%':'4','2_%':'2','3_%':'5','4_%':'3'}
     dfPerc = dfPerc.rename(mapper=colDict, axis=1)
     dfPerc = dfPerc[['1','2','3','4','5']] #order columns from 1-5
-    
+
     #sort descending tumor cluster
     dfPercSort = dfPerc.sort_values('5',ascending=False)
     dfPercSort.index = dfPercSort.index.str[0:-8]
     palette = {'1':'rgb(0,206,209)','2':'rgb(255,0,255)','3':'rgb(50,205,50)','4':'rgb(148,0,211)','5':'rgb(255,127,80)'}
-    
+
     #plot
     fig = px.bar(dfPercSort,y=dfPercSort.columns,barmode='stack',color_discrete_map=palette,labels={'index':'Specimen','value':'Fraction Present','variable':'Cluster'})
     fig.update_layout(legend_traceorder="reversed")
-    fig.write_image(path+'/results/figures/figure5D.png')
-    
+    exportFigure(fig,path+'/results/figures/figure5D.png')
+
     #look at correlation between sum of t cell clusters vs tumor cluster
     dfPerc['1+2'] = dfPerc['1'] + dfPerc['2']
-    
-    regplot(x=dfPerc['1+2'],y=dfPerc['5'])
-    plt.annotate('Correlation = '+str(round(dfPerc.corr().loc['5','1+2'],3)), (0.6,0.9))
-    plt.savefig(path+'/results/figures/figure5E.png',format='png')
-    plt.close()
-
-    #SUPPLEMENTARY FIGURE S7B
-    #get df from saved csv
-    df = pd.read_csv(path+'/results/dfCreated/dfClustCountsNK120k5_all.csv',index_col=0)
-    
-    #add % column
-    for col in df.columns:
-        df[str(col)+'_%'] = df[col]/df.iloc[:,0:5].sum(axis=1) #divide by the sum of only the first 5 columns
-    
+
+    #pyplot keeps global state, so hold the lock in case the elbow plot is being drawn in a background stage
+    with pyplotLock:
+        regplot(x=dfPerc['1+2'],y=dfPerc['5'])
+        plt.annotate('Correlation = '+str(round(dfPerc.corr().loc['5','1+2'],3)), (0.6,0.9))
+        plt.savefig(path+'/results/figures/figure5E.png',format='png')
+        plt.close()
+
+
+
+def figS7B(path):
+    '''
+    This function creates supplementary figure S7B: cluster composition per ROI.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for supplementary figure S7B
+    '''
+
+    import plotly.express as px
+
+    #get the ROI level of the saved rollup
+    df = queryRollup(path,'dfClustRollupNK120k5','ROI')
+
+    #fraction of each cluster per ROI, from the counts rather than the fractions parsed back from the csv
+    for col in df.columns[['%' in col for col in list(df.columns)]]:
+        df[col] = df[col[:-2]]/df['Total']
+
     #generate column list to cluster on based on if there is a % in the column name
     dfPerc = df[df.columns[['%' in col for col in list(df.columns)]]]
-    
+
     colDict = {'0_%':'1','1_%':'4','2_%':'2','3_%':'5','4_%':'3'}
     dfPerc = dfPerc.rename(mapper=colDict, axis=1)
     dfPerc = dfPerc[['1','2','3','4','5']] #order columns from 1-5
-    
+
     #sort by descending tumor cluster
     dfPercSort = dfPerc.sort_values('5',ascending=False)
-    
+
     #color map
     palette = {'1':'darkturquoise','2':'magenta','3':'limegreen','4':'darkviolet','5':'coral'}
-    
+
     #plot
     fig = px.bar(dfPercSort,y=dfPercSort.columns[0:5],barmode='stack',color_discrete_map=palette,labels={'index':'ROI','value':'Fraction Present','variable':'Cluster'})
     fig.update_xaxes(showticklabels=False)
     fig.update_layout(legend_traceorder="reversed")
-    fig.write_image(path+'/results/figures/figureS7B.png')
+    exportFigure(fig,path+'/results/figures/figureS7B.png')
+
+
+
+def fig5F(path):
+    '''
+    This function creates figure 5F: cluster fractions by HER2 status, and prints its statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for figure 5F
+    '''
+
+    import plotly.express as px
+    from scipy.stats import mannwhitneyu
+    from statsmodels.stats.multitest import fdrcorrection
+
+    #get the patient level of the saved rollup; it has the her2 status of each patient
+    df = queryRollup(path,'dfClustRollupNK120k5','patient')
+
+    #generate column list to cluster on based on if there is a % in the column name, and keep her2 status
+    df = df[df.columns[['%' in col or col == 'HER2' for col in list(df.columns)]]]
 
-    #FIGURE 5F
-    #get df from saved csv
-    df = pd.read_csv(path+'/results/dfCreated/dfClustCountsNK120k5_avg.csv',index_col=0)
-    
-    #generate column list to cluster on based on if there is a % in the column name
-    df = df[df.columns[['%' in col for col in list(df.columns)]]]
-    
-    #get clinical df to add her2 status
-    dfClin = pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
-    df['HER2'] = dfClin['HER2']
-    
     #reorder columns
     colDict = {'0_%':'1','1_%':'4','2_%':'2','3_%':'5','4_%':'3'}
     df = df.rename(mapper=colDict, axis=1)
     df = df[['1','2','3','4','5','HER2']] #order columns from 1-5
-    
+
     #plot
     fig = px.box(df,y=df.columns[:-1],points='all',color='HER2',labels={'variable':'Cluster','value':'Fraction Present'})
-    fig.write_image(path+'/results/figures/figure5F.png')
+    exportFigure(fig,path+'/results/figures/figure5F.png')
 
     #test for significance - HER2
     dfP = df[df['HER2'] == 1]
     dfN = df[df['HER2'] == 0]
-    
+
     pHER2List = [] #to store p values for the HER2 analysis; for MHT correction
     colList = list(df.columns[0:5])
-    
+
     #mann whitney u test
     for col in colList:
         pVal = mannwhitneyu(dfP[col],dfN[col]).pvalue
         pHER2List.append(pVal)
-    
+
     #correct for MHT - Benjamini-Hochberg
     mhtList = fdrcorrection(pHER2List,alpha=0.05)[1]
-    
+
     print('\nMHT corrected P-values for Figure 5F:')
     for i in range(len(mhtList)):
         col = colList[i]
         mhtP = mhtList[i]
-        print('Cluster',col+': p =',round(mhtP,3))   
-    
-    
-    #SUPPLEMENTARY FIGURE S7C
+        print('Cluster',col+': p =',round(mhtP,3))
+
+
+
+def figS7C(path):
+    '''
+    This function creates supplementary figure S7C: cluster fractions by HER2 status in cohort 1 only, and prints its statistics.
+    Input parameters:
+        path = cwd
+    Outputs:
+        Saves plot to 'figures' folder for supplementary figure S7C
+    '''
+
+    import plotly.express as px
+    from scipy.stats import mannwhitneyu
+    from statsmodels.stats.multitest import fdrcorrection
+
     #cohort 1 only: her2+ vs her2-
-    #get df from saved csv
-    df = pd.read_csv(path+'/results/dfCreated/dfClustCountsNK120k5_avg.csv',index_col=0)
-    
-    #subset to cohort 1 patients only (duke)
-    df = df[['D' in i for i in df.index]]
-    
-    #generate column list to cluster on based on if there is a % in the column name
-    df = df[df.columns[['%' in col for col in list(df.columns)]]]
-    
-    #get clinical df to add her2 status
-    dfClin = pd.read_csv(path+'/data/metadata/clinicalData.csv',index_col=0)
-    df['HER2'] = dfClin['HER2']
-    
+    #get the patient level of the saved rollup, subset to cohort 1 patients only (duke)
+    df = queryRollup(path,'dfClustRollupNK120k5','patient',cohort='D')
+
+    #generate column list to cluster on based on if there is a % in the column name, and keep her2 status
+    df = df[df.columns[['%' in col or col == 'HER2' for col in list(df.columns)]]]
+
     #reorder columns
     colDict = {'0_%':'1','1_%':'4','2_%':'2','3_%':'5','4_%':'3'}
     df = df.rename(mapper=colDict, axis=1)
     df = df[['1','2','3','4','5','HER2']] #order columns from 1-5
-    
+
     #plot
     fig = px.box(df,y=df.columns[:-1],points='all',color='HER2',labels={'variable':'Cluster','value':'Fraction Present'})
-    fig.write_image(path+'/results/figures/figureS7C.png')
-    
+    exportFigure(fig,path+'/results/figures/figureS7C.png')
+
     #test for significance - HER2
     dfP = df[df['HER2'] == 1]
     dfN = df[df['HER2'] == 0]
-    
+
     pHER2List = [] #to store p values for the HER2 analysis; for MHT correction
     colList = list(df.columns[0:5])
-    
+
     #mann-whitney u
     for col in colList:
         pVal = mannwhitneyu(dfP[col],dfN[col]).pvalue
         pHER2List.append(pVal)
-    
+
     #correct for MHT - Benjamini-Hochberg
     mhtList = fdrcorrection(pHER2List,alpha=0.05)[1]
-    
+
     print('\nMHT corrected P-values for Supplementary Figure S7C:')
     for i in range(len(mhtList)):
         col = colList[i]
         mhtP = mhtList[i]
         print('Cluster',col+': p =',round(mhtP,3))
-        
-    print("Figures 5B-F and Supplementary Figures S7A-C saved to 'figures' folder.")
-    print('Figure 5 complete.')
-    print('\nALL ANALYSES COMPLETE.\n')
 
 
 
 if __name__=="__main__":
-    fig3()
-    fig4()
-    fig5()
-    
\ No newline at end of file
+    import os
+    #put every ROI in the memory-mapped cohort store once (rebuilt only when a csv changes); stages and their worker processes all slice ROIs from it
+    startSession(path=os.getcwd(),csvList=getCsvList(),nProcs=None,cohortStore=True)
+    #run all figures; the figure 3, 4 and 5 analyses share no intermediates, so their stages overlap
+    runPipeline(nProcs=None)
+    endSession()
+    print('\nALL ANALYSES COMPLETE.\n')